@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Measures the filesystem primitives of multipackager (merge_overlay, copy_cache, copy_perms,
+# get_project_size, full_delete and cleanup) over synthetic trees with the shape of a real Debian
+# or Arch CHROOT environment: many small files, symlinks, deep folders and, for the overlays,
+# whiteouts and opaque folders. The whiteouts need root; without it they are skipped.
+#
+#     benchmarks/filesystem.py [--profile debian|arch] [--scale 1.0] [--repeat 3] [--path folder]
+#                              [--output results.json] [--baseline baseline.json] [--tolerance 0.2]
+#     benchmarks/filesystem.py --check-cross-device [--path folder]
+#
+# The results are stored in JSON with --output; with --baseline, they are compared with a previous
+# result file, and the program returns 1 if any primitive is slower than the baseline plus the tolerance.
+# --check-cross-device doesn't measure anything: it merges a small overlay making rename() fail with
+# EXDEV, as when the upper folder is in another filesystem, and returns 1 if the result is wrong.
+
+import sys
+import os
+import time
+import json
+import stat
+import random
+import shutil
+import platform
+import tempfile
+import errno
+import argparse
+import subprocess
+import contextlib
+import gettext
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","src"))
+gettext.install("multipackager")
+
+import multipackager_module.configuration
+import multipackager_module.package_base
+
+# approximate shape of a freshly bootstrapped CHROOT environment with the build tools installed
+profiles = {
+    "debian" : {"files":105000, "folders":9500, "symlinks":9000, "depth":12},
+    "arch" : {"files":140000, "folders":12500, "symlinks":12000, "depth":12}
+}
+
+# most of the files in a system are small
+file_sizes = [0, 64, 512, 2048, 8192, 32768, 131072]
+file_size_weights = [3, 15, 30, 25, 17, 8, 2]
+
+top_folders = ["etc", "usr/bin", "usr/lib", "usr/include", "usr/share/doc", "usr/share/locale", "usr/share/man", "var/lib", "var/cache"]
+
+
+class synthetic_tree(object):
+
+    def __init__(self, profile, scale, seed = 1):
+
+        self.profile = profile
+        self.scale = scale
+        self.random = random.Random(seed)
+        self.folders = []
+        self.files = []
+        self.stats = {"files":0, "folders":0, "symlinks":0, "bytes":0, "whiteouts":0, "opaque":0}
+
+
+    def write_file(self,path):
+
+        size = self.random.choices(file_sizes,file_size_weights)[0]
+        f = open(path,"wb")
+        if size != 0:
+            f.write(b"m" * size)
+        f.close()
+        self.stats["files"] += 1
+        self.stats["bytes"] += size
+
+
+    def create(self,path):
+
+        """ Creates the tree of the profile at path """
+
+        for folder in top_folders:
+            os.makedirs(os.path.join(path,folder))
+            self.folders.append((folder,folder.count("/") + 1))
+        for n in range(int(self.profile["folders"] * self.scale)):
+            # choose a parent that still allows to go deeper
+            while True:
+                parent,depth = self.random.choice(self.folders)
+                if depth < self.profile["depth"]:
+                    break
+            folder = os.path.join(parent,"folder{:d}".format(n))
+            os.mkdir(os.path.join(path,folder))
+            self.folders.append((folder,depth + 1))
+            self.stats["folders"] += 1
+        for n in range(int(self.profile["files"] * self.scale)):
+            folder = self.random.choice(self.folders)[0]
+            filename = os.path.join(folder,"file{:d}".format(n))
+            self.write_file(os.path.join(path,filename))
+            self.files.append(filename)
+        for n in range(int(self.profile["symlinks"] * self.scale)):
+            folder = self.random.choice(self.folders)[0]
+            # like in a real system, some links are absolute, and others relative
+            destination = self.random.choice(self.files)
+            if (n % 2) == 0:
+                destination = "/" + destination
+            else:
+                destination = os.path.relpath(destination,folder)
+            os.symlink(destination,os.path.join(path,folder,"link{:d}".format(n)))
+            self.stats["symlinks"] += 1
+
+
+    def create_overlay(self,path,can_mknod):
+
+        """ Creates, at path, an upper folder with the changes done by installing some packages over the tree """
+
+        def ensure_folder(folder):
+            full_folder = os.path.join(path,folder)
+            if not os.path.exists(full_folder):
+                os.makedirs(full_folder)
+
+        files = self.random.sample(self.files,len(self.files) // 10)
+        modified = files[:len(files) // 2]
+        deleted = files[len(files) // 2:len(files) // 2 + len(files) // 10]
+        for filename in modified:
+            ensure_folder(os.path.dirname(filename))
+            self.write_file(os.path.join(path,filename))
+        if can_mknod:
+            for filename in deleted:
+                ensure_folder(os.path.dirname(filename))
+                os.mknod(os.path.join(path,filename),0o600 | 0o020000,os.makedev(0,0))
+                self.stats["whiteouts"] += 1
+            for folder,depth in self.random.sample(self.folders,len(self.folders) // 200):
+                ensure_folder(folder)
+                os.setxattr(os.path.join(path,folder),"trusted.overlay.opaque",b"y")
+                self.write_file(os.path.join(path,folder,"opaque_file"))
+                self.stats["opaque"] += 1
+        # new packages add new folders
+        for n in range(len(self.folders) // 20):
+            folder = os.path.join(self.random.choice(self.folders)[0],"new_folder{:d}".format(n))
+            ensure_folder(folder)
+            for m in range(8):
+                self.write_file(os.path.join(path,folder,"new_file{:d}".format(m)))
+
+
+def copy_tree(origin,destination):
+
+    if 0 != subprocess.call(["cp","-a",origin,destination]):
+        raise RuntimeError("Can't copy {:s} to {:s}".format(origin,destination))
+
+
+def timed(function,*args):
+
+    with open(os.devnull,"w") as null, contextlib.redirect_stdout(null):
+        start = time.monotonic()
+        function(*args)
+        return time.monotonic() - start
+
+
+def bench_merge_overlay(distro,master,overlay_master,scratch):
+
+    lower = os.path.join(scratch,"lower")
+    upper = os.path.join(scratch,"upper")
+    copy_tree(master,lower)
+    copy_tree(overlay_master,upper)
+    elapsed = timed(distro.merge_overlay,lower,upper)
+    shutil.rmtree(lower)
+    shutil.rmtree(upper, ignore_errors = True)
+    return elapsed
+
+
+def bench_copy_cache(distro,master,overlay_master,scratch):
+
+    destination = os.path.join(scratch,"copy")
+    elapsed = timed(distro.copy_cache,master,destination)
+    shutil.rmtree(destination)
+    return elapsed
+
+
+def bench_copy_perms(distro,master,overlay_master,scratch):
+
+    # the template is the CHROOT environment, and the final folder the install_root with the same folders
+    final_folder = os.path.join(scratch,"install_root")
+    for folder in top_folders:
+        os.makedirs(os.path.join(final_folder,folder))
+    elapsed = timed(distro.copy_perms,master,final_folder)
+    shutil.rmtree(final_folder)
+    return elapsed
+
+
+def bench_get_project_size(distro,master,overlay_master,scratch):
+
+    distro.working_path = os.path.join(scratch,"working")
+    os.makedirs(distro.working_path)
+    os.symlink(master,os.path.join(distro.working_path,"install_root"))
+    elapsed = timed(distro.get_project_size)
+    shutil.rmtree(distro.working_path)
+    return elapsed
+
+
+def bench_full_delete(distro,master,overlay_master,scratch):
+
+    destination = os.path.join(scratch,"delete")
+    copy_tree(master,destination)
+    return timed(distro.full_delete,destination)
+
+
+def bench_cleanup(distro,master,overlay_master,scratch):
+
+    distro.working_path = os.path.join(scratch,"working")
+    distro.used_overlay = False
+    copy_tree(master,distro.working_path)
+    return timed(distro.cleanup)
+
+
+primitives = [
+    ("merge_overlay", bench_merge_overlay),
+    ("copy_cache", bench_copy_cache),
+    ("copy_perms", bench_copy_perms),
+    ("get_project_size", bench_get_project_size),
+    ("full_delete", bench_full_delete),
+    ("cleanup", bench_cleanup)
+]
+
+
+@contextlib.contextmanager
+def cross_device_renames():
+
+    """ Makes rename() fail with EXDEV when the origin and the destination are in different folders """
+
+    rename = os.rename
+    def cross_device_rename(origin,destination,*args,**kwargs):
+        if os.path.dirname(os.path.abspath(origin)) != os.path.dirname(os.path.abspath(destination)):
+            raise OSError(errno.EXDEV,os.strerror(errno.EXDEV),origin,None,destination)
+        return rename(origin,destination,*args,**kwargs)
+    os.rename = cross_device_rename
+    try:
+        yield
+    finally:
+        os.rename = rename
+
+
+def check_cross_device(distro,scratch):
+
+    """ Merges an overlay that replaces symlinks, device nodes and folders, copying everything as if
+        the upper folder were in another filesystem. Returns a list with the problems found """
+
+    can_mknod = (os.geteuid() == 0)
+    lower = os.path.join(scratch,"lower")
+    upper = os.path.join(scratch,"upper")
+    victim = os.path.join(scratch,"victim")
+    for folder in [os.path.join(lower,"folder"), os.path.join(lower,"replaced"), os.path.join(upper,"folder"), os.path.join(upper,"new_folder")]:
+        os.makedirs(folder)
+    with open(victim,"w") as f:
+        f.write("victim")
+    os.symlink(victim,os.path.join(lower,"file"))
+    os.symlink("a",os.path.join(lower,"link"))
+    with open(os.path.join(lower,"folder","kept"),"w") as f:
+        f.write("kept")
+    with open(os.path.join(upper,"file"),"w") as f:
+        f.write("new")
+    os.symlink("b",os.path.join(upper,"link"))
+    with open(os.path.join(upper,"replaced"),"w") as f:
+        f.write("replaced")
+    with open(os.path.join(upper,"folder","added"),"w") as f:
+        f.write("added")
+    with open(os.path.join(upper,"new_folder","inside"),"w") as f:
+        f.write("inside")
+    if can_mknod:
+        os.mknod(os.path.join(lower,"device"),0o600 | stat.S_IFCHR,os.makedev(1,3))
+        os.mknod(os.path.join(upper,"device"),0o600 | stat.S_IFCHR,os.makedev(1,5))
+
+    with cross_device_renames():
+        with open(os.devnull,"w") as null, contextlib.redirect_stdout(null):
+            failed = distro.merge_overlay(lower,upper)
+
+    def read(path):
+        if os.path.islink(path) or not os.path.isfile(path):
+            return None
+        with open(path,"r") as f:
+            return f.read()
+
+    problems = []
+    if failed:
+        problems.append("merge_overlay returned an error")
+    if read(victim) != "victim":
+        problems.append("the target of a replaced symlink was overwritten")
+    if read(os.path.join(lower,"file")) != "new":
+        problems.append("a symlink wasn't replaced by a file")
+    if (not os.path.islink(os.path.join(lower,"link"))) or (os.readlink(os.path.join(lower,"link")) != "b"):
+        problems.append("a changed symlink wasn't replaced")
+    if read(os.path.join(lower,"replaced")) != "replaced":
+        problems.append("a folder wasn't replaced by a file")
+    if (read(os.path.join(lower,"folder","kept")) != "kept") or (read(os.path.join(lower,"folder","added")) != "added"):
+        problems.append("the contents of a folder weren't merged")
+    if read(os.path.join(lower,"new_folder","inside")) != "inside":
+        problems.append("a new folder wasn't copied")
+    if can_mknod and (os.lstat(os.path.join(lower,"device")).st_rdev != os.makedev(1,5)):
+        problems.append("a changed device node wasn't replaced")
+    for dirname, dirnames, filenames in os.walk(lower):
+        if ".multipackager_merge.tmp" in dirnames + filenames:
+            problems.append("a temporary copy was left in {:s}".format(dirname))
+    return problems
+
+
+def compare(results,baseline,tolerance):
+
+    """ Prints the comparison with the baseline. Returns True if there is any regression """
+
+    regression = False
+    print("")
+    print("{:<20s} {:>10s} {:>10s} {:>8s}".format("primitive","baseline","now","ratio"))
+    for name,function in primitives:
+        if (name not in results["primitives"]) or (name not in baseline["primitives"]):
+            continue
+        old = baseline["primitives"][name]["min"]
+        new = results["primitives"][name]["min"]
+        ratio = (new / old) if old > 0 else 1.0
+        status = ""
+        if ratio > 1.0 + tolerance:
+            status = "REGRESSION"
+            regression = True
+        print("{:<20s} {:>10.3f} {:>10.3f} {:>8.2f} {:s}".format(name,old,new,ratio,status))
+    if (baseline.get("profile") != results["profile"]) or (baseline.get("scale") != results["scale"]):
+        print("Warning: the baseline was measured with a different profile or scale")
+    return regression
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description = "Measures the filesystem primitives of multipackager over synthetic trees")
+    parser.add_argument("--profile", choices = sorted(profiles), default = "debian", help = "shape of the synthetic tree")
+    parser.add_argument("--scale", type = float, default = 1.0, help = "multiplier for the number of files of the profile")
+    parser.add_argument("--repeat", type = int, default = 3, help = "times that each primitive is measured; the minimum is used")
+    parser.add_argument("--path", default = None, help = "folder where the trees are created (it must be in the filesystem to measure)")
+    parser.add_argument("--output", default = None, help = "JSON file where the results are stored")
+    parser.add_argument("--baseline", default = None, help = "JSON file with previous results to compare with")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "slowdown allowed before reporting a regression")
+    parser.add_argument("--check-cross-device", action = "store_true", help = "checks merge_overlay when the upper folder is in another filesystem")
+    args = parser.parse_args(argv[1:])
+
+    base_path = tempfile.mkdtemp(prefix = "multipackager_fsbench_", dir = args.path)
+    try:
+        config = multipackager_module.configuration.configuration()
+        config.cache_path = base_path
+        config.working_path = base_path
+        with open(os.devnull,"w") as null, contextlib.redirect_stdout(null):
+            distro = multipackager_module.package_base.package_base(config,"debian","sid","amd64")
+
+        if args.check_cross_device:
+            scratch = os.path.join(base_path,"scratch")
+            problems = check_cross_device(distro,scratch)
+            for problem in problems:
+                print(problem)
+            if os.geteuid() != 0:
+                print("Not running as root: the device nodes weren't checked")
+            print("merge_overlay across filesystems: {:s}".format("FAILED" if len(problems) != 0 else "OK"))
+            return 1 if len(problems) != 0 else 0
+
+        can_mknod = (os.geteuid() == 0)
+        if not can_mknod:
+            print("Not running as root: the overlay will have no whiteouts nor opaque folders")
+
+        tree = synthetic_tree(profiles[args.profile],args.scale)
+        master = os.path.join(base_path,"master")
+        overlay_master = os.path.join(base_path,"overlay_master")
+        start = time.monotonic()
+        tree.create(master)
+        lower_stats = dict(tree.stats)
+        tree.create_overlay(overlay_master,can_mknod)
+        print("Created a {:s} tree with {:d} files, {:d} folders and {:d} symlinks ({:d} bytes) in {:.1f} seconds".format(args.profile,
+              lower_stats["files"],lower_stats["folders"],lower_stats["symlinks"],lower_stats["bytes"],time.monotonic() - start))
+
+        results = {"profile":args.profile,
+                   "scale":args.scale,
+                   "repeat":args.repeat,
+                   "storage":distro.storage.name,
+                   "machine":{"node":platform.node(), "kernel":platform.release(), "python":platform.python_version()},
+                   "tree":lower_stats,
+                   "overlay":{"files":tree.stats["files"] - lower_stats["files"], "whiteouts":tree.stats["whiteouts"], "opaque":tree.stats["opaque"]},
+                   "primitives":{}}
+
+        print("{:<20s} {:>10s} {:>10s} {:>10s}".format("primitive","min (s)","median","max"))
+        for name,function in primitives:
+            scratch = os.path.join(base_path,"scratch")
+            times = []
+            for n in range(args.repeat):
+                os.makedirs(scratch)
+                times.append(function(distro,master,overlay_master,scratch))
+                shutil.rmtree(scratch, ignore_errors = True)
+            times.sort()
+            results["primitives"][name] = {"min":times[0], "median":times[len(times) // 2], "max":times[-1]}
+            print("{:<20s} {:>10.3f} {:>10.3f} {:>10.3f}".format(name,times[0],times[len(times) // 2],times[-1]))
+    finally:
+        shutil.rmtree(base_path, ignore_errors = True)
+
+    if args.output != None:
+        f = open(args.output,"w")
+        json.dump(results,f,indent = 4)
+        f.close()
+
+    if args.baseline != None:
+        f = open(args.baseline,"r")
+        baseline = json.load(f)
+        f.close()
+        if compare(results,baseline,args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
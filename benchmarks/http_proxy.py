@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Checks and measures the caching proxy against a local stand-in mirror, with several clients
+# downloading the same files at the same time:
+#
+#     benchmarks/http_proxy.py [--clients 8] [--packages 50] [--size KB]
+#
+# It downloads everything twice (the second time must be served from the cache), changes an
+# index in the mirror (the proxy must notice it), and stops the mirror (the proxy must keep
+# serving what it has). Returns 1 if any file received is wrong.
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+import functools
+import http.server
+import urllib.request
+import concurrent.futures
+import gettext
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","src"))
+gettext.install("multipackager")
+
+import multipackager_module.http_proxy
+
+
+class mirror_handler(http.server.SimpleHTTPRequestHandler):
+
+    def log_message(self,format,*args):
+
+        with self.server.lock:
+            self.server.requests += 1
+
+
+def start_mirror(path):
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1",0),functools.partial(mirror_handler,directory = path))
+    server.lock = threading.Lock()
+    server.requests = 0
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+
+def download(opener,url):
+
+    response = opener.open(url,timeout = 60)
+    data = response.read()
+    response.close()
+    return data
+
+
+def download_all(opener,urls,expected,clients):
+
+    """ Downloads all the URLs with several clients at the same time. Returns the time spent and the number of wrong files """
+
+    start = time.monotonic()
+    errors = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers = clients) as executor:
+        # each client asks for every file, so they compete for the same URLs
+        futures = []
+        for client in range(clients):
+            for url in urls:
+                futures.append((url,executor.submit(download,opener,url)))
+        for url,future in futures:
+            try:
+                if future.result() != expected[url]:
+                    errors += 1
+            except Exception as e:
+                print("{:s}: {:s}".format(url,str(e)))
+                errors += 1
+    return time.monotonic() - start,errors
+
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description = "Checks the caching proxy against a local stand-in mirror")
+    parser.add_argument("--clients", type = int, default = 8, help = "clients downloading at the same time")
+    parser.add_argument("--packages", type = int, default = 50, help = "number of packages in the mirror")
+    parser.add_argument("--size", type = int, default = 256, help = "size of each package, in KB")
+    args = parser.parse_args(argv[1:])
+
+    base_path = tempfile.mkdtemp(prefix = "multipackager_proxy_")
+    errors = 0
+    try:
+        mirror_path = os.path.join(base_path,"mirror")
+        os.makedirs(os.path.join(mirror_path,"pool"))
+        os.makedirs(os.path.join(mirror_path,"dists"))
+        expected = {}
+        mirror = start_mirror(mirror_path)
+        mirror_url = "http://127.0.0.1:{:d}".format(mirror.server_address[1])
+
+        index_path = os.path.join(mirror_path,"dists","Packages")
+        f = open(index_path,"w")
+        for n in range(args.packages):
+            filename = "package{:d}_1.0_amd64.deb".format(n)
+            data = bytes([n % 256]) * (args.size * 1024)
+            p = open(os.path.join(mirror_path,"pool",filename),"wb")
+            p.write(data)
+            p.close()
+            expected[mirror_url+"/pool/"+filename] = data
+            f.write("Filename: pool/{:s}\n".format(filename))
+        f.close()
+        index_url = mirror_url+"/dists/Packages"
+        f = open(index_path,"rb")
+        expected[index_url] = f.read()
+        f.close()
+
+        proxy = multipackager_module.http_proxy.http_proxy(os.path.join(base_path,"cache"),1024 * 1048576)
+        if proxy.start():
+            return 1
+        opener = urllib.request.build_opener(urllib.request.ProxyHandler({"http":proxy.get_url()}))
+        urls = sorted(expected)
+
+        elapsed,wrong = download_all(opener,urls,expected,args.clients)
+        errors += wrong
+        print("Cold: {:d} downloads in {:.3f} seconds, {:d} requests to the mirror, {:d} errors".format(len(urls) * args.clients,elapsed,mirror.requests,wrong))
+
+        mirror.requests = 0
+        elapsed,wrong = download_all(opener,urls,expected,args.clients)
+        errors += wrong
+        print("Warm: {:d} downloads in {:.3f} seconds, {:d} requests to the mirror, {:d} errors".format(len(urls) * args.clients,elapsed,mirror.requests,wrong))
+
+        # the index changes in the mirror, so the proxy must send the new one
+        time.sleep(1.1) # Last-Modified has a resolution of one second
+        f = open(index_path,"a")
+        f.write("Filename: pool/new_package_1.0_amd64.deb\n")
+        f.close()
+        f = open(index_path,"rb")
+        expected[index_url] = f.read()
+        f.close()
+        if download(opener,index_url) != expected[index_url]:
+            print("The proxy sent an outdated index")
+            errors += 1
+        else:
+            print("Updated index received")
+
+        # without mirror, the cached files must still be available
+        mirror.shutdown()
+        mirror.server_close()
+        elapsed,wrong = download_all(opener,urls,expected,1)
+        errors += wrong
+        print("Without mirror: {:d} downloads in {:.3f} seconds, {:d} errors".format(len(urls),elapsed,wrong))
+
+        proxy.stop()
+    finally:
+        shutil.rmtree(base_path, ignore_errors = True)
+
+    return 1 if errors != 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Measures the time spent by multipackager itself (scheduling, caches, overlays, file management...),
+# without the package managers. It adds a 'simulated' distro, whose commands only wait a configurable
+# time and create some files, and runs build_project, update_envs and clearcache with it over matrices
+# of targets. Doesn't need to be run as root, because the mounts are simulated too:
+#
+#     benchmarks/orchestrator.py [--targets 1,10,50,200] [--files N] [--latency ms] [--jobs N]
+#
+# For each command it shows the wall and CPU time, the time spent waiting in the simulated commands, the
+# programs launched (inside a container, outside, and by the storage backend), and the time spent in the
+# filesystem primitives (merging and deleting overlays, copying caches...), summed over all the threads.
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+import contextlib
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","src"))
+
+import multipackager
+import multipackager_module.configuration
+import multipackager_module.package_base
+
+
+class statistics(object):
+
+    def __init__(self, files, latency):
+
+        self.files = files # files in each base system
+        self.latency = latency # seconds that each simulated command lasts
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+
+    def reset(self):
+
+        self.spawns = {"chroot":0, "command":0, "storage":0}
+        self.simulated_time = 0.0
+        self.filesystem_time = 0.0
+
+
+    def add_spawn(self,category,simulated_time = 0.0):
+
+        with self.lock:
+            self.spawns[category] += 1
+            self.simulated_time += simulated_time
+
+
+    def add_filesystem_time(self,elapsed):
+
+        with self.lock:
+            self.filesystem_time += elapsed
+
+
+stats = None
+
+
+def create_tree(path,files):
+
+    """ Creates a tree with the folders of a minimal system and the specified number of small files """
+
+    for folder in ["etc","bin","usr/bin","usr/lib","usr/share/doc","var/lib","var/cache","tmp","root"]:
+        os.makedirs(os.path.join(path,folder), exist_ok = True)
+    for n in range(files):
+        folder = os.path.join(path,"usr","share","doc","package{:d}".format(n // 20))
+        os.makedirs(folder, exist_ok = True)
+        f = open(os.path.join(folder,"file{:d}".format(n)),"w")
+        f.write("simulated file {:d}\n".format(n))
+        f.close()
+
+
+def filesystem_primitive(function):
+
+    """ Adds the time spent in a filesystem primitive to the statistics, except when it is called from another one """
+
+    def inner(*args,**kwargs):
+        depth = getattr(stats.local,"depth",0)
+        stats.local.depth = depth + 1
+        start = time.monotonic()
+        try:
+            return function(*args,**kwargs)
+        finally:
+            stats.local.depth = depth
+            if depth == 0:
+                stats.add_filesystem_time(time.monotonic() - start)
+    return inner
+
+
+class simulated(multipackager_module.package_base.package_base):
+
+    """ Distro whose commands don't do anything but waiting and creating some files """
+
+    def get_package_name(self,project_path):
+
+        return "simulated-{:s}-{:s}.pkg".format(self.distro_name,self.architecture)
+
+
+    def get_dependency_list(self,project_path):
+
+        return ["libsimulated-dev", "simulated-tools"]
+
+
+    def generate(self,path):
+
+        tmp_path = path+".tmp"
+        self.storage.delete(tmp_path)
+        self.storage.create_folder(tmp_path)
+        if 0 != self.run_chroot(tmp_path,"simulated-bootstrap"):
+            return True
+        create_tree(tmp_path,stats.files)
+        os.rename(tmp_path,path)
+        return False
+
+
+    @multipackager_module.package_base.call_with_cache
+    def update(self,path):
+
+        return 0 != self.run_chroot(path,"simulated-update")
+
+
+    def install_dependencies(self,project_path,avoid_packages,preinstall):
+
+        return self.install_dependencies_layer(self.get_dependency_list(project_path))
+
+
+    def install_dependencies_full(self,path,dependencies):
+
+        return 0 != self.run_chroot(path,"simulated-install {:s}".format(" ".join(dependencies)))
+
+
+    def build_package(self,project_path):
+
+        if 0 != self.run_chroot(self.working_path,"simulated-package"):
+            return True
+        f = open(os.path.join(os.getcwd(),self.get_package_name(project_path)),"w")
+        f.write("simulated package\n")
+        f.close()
+        return False
+
+
+    def run_chroot(self,base_path,command,username = None,environment = None):
+
+        time.sleep(stats.latency)
+        stats.add_spawn("chroot",stats.latency)
+        if command.find("/install_root") != -1:
+            # the build of the project
+            create_tree(os.path.join(base_path,"install_root"),20)
+        return 0
+
+
+    def run_external_program(self,command,show_msg = True):
+
+        if command.startswith("cp "):
+            # the files copied are needed by the next phases
+            stats.add_spawn("command")
+            return multipackager_module.package_base.package_base.run_external_program(self,command,show_msg)
+        time.sleep(stats.latency)
+        stats.add_spawn("command",stats.latency)
+        return 0
+
+
+    def run_storage_program(self,args,quiet = False):
+
+        stats.add_spawn("storage")
+        return multipackager_module.package_base.package_base.run_storage_program(self,args,quiet)
+
+
+for primitive in ["merge_overlay", "discard_overlay", "cleanup", "copy_cache", "get_project_size", "copy_perms", "clear_cache", "clear_layers", "evict_layers"]:
+    setattr(simulated,primitive,filesystem_primitive(getattr(multipackager_module.package_base.package_base,primitive)))
+
+
+def measure(name,targets,function,*args):
+
+    stats.reset()
+    wall_start = time.monotonic()
+    cpu_start = time.process_time()
+    with open(os.devnull,"w") as null, contextlib.redirect_stdout(null):
+        function(*args)
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+    print("{:>7d} {:<14s} {:>9.3f} {:>9.3f} {:>9.3f} {:>7d} {:>7d} {:>7d} {:>9.3f}".format(targets,name,wall,cpu,stats.simulated_time,
+          stats.spawns["chroot"],stats.spawns["command"],stats.spawns["storage"],stats.filesystem_time))
+
+
+def run_matrix(targets,jobs):
+
+    base_path = tempfile.mkdtemp(prefix = "multipackager_bench_")
+    old_path = os.getcwd()
+    try:
+        config = multipackager_module.configuration.configuration()
+        config.config_file = os.path.join(base_path,"config.cfg") # doesn't exist, so only the values set here are used
+        config.cache_path = os.path.join(base_path,"cache")
+        config.working_path = os.path.join(base_path,"working")
+        config.sessions = False
+        config.caching_proxy = False # the simulated commands don't download anything
+        config.jobs = jobs
+        os.makedirs(config.cache_path)
+        os.makedirs(config.working_path)
+        for n in range(targets):
+            config.append_distro("simulated","sim{:d}".format(n // 2),"amd64" if (n % 2) == 0 else "i386")
+
+        project_path = os.path.join(base_path,"project")
+        os.makedirs(project_path)
+        f = open(os.path.join(project_path,"multipackager.sh"),"w")
+        f.write("true\n")
+        f.close()
+        output_path = os.path.join(base_path,"output")
+        os.makedirs(output_path)
+        os.chdir(output_path)
+
+        measure("build (cold)",targets,multipackager.build_project,config,project_path)
+        measure("build (warm)",targets,multipackager.build_project,config,project_path)
+        measure("update",targets,multipackager.update_envs,["multipackager.py","update"],config)
+        measure("clearcache",targets,multipackager.clearcache,["multipackager.py","clearcache"],config)
+    finally:
+        os.chdir(old_path)
+        shutil.rmtree(base_path, ignore_errors = True)
+
+
+def main(argv):
+
+    global stats
+
+    parser = argparse.ArgumentParser(description = "Measures the overhead of multipackager with a simulated distro")
+    parser.add_argument("--targets", default = "1,10,50,200", help = "comma-separated list with the number of targets of each matrix")
+    parser.add_argument("--files", type = int, default = 2000, help = "number of files in each simulated base system")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "milliseconds that each simulated command lasts")
+    parser.add_argument("--jobs", type = int, default = 1, help = "number of targets built at the same time")
+    args = parser.parse_args(argv[1:])
+
+    stats = statistics(args.files,args.latency / 1000.0)
+    multipackager.distro_objects["simulated"] = simulated
+
+    print("{:>7s} {:<14s} {:>9s} {:>9s} {:>9s} {:>7s} {:>7s} {:>7s} {:>9s}".format("targets","command","wall (s)","cpu (s)","sim. (s)","chroot","command","storage","fs (s)"))
+    for targets in [int(t) for t in args.targets.split(",")]:
+        run_matrix(targets,args.jobs)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
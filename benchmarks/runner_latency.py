@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Compares the time needed to launch a command inside a chroot environment with each runner,
+# and also inside a session. Must be run as root:
+#
+#     benchmarks/runner_latency.py /var/opt/multipackager/debian_chroot_sid_amd64 [iterations]
+
+import sys
+import os
+import time
+import gettext
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","src"))
+gettext.install("multipackager")
+
+import multipackager_module.configuration
+import multipackager_module.package_base
+import multipackager_module.runners
+
+
+def measure(distro,chroot_path,iterations):
+
+    times = []
+    for n in range(iterations):
+        start = time.monotonic()
+        if 0 != distro.run_chroot(chroot_path,"true"):
+            return None
+        times.append(time.monotonic() - start)
+    times.sort()
+    return times
+
+
+def main(argv):
+
+    if len(argv) < 2:
+        print("Usage: runner_latency.py chroot_path [iterations]")
+        return 1
+    if os.geteuid() != 0:
+        print("This benchmark must be run as root")
+        return 1
+
+    chroot_path = argv[1]
+    iterations = int(argv[2]) if len(argv) > 2 else 20
+
+    config = multipackager_module.configuration.configuration()
+    distro = multipackager_module.package_base.package_base(config,"","","amd64")
+    # don't print "Launching..." for each command
+    distro.run_external_program = lambda command,show_msg = True: multipackager_module.package_base.package_base.run_external_program(distro,command + " >/dev/null",False)
+
+    print("{:<20s} {:>10s} {:>10s} {:>10s}".format("runner","min (ms)","median","max"))
+    for runner in sorted(multipackager_module.runners.runners):
+        config.runner = runner
+        for session in [False, True]:
+            config.sessions = session
+            with distro.chroot_session(chroot_path):
+                times = measure(distro,chroot_path,iterations)
+            name = runner + (" (session)" if session else "")
+            if times == None:
+                print("{:<20s} failed".format(name))
+                continue
+            print("{:<20s} {:>10.1f} {:>10.1f} {:>10.1f}".format(name,times[0]*1000,times[len(times)//2]*1000,times[-1]*1000))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -23,11 +23,19 @@ import gettext
 import locale
 import configparser
 import fnmatch
+import atexit
+import threading
+import urllib.request
 import multipackager_module.debian
 import multipackager_module.fedora
 import multipackager_module.arch
 import multipackager_module.configuration
 import multipackager_module.package_base
+import multipackager_module.scheduler
+import multipackager_module.result_cache
+import multipackager_module.profiler
+import multipackager_module.tracer
+import multipackager_module.http_proxy
 
 import pkg_resources
 
@@ -41,23 +49,21 @@ gettext.install("multipackager","/usr/share/locale")
 
 _ = gettext.gettext
 
-version = str(pkg_resources.require("multipackager")[0].version)
-
 def print_usage(doexit = True):
 
-    global version
+    version = str(pkg_resources.require("multipackager")[0].version)
 
     print ("Multipackager")
     print ("Version {:s}".format(version))
     print ("Usage:")
-    print ("multipackager.py [--config config_file] [-r|--revision revision_number] [--noclean] project_folder")
-    print ("multipackager.py [--config config_file] [-r|--revision revision_number] [--noclean] project_folder {debian|ubuntu|fedora|arch} version_name {i386|amd64}")
+    print ("multipackager.py [--config config_file] [-r|--revision revision_number] [-j|--jobs N] [--cpus N] [--trace file] [--noclean] project_folder")
+    print ("multipackager.py [--config config_file] [-r|--revision revision_number] [-j|--jobs N] [--cpus N] [--trace file] [--noclean] project_folder {debian|ubuntu|fedora|arch} version_name {i386|amd64}")
     print ("multipackager.py [--config config_file] shell vm_folder {i386|amd64}")
     print ("multipackager.py [--config config_file] shell vm_folder {debian|ubuntu|fedora|arch} version_name {i386|amd64}")
-    print ("multipackager.py [--config config_file] update")
-    print ("multipackager.py [--config config_file] update {debian|ubuntu|fedora|arch}")
-    print ("multipackager.py [--config config_file] update {debian|ubuntu|fedora|arch} version_name")
-    print ("multipackager.py [--config config_file] update {debian|ubuntu|fedora|arch} version_name {i386|amd64}")
+    print ("multipackager.py [--config config_file] [-j|--jobs N] update")
+    print ("multipackager.py [--config config_file] [-j|--jobs N] update {debian|ubuntu|fedora|arch}")
+    print ("multipackager.py [--config config_file] [-j|--jobs N] update {debian|ubuntu|fedora|arch} version_name")
+    print ("multipackager.py [--config config_file] [-j|--jobs N] update {debian|ubuntu|fedora|arch} version_name {i386|amd64}")
     print ("multipackager.py [--config config_file] clearcache")
     print ("multipackager.py [--config config_file] clearcache {debian|ubuntu|fedora|arch} version_name {i386|amd64}")
 
@@ -65,22 +71,19 @@ def print_usage(doexit = True):
         sys.exit(-1)
 
 
-if (os.geteuid() != 0):
-    print_usage(False)
-    print(_("\nThis program must be run as root\n"))
-    sys.exit(-1)
+# classes that manage each distro type; other modules (like the benchmarks) can add new ones
+distro_objects = {
+    "debian" : multipackager_module.debian.debian,
+    "ubuntu" : multipackager_module.debian.debian,
+    "fedora" : multipackager_module.fedora.fedora,
+    "arch" : multipackager_module.arch.arch
+}
 
 
 def get_distro_object(distro_name):
 
-    if (distro_name == "debian") or (distro_name == "ubuntu"):
-        return multipackager_module.debian.debian
-
-    if (distro_name == "fedora"):
-        return multipackager_module.fedora.fedora
-
-    if (distro_name == "arch"):
-        return multipackager_module.arch.arch
+    if distro_name in distro_objects:
+        return distro_objects[distro_name]
 
     print(_("Distro name {:s} unknown. Aborting.").format(distro_name))
     sys.exit(-1)
@@ -109,6 +112,134 @@ def get_most_recent(filepath):
     return final_file
 
 
+# environment variables with the HTTP proxy, replaced while the caching proxy is running
+PROXY_VARIABLES = ["http_proxy", "HTTP_PROXY"]
+
+
+def start_proxy(config):
+
+    """ Starts the caching proxy for the repositories, if enabled, and makes all the package managers use it """
+
+    if not config.caching_proxy:
+        return None
+    upstream_proxies = urllib.request.getproxies()
+    upstream_proxies.pop("no",None)
+    proxy = multipackager_module.http_proxy.http_proxy(os.path.join(config.cache_path,"proxy"),config.proxy_cache_size * 1048576,upstream_proxies.get("http",None))
+    if proxy.start():
+        return None
+    # restored when the proxy is stopped
+    proxy.saved_environment = {name:os.environ.get(name,None) for name in PROXY_VARIABLES}
+    # for the downloads done in the host (debootstrap, yum...) and inside the containers
+    config.proxy_environment = {"http_proxy":proxy.get_url()}
+    config.upstream_proxies = upstream_proxies
+    for name in PROXY_VARIABLES:
+        os.environ[name] = proxy.get_url()
+    return proxy
+
+
+def stop_proxy(config,proxy):
+
+    if proxy == None:
+        return
+    config.proxy_environment = {}
+    config.upstream_proxies = None
+    for name,value in proxy.saved_environment.items():
+        if value == None:
+            os.environ.pop(name,None)
+        else:
+            os.environ[name] = value
+    proxy.stop()
+
+
+def build_target(config,distro,project_path,preinstall,dont_install,results,timer):
+
+    """ Builds the package for a single target. Returns the lists of built, skipped and failed packages """
+
+    built = []
+    skipped = []
+    failed = []
+
+    sys.stdout.write("\x1b]2;"+_("Compiling for {:s} {:s}, {:s}").format(distro.distro_type,distro.distro_name,distro.architecture)+"\x07")
+
+    package_name = timer.run(distro,"get_package_name",distro.get_package_name,project_path)
+
+    if (package_name == True):
+        failed.append(_("Can't get the package name for distro {:s}").format(distro.distro_full_name))
+        return built,skipped,failed
+
+    result_key = None
+    if results.enabled():
+        dependencies = timer.run(distro,"get_dependency_list",distro.get_dependency_list,project_path)
+        if dependencies == None:
+            failed.append(_("Can't get the dependencies for package {:s} in the distro {:s}").format(package_name,distro.distro_full_name))
+            return built,skipped,failed
+        result_key = results.get_key(distro,project_path,package_name,dependencies,preinstall.get(distro.distro_full_name,[]))
+        if results.restore(result_key,package_name,os.path.join(os.getcwd(),package_name)):
+            print(_("Package {:s} restored from the cache").format(package_name))
+            skipped.append(package_name)
+            return built,skipped,failed
+    elif (package_name != None) and (os.path.exists(os.path.join(os.getcwd(),package_name))):
+        skipped.append(package_name)
+        return built,skipped,failed
+
+    # copy the environment to a working folder
+    if timer.run(distro,"check_environment",distro.check_environment):
+        failed.append(_("Can't create working environment for package {:s} in distro {:s}").format(package_name,distro.distro_full_name))
+        return built,skipped,failed
+
+    # install the packages needed for building the project
+    if distro.distro_full_name in dont_install:
+        avoid_packages = dont_install[distro.distro_full_name]
+    else:
+        avoid_packages = []
+
+    if timer.run(distro,"install_dependencies",distro.install_dependencies,project_path,avoid_packages,preinstall):
+        failed.append(_("Can't install the dependencies for package {:s} in the distro {:s}").format(package_name,distro.distro_full_name))
+        return built,skipped,failed
+
+    if timer.run(distro,"prepare_working_path_overlay",distro.prepare_working_path_overlay):
+        failed.append(_("Can't prepare the working path inside the distro {:s} for package {:s}").format(distro.distro_full_name,package_name))
+        if config.clean:
+            distro.cleanup()
+        return built,skipped,failed
+
+    # all the commands in the working copy are launched inside a single container
+    with distro.chroot_session(distro.working_path):
+        had_error = False
+
+        if timer.run(distro,"install_postdependencies",distro.install_postdependencies,project_path):
+            had_error = True
+            failed.append(_("Can't install the dependencies for package {:s} in the distro {:s}").format(package_name,distro.distro_full_name))
+        elif distro.distro_full_name in preinstall:
+            for package in preinstall[distro.distro_full_name]:
+                print(_("Installing package {:s}").format(package))
+                if timer.run(distro,"install_local_package",distro.install_local_package,package):
+                    had_error = True
+                    failed.append(_("Can't install package {:s} in the distro {:s}").format(package,distro.distro_full_name))
+
+        # build the project itself
+        if (not had_error):
+            if timer.run(distro,"build_project",distro.build_project,project_path):
+                failed.append(_("Can't build the project {:s} in the distro {:s}").format(package_name,distro.distro_full_name))
+            else:
+                timer.run(distro,"get_project_size",distro.get_project_size)
+                # if there are no errors, create the package and copy it to the current directory
+                if timer.run(distro,"build_package",distro.build_package,project_path):
+                    failed.append(_("Can't build the package {:s} in the distro {:s}").format(package_name,distro.distro_full_name))
+                elif package_name != None:
+                    built.append(package_name)
+                    if result_key != None:
+                        # the key is calculated again because the caches could have been created during the build
+                        result_key = results.get_key(distro,project_path,package_name,distro.get_dependency_list(project_path),preinstall.get(distro.distro_full_name,[]))
+                        timer.run(distro,"store_result",results.store,result_key,package_name,os.path.join(os.getcwd(),package_name))
+
+    # remove temporary data
+    if config.clean:
+        timer.run(distro,"cleanup",distro.cleanup)
+
+    return built,skipped,failed
+
+
 def build_project(config,project_path):
 
     """ This function does all the work """
@@ -148,66 +279,53 @@ def build_project(config,project_path):
                 dont_install[element_i] = dont_install_p
 
 
+    results = multipackager_module.result_cache.result_cache(os.path.join(config.cache_path,"results"),config.result_cache_size * 1048576)
+    if results.enabled():
+        try:
+            os.makedirs(results.cache_path)
+        except:
+            pass
+
+    timer = multipackager_module.profiler.profiler()
+    if timer.load_hooks(config.hooks):
+        sys.exit(-1)
+
+    targets = multipackager_module.scheduler.scheduler(config.jobs)
+    distros = []
+
     for element in config.distros:
 
         if ((is_python) and (element["type"] == "binary")) or ((not is_python) and (element["type"] == "python")):
             continue
 
         distroclass = get_distro_object(element["distro"])
-        sys.stdout.write("\x1b]2;"+_("Compiling for {:s} {:s}, {:s}").format(element["distro"],element["name"],element["architecture"])+"\x07")
         # create a DISTRO object of the right type
         distro = distroclass(config,element["distro"],element["name"],element["architecture"],"builder")
-
-        package_name = distro.get_package_name(project_path)
-
-        if (package_name == True):
-            failed.append(_("Can't get the package name for distro {:s}").format(distro.distro_full_name))
-            continue
-        if (package_name != None) and (os.path.exists(os.path.join(os.getcwd(),package_name))):
-            skipped.append(package_name)
-            continue
-
-        # copy the environment to a working folder
-        if distro.check_environment():
-            failed.append(_("Can't create working environment for package {:s} in distro {:s}").format(package_name,distro.distro_full_name))
+        if config.jobs > 1:
+            # each target needs its own working copy when several are built at the same time
+            distro.workspace_name += "_{:d}".format(len(targets.tasks))
+        targets.add_task(build_target, (config,distro,project_path,preinstall,dont_install,results,timer), distro.get_lock_keys())
+        distros.append(distro)
+
+    # split the CPU budget between the targets that will be built at the same time
+    for distro in distros:
+        distro.cpus = max(1,config.cpus // targets.get_concurrency())
+
+    proxy = start_proxy(config)
+    try:
+        target_results = targets.run()
+    finally:
+        stop_proxy(config,proxy)
+
+    for distro,result in zip(distros,target_results):
+        if result == None:
+            failed.append(_("Unexpected error while building the package in the distro {:s}").format(distro.distro_full_name))
+            if config.clean:
+                distro.cleanup()
             continue
-
-        # install the packages needed for building the project
-        if distro.distro_full_name in dont_install:
-            avoid_packages = dont_install[distro.distro_full_name]
-        else:
-            avoid_packages = []
-
-        if (not distro.install_dependencies(project_path,avoid_packages,preinstall)):
-            if distro.prepare_working_path_overlay():
-                failed.append(_("Can't prepare the working path inside the distro {:s} for package {:s}").format(distro.distro_full_name,package_name))
-                if config.clean:
-                    distro.cleanup()
-                continue
-            had_error = False
-
-            if not distro.install_postdependencies(project_path):
-                if distro.distro_full_name in preinstall:
-                    for package in preinstall[distro.distro_full_name]:
-                        print(_("Installing package {:s}").format(package))
-                        if distro.install_local_package(package):
-                            had_error = True
-                            failed.append(_("Can't install package {:s} in the distro {:s}").format(package,distro.distro_full_name))
-                # build the project itself
-                if (not had_error) and (not distro.build_project(project_path)):
-                    distro.get_project_size()
-                    # if there are no errors, create the package and copy it to the current directory
-                    if distro.build_package(project_path):
-                        failed.append(_("Can't build the package {:s} in the distro {:s}").format(package_name,distro.distro_full_name))
-                        if config.clean:
-                            distro.cleanup()
-                        continue
-                    if package_name != None:
-                        built.append(package_name)
-
-        # remove temporary data
-        if config.clean:
-            distro.cleanup()
+        built += result[0]
+        skipped += result[1]
+        failed += result[2]
 
     if len(built) > 0:
         print(_("Built packages:"))
@@ -227,6 +345,7 @@ def build_project(config,project_path):
             print(l)
     else:
         print(_("Failed packages: none"))
+    timer.print_summary()
 
 
 def launch_shell(argv,config):
@@ -276,6 +395,45 @@ def launch_shell(argv,config):
     distro.run_chroot(env_path, command)
 
 
+def update_target(config,distro,timer,progress):
+
+    """ Updates the caches of a single target. Returns "changed" if any package was installed, removed or
+        upgraded (or if it can't be known), "current" if they were already up to date, or "failed" """
+
+    with progress["lock"]:
+        progress["started"] += 1
+        print(_("[{:d}/{:d}] Updating {:s}").format(progress["started"],progress["total"],distro.distro_full_name))
+        if config.jobs == 1:
+            sys.stdout.write("\x1b]2;"+_("Updating {:s} {:s}, {:s}").format(distro.distro_type,distro.distro_name,distro.architecture)+"\x07")
+
+    created = not os.path.exists(distro.base_cache_path)
+    if timer.run(distro,"check_environment",distro.check_environment):
+        result = "failed"
+    elif timer.run(distro,"update_environment",distro.update_environment):
+        result = "failed"
+    elif created or (distro.changed_packages != 0):
+        result = "changed"
+    else:
+        result = "current"
+
+    with progress["lock"]:
+        progress["done"] += 1
+        if result == "failed":
+            status = _("failed")
+        elif created:
+            status = _("created")
+        elif distro.changed_packages == None:
+            status = _("updated")
+        elif result == "changed":
+            status = _("{:d} packages changed").format(distro.changed_packages)
+        else:
+            status = _("already up to date")
+        print(_("[{:d}/{:d}] {:s}: {:s}").format(progress["done"],progress["total"],distro.distro_full_name,status))
+        if config.jobs > 1:
+            sys.stdout.write("\x1b]2;"+_("Updating: {:d} of {:d} done").format(progress["done"],progress["total"])+"\x07")
+    return result
+
+
 def update_envs(argv,config):
 
     nparams = len(argv)
@@ -287,12 +445,19 @@ def update_envs(argv,config):
     if (retval):
         sys.exit(-1)
 
-    param_distro = None if nparams < 3 else sys.argv[2]
-    param_name = None if nparams < 4 else sys.argv[3]
-    param_arch = None if nparams < 5 else sys.argv[4]
+    param_distro = None if nparams < 3 else argv[2]
+    param_name = None if nparams < 4 else argv[3]
+    param_arch = None if nparams < 5 else argv[4]
 
     updated = []
 
+    timer = multipackager_module.profiler.profiler()
+    if timer.load_hooks(config.hooks):
+        sys.exit(-1)
+
+    targets = multipackager_module.scheduler.scheduler(config.jobs)
+    distros = []
+
     for element in config.distros:
 
         if (param_distro is not None) and (param_distro != element["distro"]):
@@ -316,11 +481,52 @@ def update_envs(argv,config):
 
         # create a DISTRO object of the right type
         distro = distroclass(config,element["distro"],element["name"],element["architecture"],"builder")
-        if distro.check_environment():
-            continue
-        sys.stdout.write("\x1b]2;"+_("Updating {:s} {:s}, {:s}").format(element["distro"],element["name"],element["architecture"])+"\x07")
-        # update the packages in the cached environment
-        distro.update_environment()
+        distros.append(distro)
+
+    # each cache is updated by only one target at a time
+    progress = {"started":0, "done":0, "total":len(distros), "lock":threading.Lock()}
+    for distro in distros:
+        targets.add_task(update_target, (config,distro,timer,progress), distro.get_lock_keys())
+    # split the CPU budget between the targets that will be updated at the same time
+    for distro in distros:
+        distro.cpus = max(1,config.cpus // targets.get_concurrency())
+
+    proxy = start_proxy(config)
+    try:
+        target_results = targets.run()
+    finally:
+        stop_proxy(config,proxy)
+
+    changed = []
+    current = []
+    failed = []
+    for distro,result in zip(distros,target_results):
+        if result == "changed":
+            changed.append(distro.distro_full_name)
+        elif result == "current":
+            current.append(distro.distro_full_name)
+        else:
+            failed.append(distro.distro_full_name)
+
+    if len(changed) > 0:
+        print(_("Updated caches:"))
+        for l in changed:
+            print(l)
+    else:
+        print(_("Updated caches: none"))
+    if len(current) > 0:
+        print(_("Caches already up to date:"))
+        for l in current:
+            print(l)
+    else:
+        print(_("Caches already up to date: none"))
+    if len(failed) > 0:
+        print(_("Failed caches:"))
+        for l in failed:
+            print(l)
+    else:
+        print(_("Failed caches: none"))
+    timer.print_summary()
 
 
 def clearcache(argv,config):
@@ -337,9 +543,13 @@ def clearcache(argv,config):
     if (nparams == 5):
         retval = config.read_config_file()
         config.delete_distros()
-        config.append_distro(sys.argv[2], sys.argv[3] ,sys.argv[4])
+        config.append_distro(argv[2], argv[3] ,argv[4])
         retval = False
 
+    timer = multipackager_module.profiler.profiler()
+    if timer.load_hooks(config.hooks):
+        sys.exit(-1)
+
     for element in config.distros:
 
         distroclass = get_distro_object(element["distro"])
@@ -347,55 +557,70 @@ def clearcache(argv,config):
         # create a DISTRO object of the right type
         distro = distroclass(config,element["distro"],element["name"],element["architecture"],"builder")
         # update the packages in the cached environment
-        distro.clear_cache()
+        timer.run(distro,"clear_cache",distro.clear_cache)
 
 
-config = multipackager_module.configuration.configuration()
+def main(argv):
 
-args = config.parse_args(sys.argv)
-if args == None:
-    print_usage()
+    if (os.geteuid() != 0):
+        print_usage(False)
+        print(_("\nThis program must be run as root\n"))
+        sys.exit(-1)
 
-if (len(args) == 1) or (args[1] == "help") or (args[1] == "version"):
-    print_usage()
+    config = multipackager_module.configuration.configuration()
 
-if (args[1] == "shell"):
-    launch_shell(args,config)
-    sys.exit(0)
+    args = config.parse_args(argv)
+    if args == None:
+        print_usage()
 
-if (args[1] == "update"):
-    update_envs(args,config)
-    sys.exit(0)
+    if config.trace_file != None:
+        config.tracer = multipackager_module.tracer.tracer(config.trace_file)
+        atexit.register(config.tracer.write)
 
-if (args[1] == "clearcache"):
-    clearcache(args,config)
-    sys.exit(0)
+    if (len(args) == 1) or (args[1] == "help") or (args[1] == "version"):
+        print_usage()
 
-try:
-    os.makedirs(config.working_path)
-except:
-    pass
-try:
-    os.makedirs(config.cache_path)
-except:
-    pass
+    if (args[1] == "shell"):
+        launch_shell(args,config)
+        sys.exit(0)
 
-nparams = len(args)
+    if (args[1] == "update"):
+        update_envs(args,config)
+        sys.exit(0)
 
-if (nparams != 2) and (nparams != 5):
-    print_usage()
+    if (args[1] == "clearcache"):
+        clearcache(args,config)
+        sys.exit(0)
 
-project_folder = args[1]
-config.set_project_path(project_folder)
+    try:
+        os.makedirs(config.working_path)
+    except:
+        pass
+    try:
+        os.makedirs(config.cache_path)
+    except:
+        pass
 
-if config.read_config_file():
-    sys.exit(-1)
+    nparams = len(args)
+
+    if (nparams != 2) and (nparams != 5):
+        print_usage()
+
+    project_folder = args[1]
+    config.set_project_path(project_folder)
+
+    if config.read_config_file():
+        sys.exit(-1)
+
+    if (nparams == 5):
+        # read all the configuration to set all the parameters
+        retval = config.read_config_file()
+        config.delete_distros()
+        config.append_distro(args[2], args[3] ,args[4])
+        retval = False
+
+    build_project(config,project_folder)
 
-if (nparams == 5):
-    # read all the configuration to set all the parameters
-    retval = config.read_config_file()
-    config.delete_distros()
-    config.append_distro(args[2], args[3] ,args[4])
-    retval = False
 
-build_project(config,project_folder)
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import re
+import mmap
+import functools
+import threading
+
+# a relationship in a control file, like 'libglib2.0-dev:any (>= 2.40) [linux-any] <!nocheck>'
+RELATION_RE = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9+.\-]*)(?::[A-Za-z0-9\-]+)?\s*(?:\(\s*(<<|<=|>=|>>|=|<|>)\s*([^)\s]+)\s*\))?")
+
+# the fields needed from the Packages files; the rest are never copied out of the mapped files
+FIELDS_RE = re.compile(rb"^(Package|Version|Provides|Architecture|SHA256): *([^\n]*)$", re.M)
+
+
+def parse_relation(text):
+
+    """ Returns the name, the operator and the version of a relationship, or None if it can't be parsed.
+        The architecture qualifiers and restrictions are discarded """
+
+    match = RELATION_RE.match(text)
+    if match == None:
+        return None
+    return match.group(1),match.group(2),match.group(3)
+
+
+def get_relation_name(text):
+
+    """ Returns the package name of a relationship, or the text itself if it can't be parsed """
+
+    relation = parse_relation(text)
+    if relation == None:
+        return text.strip()
+    return relation[0]
+
+
+def format_relation(name,operator,version):
+
+    if operator == None:
+        return name
+    return "{:s} ({:s} {:s})".format(name,operator,version)
+
+
+def order(character):
+
+    if character == "":
+        return 0
+    if character == "~":
+        return -1
+    if character.isdigit():
+        return 0
+    if character.isalpha():
+        return ord(character)
+    return ord(character) + 256
+
+
+def compare_fragment(a,b):
+
+    """ Compares the upstream version or the revision, like dpkg does """
+
+    i = 0
+    j = 0
+    while (i < len(a)) or (j < len(b)):
+        first_diff = 0
+        while ((i < len(a)) and (not a[i].isdigit())) or ((j < len(b)) and (not b[j].isdigit())):
+            ac = order(a[i] if i < len(a) else "")
+            bc = order(b[j] if j < len(b) else "")
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while (i < len(a)) and (a[i] == "0"):
+            i += 1
+        while (j < len(b)) and (b[j] == "0"):
+            j += 1
+        while (i < len(a)) and a[i].isdigit() and (j < len(b)) and b[j].isdigit():
+            if first_diff == 0:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if (i < len(a)) and a[i].isdigit():
+            return 1
+        if (j < len(b)) and b[j].isdigit():
+            return -1
+        if first_diff != 0:
+            return first_diff
+    return 0
+
+
+def split_version(version):
+
+    epoch = 0
+    pos = version.find(":")
+    if pos != -1:
+        try:
+            epoch = int(version[:pos])
+        except ValueError:
+            pass
+        version = version[pos+1:]
+    pos = version.rfind("-")
+    if pos != -1:
+        return epoch,version[:pos],version[pos+1:]
+    return epoch,version,""
+
+
+def compare_versions(a,b):
+
+    """ Returns a negative number, zero or a positive number if the version a is lower, equal or greater than b """
+
+    epoch_a,upstream_a,revision_a = split_version(a)
+    epoch_b,upstream_b,revision_b = split_version(b)
+    if epoch_a != epoch_b:
+        return epoch_a - epoch_b
+    retval = compare_fragment(upstream_a,upstream_b)
+    if retval != 0:
+        return retval
+    return compare_fragment(revision_a,revision_b)
+
+
+def satisfies(version,operator,required):
+
+    if operator == None:
+        return True
+    if version == None:
+        return False
+    retval = compare_versions(version,required)
+    if operator == "<<":
+        return retval < 0
+    if (operator == "<=") or (operator == "<"):
+        return retval <= 0
+    if operator == "=":
+        return retval == 0
+    if (operator == ">=") or (operator == ">"):
+        return retval >= 0
+    return retval > 0
+
+
+class packages_index(object):
+
+    """ Versions and provides of the packages available in the repositories of a CHROOT environment, read
+        from the Packages files downloaded by 'apt update' """
+
+    def __init__(self):
+
+        self.versions = {} # versions available of each package
+        self.provides = {} # packages that provide each virtual name, and the version provided
+        self.archives = {} # name that apt gives to each package file in its cache, indexed by its sha256
+        self.files = 0
+
+
+    def read_file(self,path):
+
+        f = open(path,"rb")
+        try:
+            data = mmap.mmap(f.fileno(),0,access = mmap.ACCESS_READ)
+        except ValueError:
+            f.close()
+            return # empty file
+        package = None
+        stanza = {}
+        for match in FIELDS_RE.finditer(data):
+            field = match.group(1)
+            value = match.group(2).decode("utf-8","replace").strip()
+            if field == b"Package":
+                self.add_archive(package,stanza)
+                package = value
+                stanza = {}
+                if package not in self.versions:
+                    self.versions[package] = []
+            elif package == None:
+                continue
+            elif field == b"Version":
+                self.versions[package].append(value)
+                stanza[field] = value
+            elif field != b"Provides":
+                stanza[field] = value
+            else:
+                for virtual in value.split(","):
+                    relation = parse_relation(virtual)
+                    if relation == None:
+                        continue
+                    if relation[0] not in self.provides:
+                        self.provides[relation[0]] = []
+                    self.provides[relation[0]].append((package,relation[2] if relation[1] == "=" else None))
+        self.add_archive(package,stanza)
+        data.close()
+        f.close()
+        self.files += 1
+
+
+    def add_archive(self,package,stanza):
+
+        if (package == None) or (b"SHA256" not in stanza) or (b"Version" not in stanza) or (b"Architecture" not in stanza):
+            return
+        # like apt does, with the ':' of the epoch quoted
+        self.archives[stanza[b"SHA256"]] = "{:s}_{:s}_{:s}.deb".format(package,stanza[b"Version"].replace(":","%3a"),stanza[b"Architecture"])
+
+
+    def get_version(self,name):
+
+        """ Returns the newest version available of a package, or None if it isn't available """
+
+        if (name not in self.versions) or (len(self.versions[name]) == 0):
+            return None
+        return max(self.versions[name], key = functools.cmp_to_key(compare_versions))
+
+
+    def find(self,name,operator,version):
+
+        """ Returns what must be passed to apt to install a package that satisfies the relationship
+            (the name, the name with the version, or the name of a package that provides it), or None """
+
+        if name in self.versions:
+            valid = [v for v in self.versions[name] if satisfies(v,operator,version)]
+            if len(valid) != 0:
+                best = max(valid, key = functools.cmp_to_key(compare_versions))
+                newest = max(self.versions[name], key = functools.cmp_to_key(compare_versions))
+                if compare_versions(best,newest) == 0:
+                    return name
+                return "{:s}={:s}".format(name,best) # apt would choose a version not valid
+        for provider,provided_version in self.provides.get(name,[]):
+            if (operator == None) or satisfies(provided_version,operator,version):
+                return provider
+        return None
+
+
+# indexes already read, with the size and modification time of the files used
+indexes = {}
+indexes_lock = threading.Lock()
+
+
+def get_index(path):
+
+    """ Returns the packages_index of the CHROOT environment at path, or None if there are no Packages files.
+        The files are read again only when apt has changed them """
+
+    lists_path = os.path.join(path,"var","lib","apt","lists")
+    if not os.path.exists(lists_path):
+        return None
+    files = []
+    for filename in sorted(os.listdir(lists_path)):
+        if filename.endswith("_Packages"):
+            status = os.stat(os.path.join(lists_path,filename))
+            files.append((filename,status.st_size,status.st_mtime_ns))
+    if len(files) == 0:
+        return None
+    signature = tuple(files)
+
+    with indexes_lock:
+        if (lists_path in indexes) and (indexes[lists_path][0] == signature):
+            return indexes[lists_path][1]
+    index = packages_index()
+    try:
+        for filename,size,mtime in files:
+            index.read_file(os.path.join(lists_path,filename))
+    except OSError:
+        return None
+    with indexes_lock:
+        indexes[lists_path] = (signature,index)
+    return index
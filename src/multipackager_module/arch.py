@@ -21,7 +21,12 @@
 import os
 import shutil
 import configparser
+import hashlib
+import concurrent.futures
 import multipackager_module.package_base
+import multipackager_module.aur_cache
+import multipackager_module.bootstrap_cache
+import multipackager_module.package_database
 
 class arch (multipackager_module.package_base.package_base):
 
@@ -29,6 +34,12 @@ class arch (multipackager_module.package_base.package_base):
 
         multipackager_module.package_base.package_base.__init__(self, configuration, distro_type, distro_name, architecture, cache_name)
         self.install_at_lib = True
+        # the AUR snapshots are considered up to date for the same time than the package metadata
+        self.aur_cache = multipackager_module.aur_cache.aur_cache(os.path.join(self.configuration.cache_path,"aur"),self.configuration.metadata_ttl * 60,self.trace_command)
+        # bootstrap tarballs, kept to create again the environments without downloading them
+        self.bootstrap_cache = multipackager_module.bootstrap_cache.bootstrap_cache(os.path.join(self.configuration.cache_path,"bootstrap"),self.trace_command)
+        # packages built from AUR, for each generation of the environment
+        self.aur_packages_path = os.path.join(self.configuration.cache_path,"aur_packages",self.base_chroot_name)
 
 
     def set_project_version(self,text):
@@ -69,64 +80,46 @@ class arch (multipackager_module.package_base.package_base):
         # Create all, first, in a temporal folder
         tmp_path = path+".tmp"
 
-        shutil.rmtree(tmp_path, ignore_errors=True)
+        self.storage.delete(tmp_path)
 
-        os.makedirs(tmp_path)
+        self.storage.create_folder(tmp_path)
         server = self.configuration.arch_mirror
 
         if (server[-1] == '/'):
             server = server[:-1]
 
         filename = "archlinux-bootstrap-{:s}-{:s}.tar.gz".format(self.distro_name,"i686" if self.architecture=="i386" else "x86_64")
-        output_filename = os.path.join(self.configuration.cache_path,filename)
-
-        try:
-            os.remove(output_filename)
-        except:
-            pass
-
-        command = "wget {:s}/iso/{:s}/{:s} -O {:s}".format(server,self.distro_name,filename,output_filename)
+        url = "{:s}/iso/{:s}/{:s}".format(server,self.distro_name,filename)
 
-        if (0 != self.run_external_program(command)):
+        # extract it directly inside the new environment while it is downloaded, removing the "root.ARCH" folder in the tarball
+        if self.bootstrap_cache.extract(url,tmp_path,1,self.configuration.upstream_proxies):
             return True # error!!!
 
-        final_filename = os.path.join(self.configuration.cache_path , "root." + ("i686" if self.architecture == "i386" else "x86_64"))
-        shutil.rmtree(final_filename, ignore_errors=True)
-
-        command = 'bash -c "cd {:s} && tar xf {:s}"'.format(self.configuration.cache_path,filename)
-        if (0 != self.run_external_program(command)):
-            return True # error!!!
-
-        try:
-            os.remove(output_filename)
-        except:
-            pass
-
-        os.rename(final_filename,tmp_path)
-
         mirrors = open(os.path.join(tmp_path,"etc","pacman.d","mirrorlist"),"w")
         mirrors.write("Server = {:s}/$repo/os/$arch\n".format(server))
         mirrors.close()
 
-        command = "pacman-key --init"
-        if (0 != self.run_chroot(tmp_path,command)):
-            return True # error!!!
+        with self.chroot_session(tmp_path):
+            command = "pacman-key --init"
+            if (0 != self.run_chroot(tmp_path,command)):
+                return True # error!!!
 
-        command = "pacman-key --populate archlinux"
-        if (0 != self.run_chroot(tmp_path,command)):
-            return True # error!!!
+            command = "pacman-key --populate archlinux"
+            if (0 != self.run_chroot(tmp_path,command)):
+                return True # error!!!
 
-        command = "pacman -r / -Syu --noconfirm base"
-        if (0 != self.run_chroot(tmp_path,command)):
-            return True # error!!!
+            command = "pacman -r / -Syu --noconfirm base"
+            if (0 != self.run_chroot(tmp_path,command)):
+                return True # error!!!
+            self.mark_metadata_refreshed(tmp_path)
 
-        command = "useradd multipackager -m -b /"
-        if (0 != self.run_chroot(tmp_path,command)):
-            return True # error!!!
+            command = "useradd multipackager -m -b /"
+            if (0 != self.run_chroot(tmp_path,command)):
+                return True # error!!!
 
-        command = "pacman -S --noconfirm fakeroot make gcc patch cmake autoconf automake meson ninja"
-        if (0 != self.run_chroot(tmp_path,command)):
-            return True # error!!!
+            command = "pacman -S --noconfirm fakeroot make gcc patch cmake autoconf automake meson ninja"
+            if (0 != self.run_chroot(tmp_path,command)):
+                return True # error!!!
 
         os.sync()
         os.rename(tmp_path,path) # rename the folder to the definitive name
@@ -137,6 +130,135 @@ class arch (multipackager_module.package_base.package_base):
         return False # no error
 
 
+    def get_package_cache_folder(self):
+
+        return "/var/cache/pacman/pkg"
+
+
+    def get_repository_checksums(self,path):
+
+        # read each time, because the databases change when refreshing them, but not the cache generation
+        database = multipackager_module.package_database.read_pacman_sync(path)
+        if database == None:
+            return None
+        return database.files
+
+
+    def get_package_database_type(self):
+
+        return "pacman"
+
+
+    def get_database_generation(self,path,folder):
+
+        """ Returns the generation of a pacman database in the CHROOT environment at path. The working copies
+            change without bumping the cache generation, so the modification time of the database is added """
+
+        try:
+            mtime = os.stat(os.path.join(path,"var","lib","pacman",folder)).st_mtime_ns
+        except OSError:
+            mtime = 0
+        return (self.get_cache_generation(),mtime)
+
+
+    def get_installed_packages(self,path = None):
+
+        """ Returns the package_database with the packages installed in path (by default, base_path) """
+
+        if path == None:
+            path = self.base_path
+        return multipackager_module.package_database.get_database(path,"pacman",self.get_database_generation(path,"local"),self.read_local_database)
+
+
+    def get_dependency_version(self,installed,name):
+
+        version = multipackager_module.package_base.package_base.get_dependency_version(self,installed,name)
+        if version != None:
+            return version
+        available = self.get_available_packages()
+        if (available != None) and (available.get_version(name) != None):
+            return available.get_version(name)
+        # an AUR package is identified by its snapshot
+        snapshot_path = self.aur_cache.get_snapshot(name)
+        if snapshot_path == None:
+            return None
+        return "aur:"+os.path.basename(snapshot_path)
+
+
+    def get_available_packages(self,path = None):
+
+        """ Returns the package_database with the packages in the official repositories, as seen from path
+            (by default, base_path) """
+
+        if path == None:
+            path = self.base_path
+        return multipackager_module.package_database.get_database(path,"pacman_sync",self.get_database_generation(path,"sync"),self.read_sync_databases)
+
+
+    def read_local_database(self,path):
+
+        database = multipackager_module.package_database.read_pacman(path)
+        if database != None:
+            return database
+        # ask pacman, but for all the packages at once
+        lines = self.query_pacman(path,"-Q")
+        if lines == None:
+            return None
+        database = multipackager_module.package_database.package_database()
+        for line in lines:
+            fields = line.split()
+            if len(fields) == 2:
+                database.add(fields[0],fields[1],[])
+        return database
+
+
+    def read_sync_databases(self,path):
+
+        database = multipackager_module.package_database.read_pacman_sync(path)
+        if database != None:
+            return database
+        lines = self.query_pacman(path,"-Sl")
+        if lines == None:
+            return None
+        database = multipackager_module.package_database.package_database()
+        for line in lines:
+            fields = line.split()
+            if len(fields) >= 3:
+                database.add(fields[1],fields[2],[])
+        return database
+
+
+    def query_pacman(self,path,arguments):
+
+        """ Runs pacman inside the CHROOT environment and returns its output, as a list of lines """
+
+        output_path = os.path.join(path,"tmp","multipackager_pacman_query")
+        try:
+            if 0 != self.run_chroot(path,'bash -c "pacman {:s} > /tmp/multipackager_pacman_query"'.format(arguments)):
+                return None
+            f = open(output_path,"r",encoding = "utf-8",errors = "replace")
+            lines = f.read().split("\n")
+            f.close()
+        finally:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+        return lines
+
+
+    def update_environment(self):
+
+        # the AUR packages are downloaded again after updating, like the package metadata, and built again
+        self.aur_cache.invalidate()
+        self.clear_built_aur_packages()
+        return multipackager_module.package_base.package_base.update_environment(self)
+
+
+    def clear_cache(self):
+
+        multipackager_module.package_base.package_base.clear_cache(self)
+        self.clear_built_aur_packages()
+
+
     @multipackager_module.package_base.call_with_cache
     def update(self,path):
 
@@ -144,16 +266,20 @@ class arch (multipackager_module.package_base.package_base):
 
         # Here, we have for sure the CHROOT environment, but maybe it must be updated
 
-        retval = self.run_chroot(path,"pacman -Syu --noconfirm")
+        # the metadata is refreshed first, so the packages already in the pool are linked before upgrading;
+        # if the upgrade fails, the overlay is discarded, so there is never a partial upgrade
+        retval = self.refresh_metadata(path,"pacman -Sy --noconfirm",True)
         if (retval != 0):
             return True # error!!!!
+        if (0 != self.run_chroot(path,"pacman -Su --noconfirm")):
+            return True # error!!!!
 
         return False
 
 
-    @multipackager_module.package_base.call_with_cache
     def install_dependencies_full(self,path,dependencies):
 
+        self.link_pooled_packages(path)
         command = "pacman --noconfirm -S"
         for dep in dependencies:
             command += " "+dep
@@ -217,57 +343,72 @@ class arch (multipackager_module.package_base.package_base):
     def check_dependencies(self,tmp_path,dependencies,main_dependencies,aur_dependencies):
 
         new_dependencies = []
-
+        installed = self.get_installed_packages()
+        available = self.get_available_packages()
+        if (installed == None) or (available == None):
+            print(_("Can't read the package databases of {:s}").format(self.chroot_name))
+            return None
+
+        # first, the dependencies in the official repositories
+        aur_candidates = []
         for dep in dependencies:
             if (dep == "sh"):
                 dep = "bash"
-            command = "pacman -Q {:s}".format(dep)
-            if not self.run_chroot(self.base_path, command):
+            if installed.contains(dep):
                 continue # this package is already installed
-            command = "pacman -Si {:s}".format(dep)
-            if not self.run_chroot(self.base_path, command):
+            if available.contains(dep):
                 if main_dependencies.count(dep) == 0:
                     main_dependencies.append(dep) # the package is available in the oficial repository
-            else:
-                package_dir = os.path.join(tmp_path,dep)
-                pkgbuild_path = os.path.join(tmp_path,"{:s}.tar.gz".format(dep))
-                command = "wget https://aur.archlinux.org/packages/{:s}/{:s}/{:s}.tar.gz -O {:s}".format(dep[:2],dep,dep,pkgbuild_path)
-                if 0 != self.run_external_program(command):
-                    command = "wget https://aur.archlinux.org/cgit/aur.git/snapshot/{:s}.tar.gz -O {:s}".format(dep,pkgbuild_path)
-                    if 0 != self.run_external_program(command):
-                        if dep[:7] != 'python2':
-                            print(_("The package {:s} is not available in the official repositories, neither in the AUR repositories.").format(dep))
-                            return None
-                        # If it is a python2 package, and doesn't exists, try without the "2"
-                        dep2 = 'python'+dep[7:]
-                        pkgbuild_path = os.path.join(tmp_path,"{:s}.tar.gz".format(dep2))
-                        package_dir = os.path.join(tmp_path,dep2)
-                        command = "wget https://aur.archlinux.org/packages/{:s}/{:s}/{:s}.tar.gz -O {:s}".format(dep[:2],dep2,dep2,pkgbuild_path)
-                        if 0 != self.run_external_program(command):
-                            command = "wget https://aur.archlinux.org/cgit/aur.git/snapshot/{:s}.tar.gz -O {:s}".format(dep2,pkgbuild_path)
-                            if 0 != self.run_external_program(command):
-                                print(_("The package {:s} is not available in the official repositories, neither in the AUR repositories.").format(dep))
-                                return None
-                        dep = dep2
-                command = 'bash -c "cd {:s} && tar xf {:s}.tar.gz"'.format(tmp_path,dep)
-                if 0 != self.run_external_program(command):
-                    print(_("The package {:s} could not be uncompressed.").format(dep))
-                    return None
-                pkgbuild_path = os.path.join(package_dir,"PKGBUILD")
-                aur_dependencies.insert(0,dep) # the package is available in the AUR repository
-                tmpdeps = self.read_deps(pkgbuild_path, False)
-                for dep2 in tmpdeps:
-                    if (0 != aur_dependencies.count(dep2)):
-                        aur_dependencies.remove(dep2)
-                        aur_dependencies.insert(0,dep2) # move it to the start
-                    elif (0 != dependencies.count(dep2)):
-                        continue # will be checked in this loop, so there is no need of pass it again to the next loop
-                    elif (0 == main_dependencies.count(dep2)) and (0 == new_dependencies.count(dep2)):
-                        new_dependencies.append(dep2)
+            elif aur_candidates.count(dep) == 0:
+                aur_candidates.append(dep)
+
+        # and then the ones in AUR, all downloaded at the same time
+        snapshots = self.get_aur_snapshots(aur_candidates)
+        for dep in aur_candidates:
+            if snapshots[dep] == None:
+                print(_("The package {:s} is not available in the official repositories, neither in the AUR repositories.").format(dep))
+                return None
+            dep,snapshot_path = snapshots[dep]
+            if self.aur_cache.extract(snapshot_path,tmp_path):
+                print(_("The package {:s} could not be uncompressed.").format(dep))
+                return None
+            pkgbuild_path = os.path.join(tmp_path,dep,"PKGBUILD")
+            aur_dependencies.insert(0,dep) # the package is available in the AUR repository
+            tmpdeps = self.read_deps(pkgbuild_path, False)
+            for dep2 in tmpdeps:
+                if (0 != aur_dependencies.count(dep2)):
+                    aur_dependencies.remove(dep2)
+                    aur_dependencies.insert(0,dep2) # move it to the start
+                elif (0 != dependencies.count(dep2)):
+                    continue # will be checked in this loop, so there is no need of pass it again to the next loop
+                elif (0 == main_dependencies.count(dep2)) and (0 == new_dependencies.count(dep2)):
+                    new_dependencies.append(dep2)
 
         return new_dependencies
 
 
+    def get_aur_snapshot(self,dep):
+
+        snapshot_path = self.aur_cache.get_snapshot(dep)
+        if (snapshot_path == None) and (dep[:7] == 'python2'):
+            # If it is a python2 package, and doesn't exists, try without the "2"
+            dep = 'python'+dep[7:]
+            snapshot_path = self.aur_cache.get_snapshot(dep)
+        if snapshot_path == None:
+            return None
+        return dep,snapshot_path
+
+
+    def get_aur_snapshots(self,dependencies):
+
+        """ Returns, for each dependency, the name of the AUR package and the path of its snapshot, or None if it isn't in AUR """
+
+        if len(dependencies) == 0:
+            return {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers = min(8,len(dependencies))) as executor:
+            return dict(zip(dependencies,executor.map(self.get_aur_snapshot,dependencies)))
+
+
     def install_packages(self,package_list):
 
         main_dependencies = []
@@ -277,6 +418,7 @@ class arch (multipackager_module.package_base.package_base):
         shutil.rmtree(tmp_path, ignore_errors=True)
         os.makedirs(tmp_path)
 
+        # the package databases are read from outside, so no container is needed here
         while (len(package_list) != 0):
             package_list = self.check_dependencies(tmp_path, package_list, main_dependencies, self.aur_dependencies)
             if package_list == None:
@@ -284,12 +426,114 @@ class arch (multipackager_module.package_base.package_base):
 
         # Install first the dependencies from the main repository
         if (len(main_dependencies) != 0):
-            if self.install_dependencies_full(self.base_path,main_dependencies):
+            if self.install_dependencies_layer(main_dependencies):
                 return True
 
         return False
 
 
+    def get_aur_package_key(self,package_path):
+
+        """ Returns a hash of the files of an AUR package, before building it, and of the environment where it is built """
+
+        hasher = hashlib.sha256()
+        hasher.update("{:s}\0{:d}\0".format(self.distro_full_name,self.get_cache_generation()).encode("utf-8"))
+        for dirname, dirnames, filenames in os.walk(package_path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                fullpath = os.path.join(dirname,filename)
+                hasher.update("{:s}\0".format(os.path.relpath(fullpath,package_path)).encode("utf-8","surrogateescape"))
+                if os.path.islink(fullpath):
+                    hasher.update(os.readlink(fullpath).encode("utf-8","surrogateescape"))
+                else:
+                    f = open(fullpath,"rb")
+                    while True:
+                        data = f.read(1048576)
+                        if len(data) == 0:
+                            break
+                        hasher.update(data)
+                    f.close()
+                hasher.update(b"\0")
+        return hasher.hexdigest()
+
+
+    def get_aur_packages_path(self):
+
+        return os.path.join(self.aur_packages_path,"{:d}".format(self.get_cache_generation()))
+
+
+    def get_built_aur_packages(self,key):
+
+        """ Returns the paths of the packages built before from the same AUR package, or None if there aren't """
+
+        package_path = os.path.join(self.get_aur_packages_path(),key)
+        if not os.path.exists(package_path):
+            return None
+        os.utime(package_path) # mark it as recently used
+        return [os.path.join(package_path,f) for f in sorted(os.listdir(package_path))]
+
+
+    def store_built_aur_packages(self,key,files):
+
+        generation_path = self.get_aur_packages_path()
+        package_path = os.path.join(generation_path,key)
+        tmp_path = package_path+".{:d}.tmp".format(os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for f in files:
+            shutil.copy2(f,tmp_path)
+        try:
+            os.rename(tmp_path,package_path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True) # already stored by another target
+        # the packages built for older generations of the environment can't be used anymore
+        for generation in os.listdir(self.aur_packages_path):
+            if os.path.join(self.aur_packages_path,generation) != generation_path:
+                shutil.rmtree(os.path.join(self.aur_packages_path,generation), ignore_errors=True)
+
+
+    def clear_built_aur_packages(self):
+
+        shutil.rmtree(self.aur_packages_path, ignore_errors=True)
+
+
+    def get_built_package_files(self,fullpath):
+
+        return [f for f in sorted(os.listdir(fullpath)) if (f.find(".pkg.tar") != -1) and (not f.endswith(".sig"))]
+
+
+    def make_AUR_package(self,path,root_path,cpus = None):
+
+        """ Builds the AUR package at path inside the CHROOT environment at root_path, using cpus CPUs (by default,
+            all the budget of the target), or gets it from the cache. Returns the names of the package files created
+            in its folder, or None if there was an error """
+
+        fullpath = os.path.join(root_path,path)
+
+        # calculated before building, because makepkg downloads the sources inside the same folder
+        key = self.get_aur_package_key(fullpath)
+        built_packages = self.get_built_aur_packages(key)
+        if built_packages != None:
+            print(_("Using the cached build of {:s}").format(path))
+            for f in built_packages:
+                shutil.copy2(f,fullpath)
+        else:
+            os.chmod(fullpath, 511) # 777 permissions
+
+            command = 'bash -c "mkdir -p ~/.gnupg && echo -e \\"keyserver hkp://keys.gnupg.net\nkeyserver-options auto-key-retrieve\\" > ~/.gnupg/gpg.conf && cd {:s} && makepkg"'.format(path)
+            if self.run_chroot(root_path, command, "multipackager", self.get_build_environment(cpus)):
+                return None
+            built_packages = [os.path.join(fullpath,f) for f in self.get_built_package_files(fullpath)]
+            if len(built_packages) != 0:
+                self.store_built_aur_packages(key,built_packages)
+
+        files = self.get_built_package_files(fullpath)
+        if len(files) == 0:
+            print(_("Unable to install the created package for {:s}").format(path))
+            return None
+        return files
+
+
     def build_AUR_package(self,path):
 
         fullpath = os.path.join(self.working_path,path)
@@ -298,29 +542,92 @@ class arch (multipackager_module.package_base.package_base):
         if not os.path.exists(pkgfullpath):
             return False
 
-        os.chmod(fullpath, 511) # 777 permissions
+        files = self.make_AUR_package(path,self.working_path)
+        if files == None:
+            return True
+        command = 'pacman --noconfirm -U {:s}'.format(os.path.join(path,files[0]))
+        return self.run_chroot(self.working_path, command)
 
 
-        command = 'bash -c "mkdir -p ~/.gnupg && echo -e \\"keyserver hkp://keys.gnupg.net\nkeyserver-options auto-key-retrieve\\" > ~/.gnupg/gpg.conf && cd {:s} && makepkg"'.format(path)
-        if self.run_chroot(self.working_path, command, "multipackager"):
-            return True
+    def build_AUR_package_in_overlay(self,path,cpus):
 
-        for file in os.listdir(fullpath):
-            if (file[-11:]==".pkg.tar.xz"):
-                command = 'pacman --noconfirm -U {:s}'.format(os.path.join(path,file))
-                return self.run_chroot(self.working_path, command)
-        print(_("Unable to install the created package for {:s}").format(path))
-        return True
+        """ Builds an AUR package in its own overlay over the working copy, so several packages can be built at
+            the same time, each one with its share of the CPU budget. The package files are copied into the working
+            copy. Returns their names, or None if there was an error """
+
+        if not os.path.exists(os.path.join(self.working_path,path,"PKGBUILD")):
+            return []
+
+        mount_path = self.working_path+".aur_"+os.path.basename(path)
+        upper_path = mount_path+".upper"
+        work_path = mount_path+".work"
+        if self.discard_overlay(mount_path,upper_path,work_path):
+            return None
+        os.makedirs(mount_path)
+        os.makedirs(upper_path)
+        os.makedirs(work_path)
+        if (0 != self.run_external_program('mount -t overlay -o rw,lowerdir="{:s}",upperdir="{:s}",workdir="{:s}" overlay "{:s}"'.format(self.working_path,upper_path,work_path,mount_path))):
+            self.discard_overlay(mount_path,upper_path,work_path)
+            return None
+
+        try:
+            files = self.make_AUR_package(path,mount_path,cpus)
+            if files != None:
+                for f in files:
+                    shutil.copy2(os.path.join(mount_path,path,f),os.path.join(self.working_path,path))
+        finally:
+            self.discard_overlay(mount_path,upper_path,work_path)
+        return files
+
+
+    def get_AUR_build_levels(self):
+
+        """ Groups the AUR dependencies in levels, where each package depends only on packages of the previous
+            levels, based on the depends and makedepends of their PKGBUILDs """
+
+        pending = {}
+        for name in self.aur_dependencies:
+            pkgbuild_path = os.path.join(self.working_path,"built_tmp_packages",name,"PKGBUILD")
+            dependencies = self.read_deps(pkgbuild_path,False) if os.path.exists(pkgbuild_path) else []
+            pending[name] = [dep for dep in dependencies if (dep != name) and (self.aur_dependencies.count(dep) != 0)]
+
+        levels = []
+        while len(pending) != 0:
+            level = [name for name in self.aur_dependencies if (name in pending) and all((dep not in pending) for dep in pending[name])]
+            if len(level) == 0:
+                # circular dependencies; build the remaining ones one by one, in the order they were found
+                levels += [[name] for name in self.aur_dependencies if name in pending]
+                break
+            levels.append(level)
+            for name in level:
+                del pending[name]
+        return levels
 
 
     def install_postdependencies(self,project_path):
 
         print("Aur: "+str(self.aur_dependencies))
-        tmp_path = os.path.join(self.working_path,"built_tmp_packages")
-        for paths in self.aur_dependencies:
-            full_path = os.path.join("built_tmp_packages",paths)
-            if self.build_AUR_package(full_path):
-                print (_("Failed to build package {:s}. Aborting").format(paths))
+        for level in self.get_AUR_build_levels():
+            if len(level) == 1:
+                if self.build_AUR_package(os.path.join("built_tmp_packages",level[0])):
+                    print (_("Failed to build package {:s}. Aborting").format(level[0]))
+                    return True
+                continue
+
+            # the packages of a level don't depend on each other, so they are built at the same time, splitting the CPU budget
+            workers = min(len(level),self.cpus)
+            cpus = max(1,self.cpus // workers)
+            with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+                results = list(executor.map(self.build_AUR_package_in_overlay,[os.path.join("built_tmp_packages",name) for name in level],[cpus] * len(level)))
+            packages = []
+            for name,files in zip(level,results):
+                if files == None:
+                    print (_("Failed to build package {:s}. Aborting").format(name))
+                    return True
+                if len(files) != 0:
+                    packages.append(os.path.join("built_tmp_packages",name,files[0]))
+            if (len(packages) != 0) and self.run_chroot(self.working_path, "pacman --noconfirm -U {:s}".format(" ".join(packages))):
+                print (_("Failed to install the packages {:s}").format(", ".join(level)))
                 return True
         return False
 
@@ -359,11 +666,7 @@ class arch (multipackager_module.package_base.package_base):
         return False
 
 
-    def install_dependencies(self,project_path,avoid_packages,preinstall):
-
-        """ Install the dependencies needed for building this package """
-
-        dependencies = []
+    def get_dependency_list(self,project_path):
 
         if (os.path.exists(os.path.join(project_path,"setup.py"))): # it is a python package
             pacman_path = os.path.join(project_path,"stpacman.cfg")
@@ -374,12 +677,22 @@ class arch (multipackager_module.package_base.package_base):
             pacman_path = os.path.join(project_path,"PKGBUILD")
             if (not os.path.exists(pacman_path)):
                 print (_("There is no PKGBUILD file with the package specific data"))
-                return True
+                return None
             dependencies = self.read_deps(pacman_path,True)
             dependencies.append("meson")
+        return dependencies
+
+
+    def install_dependencies(self,project_path,avoid_packages,preinstall):
+
+        """ Install the dependencies needed for building this package """
+
+        dependencies = self.get_dependency_list(project_path)
+        if dependencies == None:
+            return True
 
         if self.distro_full_name in preinstall:
-            tmp_path = "/var/tmp/multipackager_arch_tmp"
+            tmp_path = os.path.join(self.configuration.working_path,self.workspace_name+".pkginfo")
             pkg_path = os.path.join(tmp_path,".PKGINFO")
             for f in preinstall[self.distro_full_name]:
                 if os.path.exists(tmp_path):
@@ -506,7 +819,7 @@ class arch (multipackager_module.package_base.package_base):
         os.chmod(self.build_path, 511) # 777 permissions
 
         command = 'bash -c "cd /project && makepkg"'
-        if self.run_chroot(self.working_path, command, "multipackager"):
+        if self.run_chroot(self.working_path, command, "multipackager", self.get_build_environment()):
             return True
 
 #         if is_python:
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import json
+import time
+import hashlib
+import tarfile
+import threading
+import urllib.request
+import urllib.error
+
+# URLs where the snapshot of an AUR package can be, in order
+AUR_URLS = ["https://aur.archlinux.org/packages/{short:s}/{name:s}/{name:s}.tar.gz",
+            "https://aur.archlinux.org/cgit/aur.git/snapshot/{name:s}.tar.gz"]
+
+# only one target can download each package at the same time
+locks = {}
+locks_lock = threading.Lock()
+
+
+def get_lock(name):
+
+    with locks_lock:
+        if name not in locks:
+            locks[name] = threading.Lock()
+        return locks[name]
+
+
+class aur_cache(object):
+
+    """ Keeps the snapshots of the AUR packages (the PKGBUILD and the files needed to build them). Each
+        package has a folder with its snapshots, named after their sha256, and a file with the current
+        one, when it was downloaded and the ETag/Last-Modified sent by AUR. It isn't checked again until it
+        is older than max_age, and then it is downloaded again only if AUR says that it has changed """
+
+    def __init__(self, cache_path, max_age, trace = None):
+
+        self.cache_path = cache_path
+        self.max_age = max_age # in seconds
+        self.trace = trace
+
+
+    def get_current(self,name):
+
+        try:
+            f = open(os.path.join(self.cache_path,name,"current.json"),"r")
+            current = json.load(f)
+            f.close()
+        except:
+            return None
+        if (current["hash"] != None) and (not os.path.exists(os.path.join(self.cache_path,name,current["hash"]+".tar.gz"))):
+            return None
+        return current
+
+
+    def set_current(self,name,current):
+
+        current_path = os.path.join(self.cache_path,name,"current.json")
+        f = open(current_path+".tmp","w")
+        json.dump(current,f)
+        f.close()
+        os.rename(current_path+".tmp",current_path)
+
+
+    def get_snapshot_path(self,name,current):
+
+        if current["hash"] == None:
+            return None
+        return os.path.join(self.cache_path,name,current["hash"]+".tar.gz")
+
+
+    def get_snapshot(self,name):
+
+        """ Returns the path of the snapshot of the AUR package, downloading it if there is no copy or it is too
+            old, or None if the package isn't in AUR. If AUR can't be reached, the old copy is used """
+
+        with get_lock(name):
+            current = self.get_current(name)
+            if (current != None) and (time.time() - current["fetched"] < self.max_age):
+                return self.get_snapshot_path(name,current)
+
+            data,validators = self.download(name,current)
+            if data == True:
+                # not modified in AUR
+                current["fetched"] = time.time()
+                self.set_current(name,current)
+                return self.get_snapshot_path(name,current)
+            if isinstance(data,Exception):
+                if (current == None) or (current["hash"] == None):
+                    print(_("Can't download {:s} from AUR: {:s}").format(name,str(data)))
+                    return None
+                print(_("Can't download {:s} from AUR; using the copy downloaded before").format(name))
+                return self.get_snapshot_path(name,current)
+
+            package_path = os.path.join(self.cache_path,name)
+            if not os.path.exists(package_path):
+                os.makedirs(package_path)
+            if data == None:
+                # it isn't in AUR, so don't ask again until it expires
+                self.set_current(name,{"hash":None, "fetched":time.time()})
+                return None
+
+            key = hashlib.sha256(data).hexdigest()
+            snapshot_path = os.path.join(package_path,key+".tar.gz")
+            if not os.path.exists(snapshot_path):
+                f = open(snapshot_path+".tmp","wb")
+                f.write(data)
+                f.close()
+                os.rename(snapshot_path+".tmp",snapshot_path)
+            current = {"hash":key, "fetched":time.time()}
+            current.update(validators)
+            self.set_current(name,current)
+            # the previous versions aren't needed anymore
+            for filename in os.listdir(package_path):
+                if filename.endswith(".tar.gz") and (filename != key+".tar.gz"):
+                    os.remove(os.path.join(package_path,filename))
+            return snapshot_path
+
+
+    def download(self,name,current):
+
+        """ Returns the contents of the snapshot, None if it doesn't exist, True if it hasn't changed since the
+            current one was downloaded, or the exception if AUR can't be reached; and the URL, ETag and
+            Last-Modified of the snapshot, to check later whether it has changed """
+
+        urls = [url.format(short = name[:2], name = name) for url in AUR_URLS]
+        if (current != None) and (current["hash"] != None) and (current.get("url") in urls):
+            # the URL where it was found before is checked first
+            urls.remove(current["url"])
+            urls.insert(0,current["url"])
+        error = None
+        for url in urls:
+            print(_("Downloading {:s}").format(url))
+            request = urllib.request.Request(url)
+            if (current != None) and (current["hash"] != None) and (current.get("url") == url):
+                if current.get("etag") != None:
+                    request.add_header("If-None-Match",current["etag"])
+                if current.get("last_modified") != None:
+                    request.add_header("If-Modified-Since",current["last_modified"])
+            start = time.monotonic()
+            try:
+                response = urllib.request.urlopen(request, timeout = 60)
+                data = response.read()
+                response.close()
+            except urllib.error.HTTPError as e:
+                self.add_trace(url,start,e.code)
+                if e.code == 304:
+                    return True,{}
+                continue # not in this URL
+            except Exception as e:
+                self.add_trace(url,start,-1)
+                error = e
+                continue
+            self.add_trace(url,start,0)
+            if data[:2] != b"\x1f\x8b":
+                continue # not a tar.gz file; probably an error page
+            return data,{"url":url, "etag":response.headers.get("ETag"), "last_modified":response.headers.get("Last-Modified")}
+        return error,{}
+
+
+    def add_trace(self,url,start,retval):
+
+        if self.trace != None:
+            self.trace("GET {:s}".format(url),"download",start,retval)
+
+
+    def extract(self,snapshot_path,destination):
+
+        """ Extracts a snapshot inside destination. Returns True if there was an error """
+
+        try:
+            archive = tarfile.open(snapshot_path,"r:gz")
+            members = []
+            for member in archive.getmembers():
+                # nothing can be written outside the destination folder
+                if os.path.isabs(member.name) or (".." in member.name.split("/")) or member.issym() or member.islnk() or member.isdev():
+                    continue
+                members.append(member)
+            if hasattr(tarfile,"data_filter"):
+                archive.extractall(destination,members,filter = "data")
+            else:
+                archive.extractall(destination,members)
+            archive.close()
+        except (tarfile.TarError, OSError, EOFError):
+            return True
+        return False
+
+
+    def invalidate(self):
+
+        """ Forces to download again all the packages the next time they are used. The old copies are
+            kept, to be used if AUR can't be reached """
+
+        if not os.path.exists(self.cache_path):
+            return
+        for name in os.listdir(self.cache_path):
+            with get_lock(name):
+                current = self.get_current(name)
+                if current == None:
+                    continue
+                current["fetched"] = 0
+                self.set_current(name,current)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import json
+import time
+import hashlib
+import tarfile
+import threading
+import urllib.request
+import urllib.error
+
+# files with the checksums published next to the bootstrap tarballs, from the best to the worst
+CHECKSUM_FILES = [("sha256","sha256sums.txt"), ("sha1","sha1sums.txt"), ("md5","md5sums.txt")]
+
+# two targets must not download the same file at the same time, but can download different ones
+locks = {}
+locks_lock = threading.Lock()
+
+
+def get_lock(file_path):
+
+    with locks_lock:
+        if file_path not in locks:
+            locks[file_path] = threading.Lock()
+        return locks[file_path]
+
+
+class download_reader(object):
+
+    """ File-like object that returns first the bytes already stored in a partial download, and then the
+        ones received from the server, appending them to the partial download. Everything is hashed """
+
+    def __init__(self, part_file, response, hasher):
+
+        self.part_file = part_file
+        self.response = response
+        self.hasher = hasher
+        self.local = True
+
+
+    def read(self,size = -1):
+
+        if self.local:
+            data = self.part_file.read(size)
+            if len(data) != 0:
+                self.hasher.update(data)
+                return data
+            self.local = False
+        if self.response == None:
+            return b""
+        data = self.response.read(size if size > 0 else 1048576)
+        if len(data) != 0:
+            self.part_file.write(data)
+            self.hasher.update(data)
+        return data
+
+
+class bootstrap_cache(object):
+
+    """ Keeps the tarballs used to create the CHROOT environments, checked against the checksums published
+        with them. They are extracted while being downloaded, and the interrupted downloads are resumed """
+
+    def __init__(self, cache_path, trace = None):
+
+        self.cache_path = cache_path
+        self.trace = trace
+        self.opener = urllib.request.build_opener()
+
+
+    def add_trace(self,name,start,retval):
+
+        if self.trace != None:
+            self.trace(name,"download",start,retval)
+
+
+    def get_checksum(self,url):
+
+        """ Returns the algorithm and the checksum published for the file at url, or None if there isn't one """
+
+        base_url,filename = url.rsplit("/",1)
+        for algorithm,sums_file in CHECKSUM_FILES:
+            start = time.monotonic()
+            try:
+                response = self.opener.open(base_url+"/"+sums_file, timeout = 60)
+                data = response.read().decode("utf-8","replace")
+                response.close()
+            except Exception:
+                self.add_trace("GET {:s}/{:s}".format(base_url,sums_file),start,-1)
+                continue
+            self.add_trace("GET {:s}/{:s}".format(base_url,sums_file),start,0)
+            for line in data.split("\n"):
+                fields = line.split()
+                if (len(fields) == 2) and (fields[1].lstrip("*") == filename):
+                    return algorithm,fields[0].lower()
+        return None
+
+
+    def read_digests(self,file_path):
+
+        try:
+            f = open(file_path+".json","r")
+            digests = json.load(f)
+            f.close()
+        except:
+            return {}
+        return digests
+
+
+    def write_digests(self,file_path,digests):
+
+        f = open(file_path+".json","w")
+        json.dump(digests,f)
+        f.close()
+
+
+    def is_valid(self,file_path,checksum):
+
+        """ Checks a cached file against the published checksum """
+
+        if checksum == None:
+            return True # it was checked when it was downloaded
+        algorithm,expected = checksum
+        digests = self.read_digests(file_path)
+        if algorithm not in digests:
+            hasher = hashlib.new(algorithm)
+            f = open(file_path,"rb")
+            while True:
+                data = f.read(1048576)
+                if len(data) == 0:
+                    break
+                hasher.update(data)
+            f.close()
+            digests[algorithm] = hasher.hexdigest()
+            self.write_digests(file_path,digests)
+        return digests[algorithm] == expected
+
+
+    def is_inside(self,path,folder):
+
+        return (path == folder) or path.startswith(folder+os.sep)
+
+
+    def extract_member(self,archive,member,destination,strip_components):
+
+        """ Extracts a member of the tarball. It is extracted while being downloaded, before checking the
+            checksum, so a member can't be written through a symlink to outside destination """
+
+        parts = member.name.split("/")[strip_components:]
+        if (len(parts) == 0) or (parts[0] == "") or member.name.startswith("/") or (".." in parts):
+            return
+        member.name = "/".join(parts)
+        if member.islnk():
+            member.linkname = "/".join(member.linkname.split("/")[strip_components:])
+
+        real_destination = os.path.realpath(destination)
+        target = os.path.join(destination,member.name)
+        if not self.is_inside(os.path.realpath(os.path.dirname(target)),real_destination):
+            raise tarfile.ExtractError(_("{:s} is outside the destination folder").format(member.name))
+        if member.islnk() and not self.is_inside(os.path.realpath(os.path.join(destination,member.linkname)),real_destination):
+            raise tarfile.ExtractError(_("{:s} links to a file outside the destination folder").format(member.name))
+        if os.path.islink(target) and not member.issym():
+            os.remove(target) # like tar, replace the symlink instead of writing through it
+        if hasattr(tarfile,"fully_trusted_filter"):
+            # the devices, owners and absolute links of the base system must be kept as-is
+            archive.extract(member,destination,numeric_owner = True,filter = "fully_trusted")
+        else:
+            archive.extract(member,destination,numeric_owner = True)
+
+
+    def extract_stream(self,fileobj,destination,strip_components):
+
+        archive = tarfile.open(fileobj = fileobj, mode = "r|*")
+        for member in archive:
+            self.extract_member(archive,member,destination,strip_components)
+        archive.close()
+
+
+    def extract(self,url,destination,strip_components = 0,proxies = None):
+
+        """ Extracts the tarball at url into destination, downloading it only if it isn't in the cache or has
+            changed in the server. proxies replaces the ones in the environment; it allows to skip the caching
+            proxy, because the tarballs are already kept here. Returns True if there was an error """
+
+        if proxies != None:
+            self.opener = urllib.request.build_opener(urllib.request.ProxyHandler(proxies))
+        else:
+            self.opener = urllib.request.build_opener()
+
+        if not os.path.exists(self.cache_path):
+            os.makedirs(self.cache_path)
+        file_path = os.path.join(self.cache_path,url.rsplit("/",1)[1])
+        checksum = self.get_checksum(url)
+        if checksum == None:
+            print(_("There are no checksums published for {:s}").format(url))
+
+        with get_lock(file_path):
+            if os.path.exists(file_path):
+                if self.is_valid(file_path,checksum):
+                    print(_("Extracting the cached copy of {:s}").format(url))
+                    start = time.monotonic()
+                    try:
+                        f = open(file_path,"rb")
+                        self.extract_stream(f,destination,strip_components)
+                        f.close()
+                    except (tarfile.TarError, OSError, EOFError) as e:
+                        print(_("Can't extract {:s}: {:s}").format(file_path,str(e)))
+                        return True
+                    self.add_trace("extract {:s}".format(file_path),start,0)
+                    return False
+                print(_("The cached copy of {:s} is outdated").format(url))
+                for path in [file_path, file_path+".json"]:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            return self.download(url,file_path,destination,strip_components,checksum)
+
+
+    def download(self,url,file_path,destination,strip_components,checksum):
+
+        part_path = file_path+".part"
+        if not os.path.exists(part_path):
+            open(part_path,"wb").close()
+        offset = os.path.getsize(part_path)
+
+        start = time.monotonic()
+        request = urllib.request.Request(url)
+        if offset != 0:
+            print(_("Resuming the download of {:s} at byte {:d}").format(url,offset))
+            request.add_header("Range","bytes={:d}-".format(offset))
+        else:
+            print(_("Downloading {:s}").format(url))
+        try:
+            response = self.opener.open(request, timeout = 60)
+        except urllib.error.HTTPError as e:
+            if (e.code == 416) and (offset != 0):
+                response = None # the partial download was already complete
+            else:
+                print(_("Can't download {:s}: {:s}").format(url,str(e)))
+                self.add_trace("GET {:s}".format(url),start,e.code)
+                return True
+        except Exception as e:
+            print(_("Can't download {:s}: {:s}").format(url,str(e)))
+            self.add_trace("GET {:s}".format(url),start,-1)
+            return True
+
+        part_file = open(part_path,"r+b")
+        if (response != None) and (offset != 0) and (response.status != 206):
+            part_file.truncate(0) # the server doesn't support resuming downloads
+
+        hasher = hashlib.new(checksum[0] if checksum != None else "sha256")
+        reader = download_reader(part_file,response,hasher)
+        retval = False
+        try:
+            # extracted while downloading; if the download fails, it will be resumed from here the next time
+            self.extract_stream(reader,destination,strip_components)
+            while len(reader.read(1048576)) != 0:
+                pass # the padding at the end
+        except (tarfile.TarError, OSError, EOFError) as e:
+            print(_("Can't download and extract {:s}: {:s}").format(url,str(e)))
+            retval = True
+        part_file.close()
+        if response != None:
+            response.close()
+        self.add_trace("GET {:s}".format(url),start,1 if retval else 0)
+        if retval:
+            return True
+
+        if (checksum != None) and (hasher.hexdigest() != checksum[1]):
+            print(_("The checksum of {:s} is wrong").format(url))
+            os.remove(part_path)
+            return True
+        os.rename(part_path,file_path)
+        self.write_digests(file_path,{hasher.name: hasher.hexdigest()})
+        return False
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import subprocess
+import os
+import sys
+import shlex
+import uuid
+
+class chroot_session(object):
+
+    """ Keeps a single container running a shell, and sends it the commands through a pipe. After each
+        command, the shell prints a line with a random token and the exit code of the command, which
+        is used to know when it has finished and how. """
+
+    def __init__(self, distro, base_path):
+
+        self.distro = distro
+        self.base_path = base_path
+        self.process = None
+        self.command = None
+        self.token = "multipackager-{:s}".format(uuid.uuid4().hex).encode("utf-8")
+
+
+    def start(self):
+
+        """ Launches the container. Returns True if there was an error """
+
+        print(_("Starting a container session at {:s}").format(self.base_path))
+        self.command = self.distro.get_chroot_command(self.base_path, "/bin/sh", pipe = True)
+        self.process = subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # ensure that the shell is alive and answering
+        if (0 != self.run("true")):
+            self.stop()
+            return True
+        return False
+
+
+    def alive(self):
+
+        return (self.process != None) and (self.process.poll() == None)
+
+
+    def get_home(self,username):
+
+        try:
+            f = open(os.path.join(self.base_path,"etc","passwd"),"r")
+        except:
+            return "/"
+        home = "/"
+        for line in f:
+            fields = line.strip().split(":")
+            if (len(fields) > 5) and (fields[0] == username):
+                home = fields[5]
+                break
+        f.close()
+        return home
+
+
+    def run(self,command,username = None,environment = None):
+
+        """ Runs a command inside the container and returns its exit code """
+
+        if not self.alive():
+            return -1
+
+        variables = ""
+        if environment != None:
+            for variable in environment:
+                variables += " {:s}={:s}".format(variable,shlex.quote(environment[variable]))
+
+        if username != None:
+            prefix = "runuser -u {:s} -- env HOME={:s} USER={:s} LOGNAME={:s}{:s}".format(username,shlex.quote(self.get_home(username)),username,username,variables)
+        else:
+            prefix = "env{:s}".format(variables)
+
+        sys.stdout.flush()
+        script = "cd / && {:s} /bin/sh -c {:s} </dev/null\nprintf '%s:%d\\n' {:s} $?\n".format(prefix,shlex.quote(command),self.token.decode("utf-8"))
+        try:
+            self.process.stdin.write(script.encode("utf-8"))
+            self.process.stdin.flush()
+        except:
+            return -1
+
+        while True:
+            line = self.process.stdout.readline()
+            if len(line) == 0:
+                return -1 # the container died
+            pos = line.find(self.token)
+            if pos == -1:
+                sys.stdout.buffer.write(line)
+                sys.stdout.flush()
+                continue
+            if pos != 0:
+                sys.stdout.buffer.write(line[:pos])
+                sys.stdout.flush()
+            try:
+                return int(line[pos+len(self.token)+1:].strip())
+            except:
+                return -1
+
+
+    def stop(self):
+
+        if self.process == None:
+            return
+        try:
+            self.process.stdin.write(b"exit 0\n")
+            self.process.stdin.close()
+        except:
+            pass
+        # show any pending output
+        for line in self.process.stdout:
+            sys.stdout.buffer.write(line)
+        sys.stdout.flush()
+        self.process.wait()
+        self.process = None
@@ -17,6 +17,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
+import os
 
 class configuration:
 
@@ -31,7 +32,27 @@ class configuration:
         self.config_file = "/etc/multipackager/config.cfg"
         self.clean = True
         self.revision = 1
+        self.jobs = 1
+        self.jobs_from_cli = False
+        self.cpus = os.cpu_count() or 1
+        self.cpus_from_cli = False
         self.arch_mirror = "http://mirrors.kernel.org/archlinux"
+        self.result_cache_size = 2048 # in MBytes
+        self.sessions = True
+        self.runner = "nspawn"
+        self.dependency_layers = 8
+        self.storage = "auto"
+        self.hooks = []
+        self.package_pool_size = 8192 # in MBytes
+        self.caching_proxy = True
+        self.proxy_cache_size = 4096 # in MBytes
+        self.metadata_ttl = 60 # in minutes
+        # environment variables to use the caching proxy, and the proxies to use for the downloads that
+        # must not go through it (those configured before launching it), while it is running
+        self.proxy_environment = {}
+        self.upstream_proxies = None
+        self.trace_file = None
+        self.tracer = None
 
 
     def set_project_path(self,project_path):
@@ -59,6 +80,8 @@ class configuration:
             print(_("Can't find the configuration file at {:s}. Using default values.").format(self.config_file))
             return False
 
+        # the file can be read more than once
+        self.hooks = []
         line_counter = 0
         for line in cfg:
             line_counter += 1
@@ -101,12 +124,116 @@ class configuration:
                     has_error = True;
                     continue
                 self.mount_path.append(parameters[1])
+            elif (parameters[0] == "package_pool_size:"):
+                if (nparams != 2):
+                    print ("Error in line {:d}; incorrect number of parameters\n".format(line_counter))
+                    has_error = True;
+                    continue
+                try:
+                    self.package_pool_size = max(0,int(parameters[1]))
+                except:
+                    print ("Error in line {:d}: {:s} is not a valid size\n".format(line_counter,parameters[1]))
+                    has_error = True;
+            elif (parameters[0] == "caching_proxy:"):
+                if (nparams != 2) or ((parameters[1] != "yes") and (parameters[1] != "no")):
+                    print ("Error in line {:d}; caching_proxy must be 'yes' or 'no'\n".format(line_counter))
+                    has_error = True;
+                    continue
+                self.caching_proxy = (parameters[1] == "yes")
+            elif (parameters[0] == "proxy_cache_size:"):
+                if (nparams != 2):
+                    print ("Error in line {:d}; incorrect number of parameters\n".format(line_counter))
+                    has_error = True;
+                    continue
+                try:
+                    self.proxy_cache_size = max(0,int(parameters[1]))
+                except:
+                    print ("Error in line {:d}: {:s} is not a valid size\n".format(line_counter,parameters[1]))
+                    has_error = True;
+            elif (parameters[0] == "metadata_ttl:"):
+                if (nparams != 2):
+                    print ("Error in line {:d}; incorrect number of parameters\n".format(line_counter))
+                    has_error = True;
+                    continue
+                try:
+                    self.metadata_ttl = max(0,int(parameters[1]))
+                except:
+                    print ("Error in line {:d}: {:s} is not a valid number of minutes\n".format(line_counter,parameters[1]))
+                    has_error = True;
+            elif (parameters[0] == "hook:"):
+                if (nparams != 2):
+                    print ("Error in line {:d}; incorrect number of parameters\n".format(line_counter))
+                    has_error = True;
+                    continue
+                self.hooks.append(parameters[1])
             elif (parameters[0] == "arch_mirror:"):
                 if (nparams != 2):
                     print ("Error in line {:d}; incorrect number of parameters\n".format(line_counter))
                     has_error = True;
                     continue
                 self.arch_mirror = parameters[1]
+            elif (parameters[0] == "jobs:"):
+                if (nparams != 2):
+                    print ("Error in line {:d}; incorrect number of parameters\n".format(line_counter))
+                    has_error = True;
+                    continue
+                try:
+                    jobs = max(1,int(parameters[1]))
+                    if not self.jobs_from_cli: # the command line has precedence
+                        self.jobs = jobs
+                except:
+                    print ("Error in line {:d}: {:s} is not a valid number of jobs\n".format(line_counter,parameters[1]))
+                    has_error = True;
+            elif (parameters[0] == "result_cache_size:"):
+                if (nparams != 2):
+                    print ("Error in line {:d}; incorrect number of parameters\n".format(line_counter))
+                    has_error = True;
+                    continue
+                try:
+                    self.result_cache_size = max(0,int(parameters[1]))
+                except:
+                    print ("Error in line {:d}: {:s} is not a valid size\n".format(line_counter,parameters[1]))
+                    has_error = True;
+            elif (parameters[0] == "sessions:"):
+                if (nparams != 2) or ((parameters[1] != "yes") and (parameters[1] != "no")):
+                    print ("Error in line {:d}; sessions must be 'yes' or 'no'\n".format(line_counter))
+                    has_error = True;
+                    continue
+                self.sessions = (parameters[1] == "yes")
+            elif (parameters[0] == "storage:"):
+                if (nparams != 2) or (parameters[1] not in ["auto", "btrfs", "reflink", "copy"]):
+                    print ("Error in line {:d}; storage must be 'auto', 'btrfs', 'reflink' or 'copy'\n".format(line_counter))
+                    has_error = True;
+                    continue
+                self.storage = parameters[1]
+            elif (parameters[0] == "runner:"):
+                if (nparams != 2) or ((parameters[1] != "nspawn") and (parameters[1] != "namespace")):
+                    print ("Error in line {:d}; runner must be 'nspawn' or 'namespace'\n".format(line_counter))
+                    has_error = True;
+                    continue
+                self.runner = parameters[1]
+            elif (parameters[0] == "dependency_layers:"):
+                if (nparams != 2):
+                    print ("Error in line {:d}; incorrect number of parameters\n".format(line_counter))
+                    has_error = True;
+                    continue
+                try:
+                    self.dependency_layers = max(1,int(parameters[1]))
+                except:
+                    print ("Error in line {:d}: {:s} is not a valid number of layers\n".format(line_counter,parameters[1]))
+                    has_error = True;
+            elif (parameters[0] == "cpus:"):
+                if (nparams != 2):
+                    print ("Error in line {:d}; incorrect number of parameters\n".format(line_counter))
+                    has_error = True;
+                    continue
+                try:
+                    cpus = max(1,int(parameters[1]))
+                    if not self.cpus_from_cli: # the command line has precedence
+                        self.cpus = cpus
+                except:
+                    print ("Error in line {:d}: {:s} is not a valid number of CPUs\n".format(line_counter,parameters[1]))
+                    has_error = True;
 
         return has_error
 
@@ -130,7 +257,7 @@ class configuration:
                 print (_("--config parameter must be followed by a path"))
                 return None
             self.config_file = args[1]
-            return args[2:]
+            return self.parse_args(args[2:])
 
         if (args[0] == "--revision") or (args[0] == "-r"):
             syntax_error = False
@@ -144,10 +271,51 @@ class configuration:
             if syntax_error:
                 print (_("--revision parameter must be followed by a number"))
                 return None
-            return args[2:]
+            return self.parse_args(args[2:])
+
+        if (args[0] == "--jobs") or (args[0] == "-j"):
+            syntax_error = False
+            if args_size < 2:
+                syntax_error = True
+            else:
+                try:
+                    self.jobs = int(args[1])
+                    if self.jobs < 1:
+                        syntax_error = True
+                except:
+                    syntax_error = True
+            if syntax_error:
+                print (_("--jobs parameter must be followed by a positive number"))
+                return None
+            self.jobs_from_cli = True
+            return self.parse_args(args[2:])
+
+        if args[0] == "--cpus":
+            syntax_error = False
+            if args_size < 2:
+                syntax_error = True
+            else:
+                try:
+                    self.cpus = int(args[1])
+                    if self.cpus < 1:
+                        syntax_error = True
+                except:
+                    syntax_error = True
+            if syntax_error:
+                print (_("--cpus parameter must be followed by a positive number"))
+                return None
+            self.cpus_from_cli = True
+            return self.parse_args(args[2:])
+
+        if args[0] == "--trace":
+            if args_size < 2:
+                print (_("--trace parameter must be followed by a path"))
+                return None
+            self.trace_file = args[1]
+            return self.parse_args(args[2:])
 
         if args[0] == "--noclean":
             self.clean = False
-            return args[1:]
+            return self.parse_args(args[1:])
 
         return None
@@ -21,6 +21,7 @@
 import os
 import shutil
 import multipackager_module.package_base
+import multipackager_module.apt_index
 
 class debian (multipackager_module.package_base.package_base):
 
@@ -95,14 +96,17 @@ class debian (multipackager_module.package_base.package_base):
         # Create all, first, in a temporal folder
         tmp_path = path+".tmp"
 
-        shutil.rmtree(tmp_path, ignore_errors=True)
+        self.storage.delete(tmp_path)
 
-        os.makedirs(tmp_path)
+        self.storage.create_folder(tmp_path)
         if self.distro_type == "debian":
             server = "http://http.debian.net/debian/"
         else:
             server = "http://archive.ubuntu.com/ubuntu/"
         command = "debootstrap --variant=buildd --arch {:s} {:s} {:s} {:s}".format(self.architecture,self.distro_name,tmp_path,server)
+        view_path = self.get_package_cache_view()
+        if view_path != None:
+            command = command.replace("debootstrap ","debootstrap --cache-dir={:s} ".format(view_path),1)
 
 
         if (0 != self.run_external_program(command)):
@@ -117,17 +121,20 @@ class debian (multipackager_module.package_base.package_base):
             f.write("deb http://archive.ubuntu.com/ubuntu/ {:s} main restricted universe multiverse\n".format(self.distro_name))
         f.close()
 
-        command = 'apt clean'
-        if (0 != self.run_chroot(tmp_path,command)):
-            return True # error!!!
+        if self.package_pool.enabled():
+            self.configure_package_cache(tmp_path)
 
-        command = 'apt update'
-        if (0 != self.run_chroot(tmp_path,command)):
-            return True # error!!!
+        with self.chroot_session(tmp_path):
+            if (0 != self.clean_package_cache(tmp_path)):
+                return True # error!!!
 
-        command = 'apt install meson ninja-build -y'
-        if (0 != self.run_chroot(tmp_path,command)):
-            return True # error!!!
+            command = 'apt update'
+            if (0 != self.refresh_metadata(tmp_path,command)):
+                return True # error!!!
+
+            command = 'apt install meson ninja-build -y'
+            if (0 != self.run_chroot(tmp_path,command)):
+                return True # error!!!
 
         os.sync()
         os.rename(tmp_path,path) # rename the folder to the definitive name
@@ -138,6 +145,43 @@ class debian (multipackager_module.package_base.package_base):
         return False # no error
 
 
+    def get_package_cache_folder(self):
+
+        return "/var/cache/apt/archives"
+
+
+    def get_package_database_type(self):
+
+        return "dpkg"
+
+
+    def get_repository_checksums(self,path):
+
+        index = multipackager_module.apt_index.get_index(path)
+        if index == None:
+            return None
+        return index.archives
+
+
+    def configure_package_cache(self,path):
+
+        # 'apt' deletes the packages after installing them, unless told otherwise
+        config_path = os.path.join(path,"etc","apt","apt.conf.d","90multipackager-pool")
+        if os.path.exists(config_path) or (not os.path.exists(os.path.dirname(config_path))):
+            return
+        f = open(config_path,"w")
+        f.write('APT::Keep-Downloaded-Packages "true";\nBinary::apt::APT::Keep-Downloaded-Packages "true";\n')
+        f.close()
+
+
+    def clean_package_cache(self,path):
+
+        # with the package pool, the cache is shared and must be kept
+        if self.get_package_cache_view() != None:
+            return 0
+        return self.run_chroot(path,"apt clean")
+
+
     @multipackager_module.package_base.call_with_cache
     def update(self,path):
 
@@ -145,11 +189,11 @@ class debian (multipackager_module.package_base.package_base):
 
         # Here, we have for sure the CHROOT environment, but maybe it must be updated
 
-        retval = self.run_chroot(path,"apt clean")
+        retval = self.clean_package_cache(path)
         if (retval != 0):
             return True # error!!!!
 
-        retval = self.run_chroot(path,"apt update")
+        retval = self.refresh_metadata(path,"apt update",True)
         if (retval != 0):
             return True # error!!!!
 
@@ -160,31 +204,116 @@ class debian (multipackager_module.package_base.package_base):
         return False
 
 
-    @multipackager_module.package_base.call_with_cache
     def install_dependencies_full(self,path,dependencies):
 
-        retval = self.run_chroot(path,"apt clean")
+        """ Installs the dependencies in path. An element with several packages separated by '|' means
+            that the first of them that can be installed must be used """
+
+        retval = self.clean_package_cache(path)
         if (retval != 0):
             return retval
 
-
-        retval = self.run_chroot(path,"apt update")
+        retval = self.refresh_metadata(path,"apt update")
         if (retval != 0):
             return retval
 
-        command = "apt install -y"
+        index = multipackager_module.apt_index.get_index(path)
+        if index == None:
+            return self.install_dependencies_one_by_one(path,dependencies)
+
+        # choose the package for each dependency here, so everything is installed in a single transaction
+        installed = self.get_installed_packages()
+        packages = {}
         for dep in dependencies:
+            relations = []
+            for element in dep.split("|"):
+                relation = multipackager_module.apt_index.parse_relation(element)
+                if relation != None:
+                    relations.append(relation)
+            if self.is_relation_installed(installed,relations):
+                continue
+            chosen = None
+            for name,operator,version in relations:
+                chosen = index.find(name,operator,version)
+                if chosen != None:
+                    break
+            if chosen == None:
+                print (_("Cant find any of these packages in the guest system:{:s}").format(" "+" | ".join([multipackager_module.apt_index.format_relation(*relation) for relation in relations])))
+                return True
+            # a package required with a specific version and also without it must be installed only once
+            name = chosen.split("=")[0]
+            if (name not in packages) or (chosen.find("=") != -1):
+                packages[name] = chosen
+
+        if len(packages) == 0:
+            return 0
+        return self.run_chroot(path, "apt install -y {:s}".format(" ".join(packages.values())))
+
+
+    def get_dependency_version(self,installed,name):
+
+        version = multipackager_module.package_base.package_base.get_dependency_version(self,installed,name)
+        if version != None:
+            return version
+        # it will be installed from the repositories
+        index = multipackager_module.apt_index.get_index(self.base_path)
+        if index == None:
+            return None
+        return index.get_version(name)
+
+
+    def is_relation_installed(self,installed,relations):
+
+        """ Returns True if any of the relationships is satisfied by the packages installed in base_path """
+
+        if installed == None:
+            return False
+        for name,operator,version in relations:
+            if operator == None:
+                if installed.contains(name):
+                    return True # a real or a virtual package
+            elif multipackager_module.apt_index.satisfies(installed.get_version(name),operator,version):
+                return True
+        return False
+
+
+    def install_dependencies_one_by_one(self,path,dependencies):
+
+        """ Installs the dependencies when there are no package lists to choose between the alternatives
+            and check the versions, by trying each alternative until one can be installed """
+
+        single_dependencies = []
+        for dep in dependencies:
+            group = [multipackager_module.apt_index.get_relation_name(element) for element in dep.split("|")]
+            group = [element for element in group if element != ""]
+            if len(group) == 0:
+                continue
+            if len(group) == 1:
+                single_dependencies.append(group[0])
+                continue
+            found = False
+            for element in group:
+                command = "apt install -y {:s}".format(element)
+                if (0 == self.run_chroot(path, command)):
+                    found = True
+                    break
+            if not found:
+                print (_("Cant find any of these packages in the guest system:{:s}").format(" "+" ".join(group)))
+                return True
+
+        command = "apt install -y"
+        for dep in single_dependencies:
             command += " "+dep
         return self.run_chroot(path, command)
 
 
     def install_local_package_internal(self, file_name):
 
-        retval = self.run_chroot(path,"apt clean")
+        retval = self.clean_package_cache(self.working_path)
         if (retval != 0):
             return retval
 
-        retval = self.run_chroot(path,"apt update")
+        retval = self.refresh_metadata(self.working_path,"apt update")
         if (retval != 0):
             return True # error!!!!
 
@@ -194,12 +323,13 @@ class debian (multipackager_module.package_base.package_base):
         return False
 
 
-    def install_dependencies(self,project_path,avoid_packages,preinstall):
+    def read_dependencies(self,project_path):
 
-        """ Install the dependencies needed for building this package """
+        """ Reads the dependencies from the control file (or stdeb.cfg for python projects). Returns a list with the
+            single packages and a list with the groups of alternative packages, or None if there is an error """
 
-        run_update = False
         dependencies = []
+        alternatives = []
 
         if (os.path.exists(os.path.join(project_path,"setup.py"))): # it is a python package
             control_path = os.path.join(project_path,"stdeb.cfg")
@@ -214,12 +344,12 @@ class debian (multipackager_module.package_base.package_base):
             debian_path = self.check_path_in_builds(project_path)
             if debian_path == None:
                 print (_("There is no DEBIAN/UBUNTU folder with the package specific data"))
-                return True
+                return None
 
             control_path = os.path.join(debian_path,"control")
             if (not os.path.exists(control_path)):
                 print (_("There is no CONTROL file with the package specific data"))
-                return True
+                return None
 
         f = open (control_path,"r")
         for line in f:
@@ -235,32 +365,18 @@ class debian (multipackager_module.package_base.package_base):
                 tmp = tmp.split(",")
                 for element2 in tmp:
                     tmp2 = element2.split("|")
-                    # if it is a single package, just add it as-is
-                    if (len(tmp2) == 1):
-                        pos = element2.find("(") # remove version info
-                        if (pos != -1):
-                            element2 = element2[:pos]
-                        dependencies.append(element2.strip())
-                        continue
-                    # but if there are several optional packages, check each one and install the first found
-                    list_p = ""
-                    found = False
+                    # the version info is kept, and checked against the package lists when installing
+                    group = []
                     for element in tmp2:
-                        pos = element.find("(") # remove version info
-                        if (pos != -1):
-                            element = element[:pos]
-                        list_p += " "+element
-                        if not run_update:
-                            self.run_chroot(self.base_path, "apt clean")
-                            self.run_chroot(self.base_path, "apt update")
-                            run_update = True
-                        command = "apt install -y {:s}".format(element)
-                        if (0 == self.run_chroot(self.base_path, command)):
-                            found = True
-                            break
-                    if not found:
-                        print (_("Cant find any of these packages in the guest system:{:s}").format(list_p))
-                        return True
+                        relation = multipackager_module.apt_index.parse_relation(element)
+                        if relation != None:
+                            group.append(multipackager_module.apt_index.format_relation(*relation))
+                    # if it is a single package, just add it as-is
+                    if (len(group) == 1):
+                        dependencies.append(group[0])
+                    # but if there are several optional packages, keep all of them to choose one later
+                    elif (len(group) != 0):
+                        alternatives.append(group)
                 continue
             if line[:7] == "Source:":
                 self.project_name = line[7:].strip()
@@ -272,13 +388,36 @@ class debian (multipackager_module.package_base.package_base):
                 self.set_project_version(line[8:].strip())
                 continue
         f.close()
+        return dependencies,alternatives
+
+
+    def get_dependency_list(self,project_path):
 
-        if (len(dependencies) != 0):
-            deps2 = []
-            for d in dependencies:
-                if avoid_packages.count(d) == 0:
-                    deps2.append(d)
-            return self.install_dependencies_full(self.base_path,deps2)
+        data = self.read_dependencies(project_path)
+        if data == None:
+            return None
+        dependencies,alternatives = data
+        return dependencies + [" | ".join(group) for group in alternatives]
+
+
+    def install_dependencies(self,project_path,avoid_packages,preinstall):
+
+        """ Install the dependencies needed for building this package """
+
+        data = self.read_dependencies(project_path)
+        if data == None:
+            return True
+        dependencies,alternatives = data
+
+        deps2 = []
+        for d in dependencies:
+            if avoid_packages.count(multipackager_module.apt_index.get_relation_name(d)) == 0:
+                deps2.append(d)
+        for group in alternatives:
+            deps2.append(" | ".join(group))
+        deps2 = self.remove_installed_dependencies(deps2)
+        if (len(deps2) != 0):
+            return self.install_dependencies_layer(deps2)
         return False
 
 
@@ -288,7 +427,7 @@ class debian (multipackager_module.package_base.package_base):
         destination_dir = os.path.join(self.build_path,"deb_dist")
         shutil.rmtree(destination_dir, ignore_errors = True)
 
-        if (self.run_chroot(self.working_path, 'bash -c "cd /project && python3 setup.py --command-packages=stdeb.command bdist_deb"')):
+        if (self.run_chroot(self.working_path, 'bash -c "cd /project && python3 setup.py --command-packages=stdeb.command bdist_deb"', environment = self.get_build_environment())):
             return True
         return False
 
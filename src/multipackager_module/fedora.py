@@ -23,6 +23,9 @@ import shutil
 import configparser
 import multipackager_module.package_base
 
+# folder, inside the new environment, with the packages downloaded while creating it
+BOOTSTRAP_PACKAGES = "/var/cache/multipackager_bootstrap"
+
 class fedora (multipackager_module.package_base.package_base):
 
     def __init__(self, configuration, distro_type, distro_name, architecture, cache_name = None):
@@ -62,9 +65,9 @@ class fedora (multipackager_module.package_base.package_base):
         # Create all, first, in a temporal folder
         tmp_path = path+".tmp"
 
-        shutil.rmtree(tmp_path, ignore_errors=True)
+        self.storage.delete(tmp_path)
 
-        os.makedirs(tmp_path)
+        self.storage.create_folder(tmp_path)
 
         yumcfgpath = os.path.join(tmp_path,"yum.conf")
         yumrepospath = os.path.join(tmp_path,"yum.repos.d")
@@ -74,7 +77,7 @@ class fedora (multipackager_module.package_base.package_base):
         yumcfg.write("[main]\n")
         yumcfg.write("cachedir=/var/cache/yum\n")
         yumcfg.write("persistdir=/var/lib/yum\n")
-        yumcfg.write("keepcache=0\n")
+        yumcfg.write("keepcache=1\n") # the packages are installed again from inside the chroot environment
         yumcfg.write("debuglevel=2\n")
         yumcfg.write("logfile={:s}\n".format(os.path.join(tmp_path,"build.log")))
         yumcfg.write("exactarch=0\n")
@@ -104,22 +107,27 @@ class fedora (multipackager_module.package_base.package_base):
         else:
             packages = "fedora-release bash dnf util-linux meson"
         command = "yum -y --config={:s} --releasever={:s} --nogpg --installroot={:s} install {:s}".format(yumcfgpath,self.distro_name,tmp_path,packages)
-        if (0 != self.run_external_program(command)):
-            shutil.rmtree(tmp_path, ignore_errors=True)
+        if (0 != self.run_phase("bootstrap_host",self.run_external_program,command)):
+            self.storage.delete(tmp_path)
             return True # error!!!
 
         shutil.rmtree(yumrepospath, ignore_errors=True)
         os.remove(yumcfgpath)
 
-        # for some reason, the RPM database is not complete, so it is a must to reinstall everything from inside the chroot environment
+        # for some reason, the RPM database is not complete, so it is a must to reinstall everything from inside the chroot environment.
+        # The packages downloaded by the first pass are used, so they aren't downloaded twice
+        if self.collect_bootstrap_packages(tmp_path) != 0:
+            packages = "{:s}/*.rpm".format(BOOTSTRAP_PACKAGES)
         # umount /sys to avoid failure due to filesystem.rpm. At least with Fedora 21
         if self.distro_number <= 21:
             command = 'bash -c "umount /sys && yum -y --releasever={:s} install {:s}"'.format(self.distro_name,packages)
         else:
             command = 'bash -c "dnf -y --releasever={:s} install {:s}"'.format(self.distro_name,packages)
-        if (0 != self.run_chroot(tmp_path, command)):
-            shutil.rmtree(tmp_path, ignore_errors=True)
+        if (0 != self.run_phase("bootstrap_chroot",self.run_chroot,tmp_path,command)):
+            self.storage.delete(tmp_path)
             return True # error!!!
+        shutil.rmtree(os.path.join(tmp_path,BOOTSTRAP_PACKAGES[1:]), ignore_errors=True)
+        self.mark_metadata_refreshed(tmp_path)
 
         os.sync()
         os.rename(tmp_path,path) # rename the folder to the definitive name
@@ -130,17 +138,86 @@ class fedora (multipackager_module.package_base.package_base):
         return False # no error
 
 
+    def collect_bootstrap_packages(self,tmp_path):
+
+        """ Moves the packages downloaded by yum from the host into a single folder of the new environment,
+            and returns how many there are """
+
+        destination = os.path.join(tmp_path,BOOTSTRAP_PACKAGES[1:])
+        os.makedirs(destination, exist_ok = True)
+        counter = 0
+        for folder,dirs,files in os.walk(os.path.join(tmp_path,"var","cache","yum")):
+            for filename in files:
+                if filename.endswith(".rpm"):
+                    os.rename(os.path.join(folder,filename),os.path.join(destination,filename))
+                    counter += 1
+        return counter
+
+
+    def get_package_cache_folder(self):
+
+        if self.distro_number <= 21:
+            return "/var/cache/yum"
+        return "/var/cache/dnf"
+
+
+    def get_package_database_type(self):
+
+        return "rpm"
+
+
+    def configure_package_cache(self,path):
+
+        if self.distro_number <= 21:
+            config_path = os.path.join(path,"etc","yum.conf")
+        else:
+            config_path = os.path.join(path,"etc","dnf","dnf.conf")
+        if not os.path.exists(config_path):
+            return
+        f = open(config_path,"r")
+        lines = f.read().split("\n")
+        f.close()
+        new_lines = []
+        for line in lines:
+            if line.replace(" ","").startswith("keepcache="):
+                continue
+            new_lines.append(line)
+            if line.strip() == "[main]":
+                new_lines.append("keepcache=1")
+        if new_lines == lines:
+            return
+        f = open(config_path,"w")
+        f.write("\n".join(new_lines))
+        f.close()
+
+
+    def get_package_manager(self):
+
+        """ Returns the package manager command. The metadata is refreshed only by refresh_metadata, so it
+            must not refresh it by itself when it considers that it has expired """
+
+        if self.distro_number <= 21:
+            return "yum -y --setopt=metadata_expire=never"
+        return "dnf -y --setopt=metadata_expire=never"
+
+
+    def get_refresh_command(self):
+
+        if self.distro_number <= 21:
+            return 'bash -c "yum clean expire-cache && yum makecache"'
+        return "dnf makecache --refresh"
+
+
     @multipackager_module.package_base.call_with_cache
     def update(self,path):
 
         """ Ensures that the chroot environment is updated with the lastest packages """
 
         # Here, we have for sure the CHROOT environment, but maybe it must be updated
-        if self.distro_number <= 21:
-            command = 'yum update -y'
-        else:
-            command = 'dnf update -y'
-        if (0 != self.run_chroot(path,command)):
+        if (0 != self.refresh_metadata(path,self.get_refresh_command(),True)):
+            return True # error!!!
+
+        if (0 != self.run_chroot(path,"{:s} update".format(self.get_package_manager()))):
             return True # error!!!
 
         return False
@@ -222,16 +299,15 @@ class fedora (multipackager_module.package_base.package_base):
             shutil.rmtree(install_path,ignore_errors = True)
         os.makedirs(install_path)
 
-        return self.run_chroot(self.working_path, 'bash -c "cd /project/meson && meson .. && mesonconf -Dprefix=/usr && ninja-build && DESTDIR=/install_root ninja-build install"')
+        return self.run_chroot(self.working_path, 'bash -c "cd /project/meson && meson .. && mesonconf -Dprefix=/usr && ninja-build -j{:d} && DESTDIR=/install_root ninja-build install"'.format(self.cpus), environment = self.get_build_environment())
 
 
-    @multipackager_module.package_base.call_with_cache
     def install_dependencies_full(self,path,deps):
 
-        if self.distro_number <= 21:
-            command = "yum -y install"
-        else:
-            command = "dnf -y install"
+        if (0 != self.refresh_metadata(path,self.get_refresh_command())):
+            return True
+
+        command = "{:s} install".format(self.get_package_manager())
         for dep in deps:
             command += " "+dep
         return self.run_chroot(path, command)
@@ -239,16 +315,22 @@ class fedora (multipackager_module.package_base.package_base):
 
     def install_local_package_internal(self, file_name):
 
-        if self.distro_number <= 21:
-            command = "yum install -y {:s}".format(file_name)
-        else:
-            command = "dnf install -y {:s}".format(file_name)
+        if (0 != self.refresh_metadata(self.working_path,self.get_refresh_command())):
+            return True
 
+        command = "{:s} install {:s}".format(self.get_package_manager(),file_name)
         if 0 != self.run_chroot(self.working_path, command):
             return True
         return False
 
 
+    def get_dependency_list(self,project_path):
+
+        if self.read_specs_data(project_path):
+            return None
+        return self.dependencies
+
+
     def install_dependencies(self,project_path,avoid_packages,preinstall):
 
         """ Install the dependencies needed for building this package """
@@ -260,9 +342,10 @@ class fedora (multipackager_module.package_base.package_base):
         for d in self.dependencies:
             if avoid_packages.count(d) == 0:
                 deps.append(d)
+        deps = self.remove_installed_dependencies(deps)
 
         if (len(deps) != 0):
-            return self.install_dependencies_full(self.base_path,deps)
+            return self.install_dependencies_layer(deps)
         return False
 
 
@@ -272,7 +355,7 @@ class fedora (multipackager_module.package_base.package_base):
         destination_dir = os.path.join(self.build_path,"dist")
         shutil.rmtree(destination_dir, ignore_errors = True)
 
-        if (self.run_chroot(self.working_path, 'bash -c "cd /project && python3 setup.py bdist_rpm"')):
+        if (self.run_chroot(self.working_path, 'bash -c "cd /project && python3 setup.py bdist_rpm"', environment = self.get_build_environment())):
             return True
 
         return False
@@ -396,8 +479,8 @@ class fedora (multipackager_module.package_base.package_base):
         spec_i.close()
         spec_o.close()
 
-        command = "rpmbuild -bb {:s}".format(os.path.join("rpmpackage/SPECS",self.project_name+".specs"))
-        if (self.run_chroot(self.working_path, command)):
+        command = "rpmbuild --define '_smp_mflags -j{:d}' -bb {:s}".format(self.cpus,os.path.join("rpmpackage/SPECS",self.project_name+".specs"))
+        if (self.run_chroot(self.working_path, command, environment = self.get_build_environment())):
             return True
 
         return self.copy_bin_rpms(os.path.join(self.working_path,"rpmpackage","RPMS"))
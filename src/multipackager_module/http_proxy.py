@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+import urllib.request
+import urllib.error
+import http.server
+import socketserver
+
+# files that never change once published in a repository, so they can be served without asking the mirror
+IMMUTABLE_EXTENSIONS = (".deb", ".udeb", ".rpm", ".pkg.tar", ".pkg.tar.gz", ".pkg.tar.xz", ".pkg.tar.zst", ".sig", ".drpm")
+
+# headers sent to the clients from the cached entries
+CACHED_HEADERS = ["Content-Type", "Last-Modified", "ETag"]
+
+
+class proxy_handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self,format,*args):
+
+        return # the package managers already show what they download
+
+
+    def is_immutable(self,url):
+
+        path = url.split("?")[0]
+        return path.endswith(IMMUTABLE_EXTENSIONS) or ("/by-hash/" in path)
+
+
+    def send_cached(self,data,meta,send_body = True):
+
+        """ Sends a cached entry; data is its file, already opened """
+
+        self.send_response(200)
+        for header in CACHED_HEADERS:
+            if header in meta["headers"]:
+                self.send_header(header,meta["headers"][header])
+        size = os.fstat(data.fileno()).st_size
+        self.send_header("Content-Length",str(size))
+        self.end_headers()
+        if send_body:
+            shutil.copyfileobj(data,self.wfile,65536)
+            self.server.proxy.add_statistic("bytes",size)
+        data.close()
+
+
+    def send_error_response(self,code,message):
+
+        body = message.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type","text/plain")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def forward(self,method):
+
+        """ Sends the request to the mirror without caching it """
+
+        request = urllib.request.Request(self.path,method = method,headers = self.get_forwarded_headers())
+        try:
+            response = self.server.proxy.opener.open(request,timeout = 60)
+        except urllib.error.HTTPError as e:
+            response = e
+        except Exception as e:
+            self.send_error_response(502,str(e))
+            return
+        self.send_response(response.status)
+        for header,value in response.headers.items():
+            if header.lower() not in ["connection","transfer-encoding","keep-alive"]:
+                self.send_header(header,value)
+        if "Content-Length" not in response.headers:
+            self.close_connection = True
+        self.end_headers()
+        if method != "HEAD":
+            shutil.copyfileobj(response,self.wfile,65536)
+        response.close()
+
+
+    def get_forwarded_headers(self):
+
+        headers = {}
+        for header,value in self.headers.items():
+            if header.lower() not in ["proxy-connection","connection","keep-alive","host","if-modified-since","if-none-match"]:
+                headers[header] = value
+        return headers
+
+
+    def fetch(self,entry_path,meta,send_body):
+
+        """ Downloads the URL into the cache, sending it to the client at the same time, or validates
+            the cached copy. Returns True if the file was downloaded and sent, the metadata of the
+            cache entry if it is still valid, or an HTTPError/exception if the mirror failed """
+
+        headers = self.get_forwarded_headers()
+        if meta != None:
+            if "ETag" in meta["headers"]:
+                headers["If-None-Match"] = meta["headers"]["ETag"]
+            if "Last-Modified" in meta["headers"]:
+                headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+        request = urllib.request.Request(self.path,headers = headers)
+        try:
+            response = self.server.proxy.opener.open(request,timeout = 60)
+        except urllib.error.HTTPError as e:
+            if (e.code == 304) and (meta != None):
+                self.server.proxy.add_statistic("revalidated")
+                return meta
+            return e
+        except Exception as e:
+            return e
+
+        new_meta = {"url":self.path, "headers":{}}
+        self.send_response(200)
+        for header in CACHED_HEADERS:
+            if header in response.headers:
+                new_meta["headers"][header] = response.headers[header]
+                self.send_header(header,response.headers[header])
+        if "Content-Length" in response.headers:
+            self.send_header("Content-Length",response.headers["Content-Length"])
+        else:
+            self.close_connection = True
+        self.end_headers()
+
+        # the file is stored in the cache while it is sent, even if the client disconnects
+        tmp_path = entry_path+".{:d}.tmp".format(threading.get_ident())
+        client_alive = send_body
+        size = 0
+        f = open(tmp_path,"wb")
+        try:
+            while True:
+                data = response.read(65536)
+                if len(data) == 0:
+                    break
+                f.write(data)
+                size += len(data)
+                if client_alive:
+                    try:
+                        self.wfile.write(data)
+                    except OSError:
+                        client_alive = False
+        except Exception:
+            f.close()
+            response.close()
+            os.remove(tmp_path)
+            self.close_connection = True # the client got an incomplete file
+            return True
+        f.close()
+        response.close()
+        os.rename(tmp_path,entry_path+".data")
+        f = open(entry_path+".json","w")
+        json.dump(new_meta,f)
+        f.close()
+        self.server.proxy.add_statistic("misses")
+        if send_body:
+            self.server.proxy.add_statistic("bytes",size)
+        return True
+
+
+    def do_GET(self,send_body = True):
+
+        if (not self.path.startswith("http://")) or ("Range" in self.headers):
+            self.forward("GET" if send_body else "HEAD")
+            return
+
+        proxy = self.server.proxy
+        key = hashlib.sha256(self.path.encode("utf-8")).hexdigest()
+        entry_path = os.path.join(proxy.cache_path,key[:2],key)
+
+        # only one client downloads each URL; the others wait and get the cached copy
+        with proxy.get_url_lock(key):
+            meta = proxy.read_meta(entry_path)
+            if (meta != None) and self.is_immutable(self.path):
+                proxy.add_statistic("hits")
+            else:
+                if not os.path.exists(os.path.dirname(entry_path)):
+                    os.makedirs(os.path.dirname(entry_path), exist_ok = True)
+                retval = self.fetch(entry_path,meta,send_body)
+                if retval == True:
+                    return # already sent
+                client_error = isinstance(retval,urllib.error.HTTPError) and (retval.code < 500)
+                if isinstance(retval,dict):
+                    meta = retval
+                elif (meta != None) and not client_error:
+                    # the mirror isn't available, so use the copy that we have
+                    proxy.add_statistic("stale")
+                elif isinstance(retval,urllib.error.HTTPError):
+                    if (meta != None) and (retval.code in (404,410)):
+                        # the mirror removed the file, so the cached copy must not be served anymore
+                        for extension in [".json",".data"]:
+                            try:
+                                os.remove(entry_path+extension)
+                            except OSError:
+                                pass
+                    self.send_error_response(retval.code,str(retval.reason))
+                    return
+                else:
+                    self.send_error_response(502,str(retval))
+                    return
+            os.utime(entry_path+".json")
+            # opened with the lock held, so it can't be replaced before being sent
+            data = open(entry_path+".data","rb")
+        self.send_cached(data,meta,send_body)
+
+
+    def do_HEAD(self):
+
+        self.do_GET(False)
+
+
+class threading_server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+
+
+class http_proxy(object):
+
+    """ Caching HTTP proxy for the repositories. The packages are served from the disk cache
+        without contacting the mirror; the other files (indexes, release files...) are validated
+        with the mirror using If-None-Match/If-Modified-Since before serving them """
+
+    def __init__(self, cache_path, max_size, upstream = None):
+
+        self.cache_path = cache_path
+        self.max_size = max_size # in bytes
+        self.server = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.url_locks = {}
+        self.statistics = {"hits":0, "misses":0, "revalidated":0, "stale":0, "bytes":0}
+        # the proxy itself connects to the mirrors directly, or through the proxy that was configured before it
+        self.opener = urllib.request.build_opener(urllib.request.ProxyHandler({"http":upstream} if upstream != None else {}))
+
+
+    def get_url_lock(self,key):
+
+        with self.lock:
+            if key not in self.url_locks:
+                self.url_locks[key] = threading.Lock()
+            return self.url_locks[key]
+
+
+    def add_statistic(self,name,value = 1):
+
+        with self.lock:
+            self.statistics[name] += value
+
+
+    def read_meta(self,entry_path):
+
+        try:
+            f = open(entry_path+".json","r")
+            meta = json.load(f)
+            f.close()
+        except:
+            return None
+        if not os.path.exists(entry_path+".data"):
+            return None
+        return meta
+
+
+    def start(self):
+
+        """ Starts the proxy in a background thread. Returns True if there was an error """
+
+        if not os.path.exists(self.cache_path):
+            os.makedirs(self.cache_path)
+        try:
+            self.server = threading_server(("127.0.0.1",0),proxy_handler)
+        except OSError as e:
+            print(_("Can't start the caching proxy: {:s}").format(str(e)))
+            return True
+        self.server.proxy = self
+        self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+        self.thread.start()
+        print(_("Caching proxy running at {:s}").format(self.get_url()))
+        return False
+
+
+    def get_url(self):
+
+        return "http://127.0.0.1:{:d}".format(self.server.server_address[1])
+
+
+    def stop(self):
+
+        if self.server == None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        self.evict()
+        print(_("Caching proxy: {:d} hits, {:d} downloads, {:d} validated, {:d} served while the mirror was unavailable, {:d} bytes sent").format(
+              self.statistics["hits"],self.statistics["misses"],self.statistics["revalidated"],self.statistics["stale"],self.statistics["bytes"]))
+
+
+    def evict(self):
+
+        """ Removes the least recently used entries until the cache fits in its maximum size """
+
+        entries = []
+        total_size = 0
+        for prefix in os.listdir(self.cache_path):
+            prefix_path = os.path.join(self.cache_path,prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for filename in os.listdir(prefix_path):
+                if not filename.endswith(".json"):
+                    if filename.endswith(".tmp"):
+                        os.remove(os.path.join(prefix_path,filename))
+                    continue
+                entry_path = os.path.join(prefix_path,filename[:-5])
+                try:
+                    size = os.path.getsize(entry_path+".data")
+                except OSError:
+                    size = 0
+                entries.append((os.stat(entry_path+".json").st_mtime,size,entry_path))
+                total_size += size
+
+        entries.sort()
+        for mtime,size,entry_path in entries:
+            if total_size <= self.max_size:
+                break
+            for extension in [".json",".data"]:
+                try:
+                    os.remove(entry_path+extension)
+                except OSError:
+                    pass
+            total_size -= size
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Launches a command inside a chroot environment, in its own mount, PID, UTS and IPC namespaces.
+# It is called by the 'namespace' runner:
+#
+#     namespace_helper.py --root=path --personality={x86|x86-64} [--user=name] [--setenv=VAR=value]... -- [--bind=path[:path]]... command...
+
+import os
+import sys
+import signal
+import socket
+import ctypes
+
+CLONE_NEWNS = 0x00020000
+CLONE_NEWUTS = 0x04000000
+CLONE_NEWIPC = 0x08000000
+CLONE_NEWPID = 0x20000000
+
+MS_RDONLY = 0x1
+MS_NOSUID = 0x2
+MS_NODEV = 0x4
+MS_NOEXEC = 0x8
+MS_REMOUNT = 0x20
+MS_BIND = 0x1000
+MS_REC = 0x4000
+MS_PRIVATE = 0x40000
+
+PER_LINUX = 0x0000
+PER_LINUX32 = 0x0008
+
+libc = ctypes.CDLL(None, use_errno = True)
+
+
+def check_error(retval,message):
+
+    if retval < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, "{:s}: {:s}".format(message,os.strerror(errno)))
+
+
+def unshare(flags):
+
+    if hasattr(os,"unshare"):
+        os.unshare(flags)
+    else:
+        check_error(libc.unshare(flags),"unshare")
+
+
+def mount(source,target,fstype,flags):
+
+    check_error(libc.mount(None if source == None else source.encode("utf-8"),
+                           target.encode("utf-8"),
+                           None if fstype == None else fstype.encode("utf-8"),
+                           ctypes.c_ulong(flags),
+                           None),"mount {:s}".format(target))
+
+
+def get_user(root,username):
+
+    """ Reads the UID, GID and HOME of an user from the passwd file of the chroot environment """
+
+    f = open(os.path.join(root,"etc","passwd"),"r")
+    for line in f:
+        fields = line.strip().split(":")
+        if (len(fields) > 5) and (fields[0] == username):
+            f.close()
+            return int(fields[2]),int(fields[3]),fields[5]
+    f.close()
+    raise KeyError("User {:s} doesn't exist in {:s}".format(username,root))
+
+
+def bind(root,path,read_only = False):
+
+    pos = path.find(":")
+    if pos == -1:
+        source = path
+        destination = path
+    else:
+        source = path[:pos]
+        destination = path[pos+1:]
+    destination = os.path.join(root,destination.lstrip("/"))
+    if not os.path.exists(destination):
+        if os.path.isdir(source):
+            os.makedirs(destination)
+        else:
+            open(destination,"a").close()
+    mount(source,destination,None,MS_BIND | MS_REC)
+    if read_only:
+        mount(None,destination,None,MS_BIND | MS_REC | MS_RDONLY | MS_REMOUNT)
+
+
+def prepare_root(root,binds):
+
+    """ Mounts the virtual filesystems inside the chroot environment. This is done inside the new
+        mount namespace, so everything is unmounted automatically when the command ends """
+
+    for folder in ["proc","sys","dev"]:
+        path = os.path.join(root,folder)
+        if not os.path.exists(path):
+            os.makedirs(path)
+    mount("proc",os.path.join(root,"proc"),"proc",MS_NOSUID | MS_NODEV | MS_NOEXEC)
+    mount("/sys",os.path.join(root,"sys"),None,MS_BIND | MS_REC)
+    mount("/dev",os.path.join(root,"dev"),None,MS_BIND | MS_REC)
+    for path,read_only in binds:
+        bind(root,path,read_only)
+
+
+def run_child(root,personality,username,environment,binds,command):
+
+    prepare_root(root,binds)
+    socket.sethostname(os.path.basename(root.rstrip("/"))[:64])
+    check_error(libc.personality(PER_LINUX32 if personality == "x86" else PER_LINUX),"personality")
+
+    if username != None:
+        uid,gid,home = get_user(root,username)
+    else:
+        uid,gid,home = 0,0,"/root"
+
+    os.chroot(root)
+    os.chdir("/")
+
+    env = {"PATH":"/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin",
+           "HOME":home,
+           "USER":username if username != None else "root",
+           "LOGNAME":username if username != None else "root",
+           "container":"multipackager"}
+    if "TERM" in os.environ:
+        env["TERM"] = os.environ["TERM"]
+    env.update(environment)
+
+    if uid != 0:
+        os.setgroups([gid])
+        os.setgid(gid)
+        os.setuid(uid)
+
+    # os.execvpe() can't be used because it imports modules, and the python library isn't available after the chroot
+    executable = command[0]
+    if executable.find("/") == -1:
+        for path in env["PATH"].split(":"):
+            if os.access(os.path.join(path,executable),os.X_OK):
+                executable = os.path.join(path,executable)
+                break
+    os.execve(executable,command,env)
+
+
+def main(argv):
+
+    root = None
+    personality = "x86-64"
+    username = None
+    environment = {}
+    binds = []
+
+    pos = 0
+    while (pos < len(argv)) and (argv[pos] != "--"):
+        param = argv[pos]
+        if param.startswith("--root="):
+            root = param[7:]
+        elif param.startswith("--personality="):
+            personality = param[14:]
+        elif param.startswith("--user="):
+            username = param[7:]
+        elif param.startswith("--setenv="):
+            variable,value = param[9:].split("=",1)
+            environment[variable] = value
+        pos += 1
+    command = argv[pos+1:]
+
+    # the same --bind parameters than systemd-nspawn are accepted before the command
+    while (len(command) != 0) and (command[0].startswith("--bind")):
+        if command[0].startswith("--bind="):
+            binds.append((command[0][7:],False))
+        elif command[0].startswith("--bind-ro="):
+            binds.append((command[0][10:],True))
+        command = command[1:]
+
+    if (root == None) or (len(command) == 0):
+        print("Usage: namespace_helper.py --root=path --personality={x86|x86-64} [--user=name] [--setenv=VAR=value]... -- command")
+        return 1
+
+    root = os.path.abspath(root)
+
+    unshare(CLONE_NEWNS | CLONE_NEWUTS | CLONE_NEWIPC | CLONE_NEWPID)
+    # don't propagate our mounts to the host
+    mount(None,"/",None,MS_REC | MS_PRIVATE)
+
+    # the first child is the PID 1 of the new PID namespace
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_child(root,personality,username,environment,binds,command)
+        except Exception as e:
+            sys.stderr.write("{:s}\n".format(str(e)))
+        os._exit(127)
+
+    # the signals sent by the terminal arrive also to the child, so let it manage them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGQUIT, signal.SIG_IGN)
+    pid,status = os.waitpid(pid,0)
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import stat
+import shutil
+import errno
+import threading
+import concurrent.futures
+
+# extended attributes used internally by OverlayFS, which must not be copied to the final folder
+OVERLAY_XATTR_PREFIXES = ("trusted.overlay.", "user.overlay.")
+
+# copy_file_range() is only available in Python 3.8 or later, and only in Linux
+HAS_COPY_FILE_RANGE = hasattr(os,"copy_file_range")
+
+
+class overlay_merge(object):
+
+    """ Commits the upper folder of an OverlayFS into its lower folder, once unmounted. Whiteouts
+        delete the lower element, opaque folders replace the lower one, and the other elements
+        are moved with rename(), copying them only if they are in a different filesystem. Each
+        folder is processed as an independent task in a pool of threads """
+
+    def __init__(self, workers = 4):
+
+        self.workers = max(1,workers)
+        self.files = 0
+        self.bytes = 0
+        self.errors = []
+        self.directories = []
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.pool = None
+
+
+    def is_whiteout(self,status):
+
+        return stat.S_ISCHR(status.st_mode) and (status.st_rdev == 0)
+
+
+    def get_overlay_xattr(self,path,name):
+
+        for prefix in OVERLAY_XATTR_PREFIXES:
+            try:
+                return os.getxattr(path,prefix+name,follow_symlinks=False)
+            except OSError:
+                pass
+        return None
+
+
+    def is_opaque(self,path):
+
+        return self.get_overlay_xattr(path,"opaque") == b"y"
+
+
+    def remove_overlay_xattrs(self,path):
+
+        try:
+            names = os.listxattr(path,follow_symlinks=False)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(OVERLAY_XATTR_PREFIXES):
+                try:
+                    os.removexattr(path,name,follow_symlinks=False)
+                except OSError:
+                    pass
+
+
+    def copy_xattrs(self,origin,destination):
+
+        try:
+            names = os.listxattr(origin,follow_symlinks=False)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(OVERLAY_XATTR_PREFIXES):
+                continue
+            try:
+                os.setxattr(destination,name,os.getxattr(origin,name,follow_symlinks=False),follow_symlinks=False)
+            except OSError:
+                pass
+
+
+    def copy_metadata(self,origin,destination,status):
+
+        """ Copies the ownership, permissions and extended attributes (the times are set later) """
+
+        os.chown(destination,status.st_uid,status.st_gid,follow_symlinks=False)
+        if not stat.S_ISLNK(status.st_mode):
+            os.chmod(destination,stat.S_IMODE(status.st_mode))
+        self.copy_xattrs(origin,destination)
+
+
+    def delete(self,path):
+
+        status = os.lstat(path)
+        if stat.S_ISDIR(status.st_mode):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+    def copy_file(self,origin,destination,status):
+
+        """ Copies an element when it can't be moved because it is in another filesystem """
+
+        if stat.S_ISLNK(status.st_mode):
+            os.symlink(os.readlink(origin),destination)
+        elif stat.S_ISREG(status.st_mode):
+            with open(origin,"rb") as fin, open(destination,"wb") as fout:
+                remaining = status.st_size
+                try:
+                    while HAS_COPY_FILE_RANGE and (remaining > 0):
+                        copied = os.copy_file_range(fin.fileno(),fout.fileno(),remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                except OSError:
+                    pass # copy_file_range isn't supported between these filesystems
+                if remaining > 0:
+                    fin.seek(status.st_size - remaining)
+                    fout.seek(status.st_size - remaining)
+                    shutil.copyfileobj(fin,fout,1048576)
+        elif stat.S_ISDIR(status.st_mode):
+            os.mkdir(destination)
+            for entry in os.scandir(origin):
+                self.copy_file(entry.path,os.path.join(destination,entry.name),entry.stat(follow_symlinks=False))
+        else:
+            os.mknod(destination,status.st_mode,status.st_rdev)
+        self.copy_metadata(origin,destination,status)
+        os.utime(destination,ns=(status.st_atime_ns,status.st_mtime_ns),follow_symlinks=False)
+
+
+    def copy_over(self,origin,destination,status):
+
+        """ Copies an element over destination. It is copied first into a temporary sibling and then renamed,
+            so an existing element is replaced as a whole, and a symlink there is never followed """
+
+        temporary = os.path.join(os.path.dirname(destination),".multipackager_merge.tmp")
+        if os.path.lexists(temporary):
+            self.delete(temporary)
+        try:
+            self.copy_file(origin,temporary,status)
+            os.rename(temporary,destination)
+        except:
+            if os.path.lexists(temporary):
+                self.delete(temporary)
+            raise
+
+
+    def count(self,path,status):
+
+        """ Returns the number of files and bytes in an element moved as a whole. Any whiteout inside
+            is removed, because there is nothing below a new folder to hide """
+
+        if not stat.S_ISDIR(status.st_mode):
+            return 1,status.st_size
+        files = 0
+        size = 0
+        for entry in os.scandir(path):
+            estatus = entry.stat(follow_symlinks=False)
+            if self.is_whiteout(estatus):
+                os.remove(entry.path)
+                continue
+            f,s = self.count(entry.path,estatus)
+            files += f
+            size += s
+        return files,size
+
+
+    def move(self,origin,destination,status):
+
+        try:
+            os.rename(origin,destination)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            self.copy_over(origin,destination,status)
+        if stat.S_ISDIR(status.st_mode):
+            self.remove_overlay_xattrs(destination)
+        files,size = self.count(destination,status)
+        with self.condition:
+            self.files += files
+            self.bytes += size
+
+
+    def merge_directory(self,path,overlay_path):
+
+        for entry in os.scandir(overlay_path):
+            final_file = entry.path
+            original_file = os.path.join(path,entry.name)
+            status = entry.stat(follow_symlinks=False)
+
+            # a whiteout means that the original file/folder must be deleted
+            if self.is_whiteout(status):
+                if os.path.lexists(original_file):
+                    self.delete(original_file)
+                continue
+
+            try:
+                ostatus = os.lstat(original_file)
+            except FileNotFoundError:
+                ostatus = None
+
+            if not stat.S_ISDIR(status.st_mode):
+                # rename() replaces atomically any file, but not a folder
+                if (ostatus != None) and stat.S_ISDIR(ostatus.st_mode):
+                    shutil.rmtree(original_file)
+                self.move(final_file,original_file,status)
+                continue
+
+            # an opaque folder hides all the contents of the original one
+            if (ostatus != None) and ((not stat.S_ISDIR(ostatus.st_mode)) or self.is_opaque(final_file)):
+                self.delete(original_file)
+                ostatus = None
+
+            # a new folder is moved as a whole
+            if ostatus == None:
+                self.move(final_file,original_file,status)
+                continue
+
+            # both elements are folders, so let's check them recursively
+            self.copy_metadata(final_file,original_file,status)
+            with self.condition:
+                self.directories.append((original_file,status))
+            self.submit(original_file,final_file)
+
+
+    def run_task(self,path,overlay_path):
+
+        try:
+            self.merge_directory(path,overlay_path)
+        except Exception as e:
+            with self.condition:
+                self.errors.append("{:s}: {:s}".format(overlay_path,str(e)))
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
+
+
+    def submit(self,path,overlay_path):
+
+        with self.condition:
+            self.pending += 1
+        self.pool.submit(self.run_task,path,overlay_path)
+
+
+    def merge(self,path,overlay_path):
+
+        """ Merges overlay_path into path. Returns True if there were errors """
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = self.workers)
+        self.submit(path,overlay_path)
+        with self.condition:
+            while self.pending != 0:
+                self.condition.wait()
+        self.pool.shutdown()
+        self.pool = None
+
+        # the modification times of the folders are set at the end, because merging their contents changes them
+        self.directories.sort(key = lambda d: len(d[0]), reverse = True)
+        for directory,status in self.directories:
+            try:
+                os.utime(directory,ns=(status.st_atime_ns,status.st_mtime_ns))
+            except OSError:
+                pass
+
+        for error in self.errors:
+            print(error)
+        return len(self.errors) != 0
@@ -24,6 +24,24 @@ import shutil
 import re
 import functools
 import stat
+import contextlib
+import hashlib
+import time
+import threading
+import multipackager_module.chroot_session
+import multipackager_module.runners
+import multipackager_module.overlay_merge
+import multipackager_module.storage
+import multipackager_module.package_pool
+import multipackager_module.package_database
+
+# file, inside each CHROOT environment, with the time when its package metadata was refreshed
+METADATA_STAMP = os.path.join("var","lib","multipackager","metadata_refreshed")
+
+# dependency layers used by the working copies of the targets being built, with how many use each one
+layers_in_use = {}
+layers_lock = threading.Lock()
+
 
 def call_with_cache(func):
 
@@ -38,14 +56,10 @@ def call_with_cache(func):
         work_path = path+".work"
 
         print(_("Sanitary umount, to ensure that there aren't old mounting points"))
+        if self.discard_overlay(mount_path,overlay_path,work_path):
+            return True # error!!!
 
-        self.run_external_program("umount {:s}".format(mount_path))
         print(_("Mounting overlayfs for {:s} at {:s}, using {:s} for new files").format(path,mount_path,overlay_path))
-
-        # remove data inside destination path
-        shutil.rmtree(overlay_path, ignore_errors=True)
-        shutil.rmtree(mount_path, ignore_errors=True)
-        shutil.rmtree(work_path, ignore_errors=True)
         try:
             os.mkdir(overlay_path)
         except:
@@ -70,18 +84,20 @@ def call_with_cache(func):
                 args2.append(args[a])
 
         try:
-            retval = func(*args2)
+            with self.chroot_session(mount_path):
+                retval = func(*args2)
         except:
-            retval = true
+            retval = True
 
-        self.run_external_program("umount {:s}".format(mount_path))
+        if self.umount_path(mount_path):
+            return True # error!!! The changes can't be merged while the overlay is mounted
+        self.last_merge = (0,0)
         if (not retval):
             print(_("Mixing file systems"))
-            self.merge_overlay(path,overlay_path)
+            if self.merge_overlay(path,overlay_path):
+                retval = True
 
-        shutil.rmtree(overlay_path, ignore_errors=True)
-        shutil.rmtree(mount_path, ignore_errors=True)
-        shutil.rmtree(work_path, ignore_errors=True)
+        self.discard_overlay(mount_path,overlay_path,work_path)
         os.sync() # sync disks
 
         return retval
@@ -105,39 +121,13 @@ class package_base(object):
 
     def merge_overlay(self,path,overlay_path):
 
-        for f in os.listdir(overlay_path):
-            original_file = os.path.join(path,f)
-            final_file = os.path.join(overlay_path,f)
-            status = os.lstat(final_file)
-
-            # if it is a character device with 0 as major number, the original file/folder must be deleted
-            if (stat.S_ISCHR(status.st_mode) is True) and (os.major(status.st_rdev) == 0):
-                self.full_delete(original_file)
-                continue
-
-            # if it is a newly created file or folder, we just move it. That way it is faster and everything is preserved
-            if os.path.exists(original_file) is False:
-                self.run_external_program('mv "{:s}" "{:s}"'.format(final_file,original_file), False)
-                continue
-
-            ostatus = os.lstat(original_file)
-            # if it is a file, just copy it and overwrite
-            if (stat.S_ISDIR(status.st_mode) is False):
-                self.full_delete(original_file)
-                self.run_external_program('cp -a "{:s}" "{:s}"'.format(final_file,original_file), False)
-                continue
-
-            # if the new element is a folder, but the old is a file, delete the file and move the folder
-            if (stat.S_ISDIR(ostatus.st_mode) is False):
-                self.full_delete(original_file)
-                self.run_external_program('mv "{:s}" "{:s}"'.format(final_file,original_file), False)
-                continue
+        """ Moves the changes stored in the upper folder of an overlay into its lower folder """
 
-            # if we reach here, both elements are folders, so let's check them recursively
-            shutil.copystat(final_file,original_file) # set permission bits
-            if (status.st_uid != ostatus.st_uid) or (status.st_gid != ostatus.st_gid):
-                shutil.chown(original_file,status.st_uid,status.st_gid)
-            self.merge_overlay(original_file,final_file)
+        merger = multipackager_module.overlay_merge.overlay_merge(min(8,self.configuration.cpus))
+        retval = merger.merge(path,overlay_path)
+        self.last_merge = (merger.files,merger.bytes)
+        print(_("Merged {:d} files ({:d} bytes) into {:s}").format(merger.files,merger.bytes,path))
+        return retval
 
 
     def __init__(self, configuration, distro_type, distro_name, architecture, cache_name = None):
@@ -153,9 +143,13 @@ class package_base(object):
         self.python2 = False
         self.distro_full_name = "{:s} {:s} {:s}".format(distro_type,distro_name,architecture)
         self.program_size = 0
+        # number of CPUs available for compiling this target
+        self.cpus = self.configuration.cpus
 
         # name of the CHROOT environment to use
         self.base_chroot_name = self.distro_type+"_chroot_"+self.distro_name+"_"+self.architecture
+        # name of the working copy; must be unique when several targets are built at the same time
+        self.workspace_name = self.base_chroot_name
         # path to the origin CHROOT environment to use (the one with only the base system)
         self.base_cache_path = os.path.join(self.configuration.cache_path,self.base_chroot_name)
 
@@ -165,12 +159,20 @@ class package_base(object):
         else:
             self.chroot_name = self.base_chroot_name
 
+        # file with the generation number of the caches; it changes every time they are created or updated
+        self.generation_path = os.path.join(self.configuration.cache_path,self.base_chroot_name+".generation")
+
         # path of the base CHROOT enviromnent to use (the one which will be copied to the final one)
         self.base_path = os.path.join(self.configuration.cache_path,self.chroot_name)
 
         if (self.base_path[-1] == os.path.sep):
             self.base_path = self.base_path[:-1] # remove the last "/" if it exists
 
+        # path of the overlay layers with the dependencies installed over base_path; there is one for each set of dependencies
+        self.layers_path = os.path.join(self.configuration.cache_path,"layers",self.chroot_name)
+        # layer with the dependencies for the current project
+        self.dependency_layer = None
+
         # path of the working copy, where the project has been copied for being build
         self.working_path = None
 
@@ -184,23 +186,262 @@ class package_base(object):
         self.upper_path = None
         self.overlay_path = None
 
+        # how to copy and delete the CHROOT environments in the cache path
+        self.storage = multipackager_module.storage.get_storage(self.configuration.cache_path,self.configuration.storage,self.run_storage_program)
+
+        # shared cache of downloaded packages
+        self.package_pool = multipackager_module.package_pool.package_pool(os.path.join(self.configuration.cache_path,"pool"),self.configuration.package_pool_size * 1048576)
+
+        # phase of the build being done now, and the profiler measuring it
+        self.current_phase = None
+        self.profiler = None
+
+        # containers kept running to launch several commands inside, indexed by their path
+        self.sessions = {}
+
+        # number of files and bytes merged into a cache by the last call_with_cache
+        self.last_merge = (0,0)
+
+        # number of packages installed, removed or upgraded by the last update_environment, or None if unknown
+        self.changed_packages = None
+
+
+    def get_lock_keys(self):
+
+        """ Returns the paths shared with other targets. Two targets with a common key are never built at the same time """
+
+        return [self.base_path, self.base_cache_path]
+
+
+    def get_cache_generation(self):
+
+        try:
+            f = open(self.generation_path,"r")
+            generation = int(f.read().strip())
+            f.close()
+        except:
+            generation = 0
+        return generation
+
+
+    def bump_cache_generation(self):
+
+        generation = self.get_cache_generation() + 1
+        try:
+            f = open(self.generation_path+".tmp","w")
+            f.write("{:d}\n".format(generation))
+            f.close()
+            os.rename(self.generation_path+".tmp",self.generation_path)
+        except:
+            pass
+        return generation
+
+
+    def get_metadata_age(self,path):
+
+        """ Returns the seconds passed since the package metadata of the CHROOT environment at path was
+            refreshed, or None if it is unknown. The time is stored inside the environment, so the
+            overlays and copies made from it inherit it """
+
+        try:
+            f = open(os.path.join(path,METADATA_STAMP),"r")
+            refreshed = float(f.read().strip())
+            f.close()
+        except:
+            return None
+        age = time.time() - refreshed
+        if age < 0:
+            return None # the clock changed
+        return age
+
+
+    def mark_metadata_refreshed(self,path):
+
+        stamp_path = os.path.join(path,METADATA_STAMP)
+        try:
+            if not os.path.exists(os.path.dirname(stamp_path)):
+                os.makedirs(os.path.dirname(stamp_path))
+            f = open(stamp_path,"w")
+            f.write("{:f}\n".format(time.time()))
+            f.close()
+        except:
+            pass
+
+
+    def refresh_metadata(self,path,command,force = False):
+
+        """ Runs command to refresh the package metadata of the CHROOT environment at path, unless it was
+            refreshed less than metadata_ttl minutes ago. Only the 'update' command should force it """
+
+        if not force:
+            age = self.get_metadata_age(path)
+            if (age != None) and (age < self.configuration.metadata_ttl * 60):
+                print(_("The package metadata of {:s} was refreshed {:d} minutes ago; not refreshing it").format(self.chroot_name,int(age / 60)))
+                self.link_pooled_packages(path)
+                return 0
+        retval = self.run_chroot(path,command)
+        if retval == 0:
+            self.mark_metadata_refreshed(path)
+            self.link_pooled_packages(path)
+        return retval
+
+
+    def get_dependency_list(self,project_path):
+
+        """ Returns the list of dependencies declared by the project, without installing them, or None if there is an error """
+
+        return []
+
+
+    def get_package_database_type(self):
+
+        """ Returns the kind of database of installed packages used by the distro (see package_database.readers) """
+
+        return None
+
+
+    def get_installed_packages(self):
+
+        """ Returns the package_database with the packages installed in base_path, or None if it can't be read """
+
+        kind = self.get_package_database_type()
+        if kind == None:
+            return None
+        return multipackager_module.package_database.get_database(self.base_path,kind,self.get_cache_generation())
+
+
+    def get_installed_versions(self):
+
+        """ Returns a dictionary with the version of each package installed in base_path, or None if they can't be read """
+
+        database = self.get_installed_packages()
+        if database == None:
+            return None
+        return dict(database.packages)
+
+
+    def get_dependency_names(self,dependency):
+
+        """ Returns the package names in a dependency, as returned by get_dependency_list, without the versions """
+
+        names = []
+        for alternative in re.split(r"[|,]",dependency):
+            match = re.match(r"\s*([^\s<>=|,:]+)",alternative)
+            if match != None:
+                names.append(match.group(1))
+        return names
+
+
+    def get_dependency_version(self,installed,name):
+
+        """ Returns the version of the package that will be used for a dependency, or None if it isn't known """
+
+        if installed == None:
+            return None
+        return installed.get_version(name)
+
+
+    def get_dependency_versions(self,dependencies):
+
+        """ Returns the versions of the packages that will be used for the dependencies, to know when
+            they have changed even if the cache hasn't been updated """
+
+        installed = self.get_installed_packages()
+        versions = []
+        for dependency in dependencies:
+            for name in self.get_dependency_names(dependency):
+                version = self.get_dependency_version(installed,name)
+                versions.append("{:s}={:s}".format(name,version if version != None else ""))
+        return versions
+
+
+    def remove_installed_dependencies(self,dependencies):
+
+        """ Returns the dependencies that aren't already installed in base_path, keeping the ones that can't be checked """
+
+        database = self.get_installed_packages()
+        if database == None:
+            return dependencies
+        pending = []
+        for dependency in dependencies:
+            if not database.is_satisfied(dependency):
+                pending.append(dependency)
+        if len(pending) != len(dependencies):
+            print(_("{:d} dependencies are already installed in {:s}").format(len(dependencies) - len(pending),self.chroot_name))
+        return pending
+
+
+    def get_mount_points(self,path):
+
+        """ Returns the mount points at path or inside it, the deepest first """
+
+        mount_points = []
+        path = os.path.abspath(path)
+        try:
+            f = open("/proc/self/mountinfo","r")
+        except:
+            return mount_points
+        for line in f:
+            fields = line.split(" ")
+            if len(fields) < 5:
+                continue
+            # spaces and other special characters are stored in octal
+            mount_point = re.sub("\\\\([0-7]{3})", lambda m: chr(int(m.group(1),8)), fields[4])
+            if (mount_point == path) or (mount_point.startswith(path+os.path.sep)):
+                mount_points.append(mount_point)
+        f.close()
+        mount_points.sort(key = len, reverse = True)
+        return mount_points
+
+
+    def umount_path(self,path):
+
+        """ Unmounts path and everything mounted inside it, including stale mounts left by
+            crashed runs. Returns True if something is still mounted """
+
+        for mount_point in self.get_mount_points(path):
+            if 0 != self.run_external_program('umount "{:s}"'.format(mount_point)):
+                # the mount point is busy; detach it, so it will be freed when no longer used
+                self.run_external_program('umount -l "{:s}"'.format(mount_point))
+
+        if len(self.get_mount_points(path)) != 0:
+            print(_("Can't umount {:s}").format(path))
+            return True
+        return False
+
+
+    def discard_overlay(self,mount_path,upper_path,work_path):
+
+        """ Removes an overlay without walking the merged tree: it is unmounted first, so only the
+            files in the upper and work folders (the ones changed) must be deleted """
+
+        if self.umount_path(mount_path):
+            return True # error!!! deleting it now would write a whiteout for each file
+        shutil.rmtree(mount_path, ignore_errors=True) # now it is empty, or a plain folder
+        if upper_path != None:
+            shutil.rmtree(upper_path, ignore_errors=True)
+        if work_path != None:
+            shutil.rmtree(work_path, ignore_errors=True)
+        return False
+
 
     def cleanup(self):
 
+        self.store_downloaded_packages()
         if self.working_path != None:
-            shutil.rmtree(self.working_path, ignore_errors=True)
             if self.used_overlay:
-                self.run_external_program('umount "{:s}"'.format(self.working_path))
+                if self.discard_overlay(self.working_path,self.upper_path,self.overlay_path):
+                    return True
                 self.used_overlay = False
-        if self.upper_path != None:
-            shutil.rmtree(self.upper_path, ignore_errors=True)
-            self.upper_path = None
-        if self.overlay_path != None:
-            shutil.rmtree(self.overlay_path, ignore_errors=True)
-            self.overlay_path = None
+            else:
+                self.storage.delete(self.working_path)
+        self.upper_path = None
+        self.overlay_path = None
+        self.set_dependency_layer(None)
 
         return False
 
+
     def install_local_package(self,file_path):
 
         shutil.copy(file_path,self.working_path)
@@ -215,15 +456,12 @@ class package_base(object):
         if (os.path.exists(destination_path)) and (force_delete == False):
             return False # don't delete it
 
-        # Create the destination folder and all the previous folders, if needed
-        if not os.path.exists(destination_path):
-            os.makedirs(destination_path)
-
         # remove data inside destination path
-        shutil.rmtree(destination_path, ignore_errors=True)
+        self.storage.delete(destination_path)
 
         # copy the base system to the path where we want to work with to generate the package
-        if (0 != self.run_external_program("cp -a {:s} {:s}".format(origin_path,destination_path))):
+        print(_("Copying {:s} to {:s} ({:s} storage)").format(origin_path,destination_path,self.storage.name))
+        if self.storage.clone(origin_path,destination_path):
             return True # error!!!
 
         return False
@@ -248,38 +486,230 @@ class package_base(object):
                 print(_("Failed to initializate environment for {:s}").format(self.base_chroot_name))
                 return True # error!!!
             self.add_dns(self.base_cache_path)
+            self.bump_cache_generation()
+            self.store_downloaded_packages()
 
         if not os.path.exists(self.base_path):
             if self.copy_cache(self.base_cache_path,self.base_path):
                 print(_("Failed to initializate environment for {:s}").format(self.base_chroot_name))
                 return True # error!!!
+            self.bump_cache_generation()
+
+        if self.package_pool.enabled():
+            self.configure_package_cache(self.base_cache_path)
+            self.configure_package_cache(self.base_path)
 
         return False
 
 
+    def get_package_cache_folder(self):
+
+        """ Returns the folder, inside the CHROOT environment, where the package manager stores the downloaded packages """
+
+        return None
+
+
+    def configure_package_cache(self,path):
+
+        """ Configures the package manager of the CHROOT environment at path to keep the downloaded packages """
+
+        return
+
+
+    def get_package_cache_view(self):
+
+        """ Returns the folder of the package pool used as package cache for this environment, or None if the pool isn't used """
+
+        if (not self.package_pool.enabled()) or (self.get_package_cache_folder() == None):
+            return None
+        return self.package_pool.get_view_path(self.base_chroot_name)
+
+
+    def get_binds(self):
+
+        """ Returns the host folders to mount inside the containers """
+
+        view_path = self.get_package_cache_view()
+        if view_path == None:
+            return None
+        return ["{:s}:{:s}".format(view_path,self.get_package_cache_folder())]
+
+
+    def get_repository_checksums(self,path):
+
+        """ Returns the name that the package manager of the CHROOT environment at path gives to each package file
+            in its cache, indexed by its sha256, read from the repository metadata; or None if it isn't known """
+
+        return None
+
+
+    def link_pooled_packages(self,path):
+
+        """ Links into the package cache the packages already in the pool that are in the repositories,
+            so the package manager doesn't download them again """
+
+        view_path = self.get_package_cache_view()
+        if view_path == None:
+            return
+        archives = self.get_repository_checksums(path)
+        if (archives == None) or (len(archives) == 0):
+            return
+        linked = self.package_pool.link_objects(view_path,archives)
+        if linked != 0:
+            print(_("Package pool: {:d} packages reused").format(linked))
+
+
+    def store_downloaded_packages(self):
+
+        view_path = self.get_package_cache_view()
+        if view_path == None:
+            return
+        new_packages,duplicated = self.package_pool.ingest(view_path)
+        if (new_packages != 0) or (duplicated != 0):
+            print(_("Package pool: {:d} new packages, {:d} already stored").format(new_packages,duplicated))
+
+
     def install_postdependencies(self,project_path):
         return False
 
 
+    def install_dependencies_layer(self,dependencies):
+
+        """ Ensures that there is a layer with the dependencies installed over the builder cache, and
+            uses it for the working copy. Each set of dependencies has its own layer, so if it already
+            exists, there is no need of installing anything """
+
+        hasher = hashlib.sha256()
+        hasher.update("{:d}\0".format(self.get_cache_generation()).encode("utf-8"))
+        for dependency in sorted(set(dependencies)):
+            hasher.update("{:s}\0".format(dependency).encode("utf-8"))
+        layer_path = os.path.join(self.layers_path,hasher.hexdigest()[:16])
+
+        if os.path.exists(layer_path):
+            print(_("Using the cached dependencies at {:s}").format(layer_path))
+            os.utime(layer_path) # mark it as recently used
+            self.set_dependency_layer(layer_path)
+            return False
+
+        upper_path = layer_path+".tmp"
+        mount_path = layer_path+".mount"
+        work_path = layer_path+".work"
+        if self.discard_overlay(mount_path,upper_path,work_path):
+            return True # error!!!
+        os.makedirs(upper_path)
+        os.makedirs(mount_path)
+        os.makedirs(work_path)
+
+        if (0 != self.run_external_program('mount -t overlay -o rw,lowerdir="{:s}",upperdir="{:s}",workdir="{:s}" overlay "{:s}"'.format(self.base_path,upper_path,work_path,mount_path))):
+            self.discard_overlay(mount_path,upper_path,work_path)
+            return True # error!!!
+
+        with self.chroot_session(mount_path):
+            retval = self.install_dependencies_full(mount_path,dependencies)
+        self.store_downloaded_packages()
+
+        if self.umount_path(mount_path) or retval:
+            self.discard_overlay(mount_path,upper_path,work_path)
+            return True # error!!!
+
+        # the upper folder, with its whiteouts, is used as-is as a lower layer for the working copy
+        os.rename(upper_path,layer_path)
+        self.discard_overlay(mount_path,None,work_path)
+        self.set_dependency_layer(layer_path)
+        self.evict_layers()
+        return False
+
+
+    def set_dependency_layer(self,layer_path):
+
+        """ Sets the dependency layer used by the working copy, marking it as in use so it isn't evicted """
+
+        with layers_lock:
+            if self.dependency_layer != None:
+                layers_in_use[self.dependency_layer] -= 1
+                if layers_in_use[self.dependency_layer] == 0:
+                    del layers_in_use[self.dependency_layer]
+            if layer_path != None:
+                layers_in_use[layer_path] = layers_in_use.get(layer_path,0) + 1
+        self.dependency_layer = layer_path
+
+
+    def get_mounted_layers(self):
+
+        """ Returns the folders used as lower layers by the overlays mounted now, including the ones left
+            by --noclean or by other instances of multipackager """
+
+        layers = set()
+        try:
+            f = open("/proc/mounts","r")
+            lines = f.readlines()
+            f.close()
+        except OSError:
+            return layers
+        for line in lines:
+            fields = line.split()
+            if (len(fields) < 4) or (fields[2] != "overlay"):
+                continue
+            for option in fields[3].split(","):
+                if option.startswith("lowerdir="):
+                    option = option[9:]
+                elif option.startswith("lowerdir+="):
+                    option = option[10:]
+                else:
+                    continue
+                for folder in option.split(":"):
+                    if folder != "":
+                        layers.add(folder.replace("\\040"," "))
+        return layers
+
+
+    def evict_layers(self):
+
+        """ Removes the least recently used dependency layers, except the ones being used """
+
+        mounted = self.get_mounted_layers()
+        layers = []
+        for layer in os.listdir(self.layers_path):
+            layer_path = os.path.join(self.layers_path,layer)
+            if layer.find(".") != -1:
+                continue
+            with layers_lock:
+                in_use = layer_path in layers_in_use
+            if in_use or (os.path.realpath(layer_path) in mounted):
+                continue
+            layers.append((os.stat(layer_path).st_mtime,layer_path))
+        layers.sort(reverse = True)
+        for mtime,layer_path in layers[max(0,self.configuration.dependency_layers-1):]:
+            print(_("Removing the cached dependencies at {:s}").format(layer_path))
+            shutil.rmtree(layer_path, ignore_errors=True)
+
+
+    def clear_layers(self):
+
+        shutil.rmtree(self.layers_path, ignore_errors=True)
+
+
     def prepare_working_path_overlay(self):
 
         """ Creates an overlay of the chroot environment to keep the original untouched. """
 
-        self.working_path = os.path.join(self.configuration.working_path,self.base_chroot_name)
+        self.working_path = os.path.join(self.configuration.working_path,self.workspace_name)
         self.upper_path = self.working_path+".upper"
         self.overlay_path = self.working_path+".overlay"
         original_path = self.base_path
         self.used_overlay = True
 
-        self.run_external_program('umount {:s}'.format(self.working_path))
+        if self.discard_overlay(self.working_path,self.upper_path,self.overlay_path):
+            print(_("Failed to create the working environment at {:s} from {:s}").format(self.working_path,original_path))
+            return True # error!!!
 
-        shutil.rmtree(self.working_path, ignore_errors=True)
-        shutil.rmtree(self.upper_path, ignore_errors=True)
-        shutil.rmtree(self.overlay_path, ignore_errors=True)
         os.mkdir(self.upper_path)
         os.mkdir(self.overlay_path)
         os.mkdir(self.working_path)
 
+        if self.dependency_layer != None:
+            original_path = self.dependency_layer+":"+original_path
+
         if (0 != self.run_external_program('mount -t overlay -o rw,lowerdir="{:s}",upperdir="{:s}",workdir="{:s}" overlay "{:s}"'.format(original_path,self.upper_path,self.overlay_path,self.working_path))):
             print(_("Failed to create the working environment at {:s} from {:s}").format(self.working_path,original_path))
             return True # error!!!
@@ -300,14 +730,14 @@ class package_base(object):
         self.used_overlay = False
 
         if final_path == None:
-            self.working_path = os.path.join(self.configuration.working_path,self.base_chroot_name)
+            self.working_path = os.path.join(self.configuration.working_path,self.workspace_name)
             original_path = self.base_path
         else:
             self.working_path = final_path
             original_path = self.base_cache_path
 
-        shutil.rmtree(self.working_path, ignore_errors=True)
-        if (0 != self.run_external_program("cp -a {:s} {:s}".format(original_path,self.working_path))): # copy the base system to the path where we want to work with to generate the package
+        self.storage.delete(self.working_path)
+        if self.storage.clone(original_path,self.working_path): # copy the base system to the path where we want to work with to generate the package
             print(_("Failed to create the working environment at {:s} from {:s}").format(self.working_path,original_path))
             return True # error!!!
 
@@ -320,17 +750,31 @@ class package_base(object):
         """ Ensures that the environment is updated with the last packages """
 
         print(_("Updating {:s}").format(self.base_chroot_name))
+        before = self.get_installed_versions()
         self.update(self.base_cache_path)
-        return self.update(self.base_path)
+        retval = self.update(self.base_path)
+        self.bump_cache_generation()
+        after = self.get_installed_versions()
+        if (before == None) or (after == None):
+            self.changed_packages = None
+        else:
+            self.changed_packages = len([name for name in set(before) | set(after) if before.get(name) != after.get(name)])
+        self.store_downloaded_packages()
+        # the dependency layers were built over the old cache
+        self.clear_layers()
+        return retval
 
 
     def clear_cache(self):
 
         if os.path.exists(self.base_path):
-            shutil.rmtree(self.base_path, ignore_errors = True)
+            self.storage.delete(self.base_path)
 
         if os.path.exists(self.base_cache_path):
-            shutil.rmtree(self.base_cache_path, ignore_errors = True)
+            self.storage.delete(self.base_cache_path)
+
+        self.clear_layers()
+        self.bump_cache_generation()
 
 
     def get_project_size(self):
@@ -341,7 +785,7 @@ class package_base(object):
         final_path = os.path.join(self.working_path,"install_root")
         for dirname, dirnames, filenames in os.walk(final_path):
             for filename in filenames:
-                sum += os.path.getsize(os.path.join(dirname,filename))
+                sum += os.lstat(os.path.join(dirname,filename)).st_size # dangling symlinks must not fail
 
         self.program_size = sum
         print("Tamano: {%s}" % sum)
@@ -407,9 +851,18 @@ class package_base(object):
         return False
 
 
+    def get_build_environment(self,cpus = None):
+
+        """ Returns the environment variables that pass the CPU budget (by default, the whole one of the target) to the build systems """
+
+        if cpus == None:
+            cpus = self.cpus
+        return {"MAKEFLAGS":"-j{:d}".format(cpus), "CMAKE_BUILD_PARALLEL_LEVEL":str(cpus), "DEB_BUILD_OPTIONS":"parallel={:d}".format(cpus)}
+
+
     def build_multipackager(self,filename):
 
-        return self.run_chroot(self.working_path, 'bash -c "cd /project && source {:s} /install_root"'.format(filename))
+        return self.run_chroot(self.working_path, 'bash -c "cd /project && source {:s} /install_root"'.format(filename), environment = self.get_build_environment())
 
 
     def build_cmake(self):
@@ -420,9 +873,9 @@ class package_base(object):
         os.makedirs(install_path)
 
         if self.install_at_lib:
-            return self.run_chroot(self.working_path, 'bash -c "cd /project/install && cmake .. -DCMAKE_INSTALL_PREFIX=/usr -DCMAKE_INSTALL_LIBDIR=/usr/lib && make VERBOSE=1 && make DESTDIR=/install_root install"')
+            return self.run_chroot(self.working_path, 'bash -c "cd /project/install && cmake .. -DCMAKE_INSTALL_PREFIX=/usr -DCMAKE_INSTALL_LIBDIR=/usr/lib && make -j{:d} VERBOSE=1 && make DESTDIR=/install_root install"'.format(self.cpus), environment = self.get_build_environment())
         else:
-            return self.run_chroot(self.working_path, 'bash -c "cd /project/install && cmake .. -DCMAKE_INSTALL_PREFIX=/usr && make VERBOSE=1 && make DESTDIR=/install_root install"')
+            return self.run_chroot(self.working_path, 'bash -c "cd /project/install && cmake .. -DCMAKE_INSTALL_PREFIX=/usr && make -j{:d} VERBOSE=1 && make DESTDIR=/install_root install"'.format(self.cpus), environment = self.get_build_environment())
 
 
     def build_meson(self):
@@ -432,7 +885,7 @@ class package_base(object):
             shutil.rmtree(install_path,ignore_errors = True)
         os.makedirs(install_path)
 
-        return self.run_chroot(self.working_path, 'bash -c "cd /project/meson && meson .. && mesonconf -Dprefix=/usr && ninja && DESTDIR=/install_root ninja install"')
+        return self.run_chroot(self.working_path, 'bash -c "cd /project/meson && meson .. && mesonconf -Dprefix=/usr && ninja -j{:d} && DESTDIR=/install_root ninja install"'.format(self.cpus), environment = self.get_build_environment())
 
 
     def build_autoconf(self,autogen):
@@ -441,12 +894,12 @@ class package_base(object):
             if (self.run_chroot(self.working_path, 'bash -c "cd /project && ./autogen.sh"')):
                 return True
 
-        return self.run_chroot(self.working_path, 'bash -c "cd /project && ./configure --prefix=/usr && make clean && make && make DESTDIR=/install_root install"')
+        return self.run_chroot(self.working_path, 'bash -c "cd /project && ./configure --prefix=/usr && make clean && make -j{:d} && make DESTDIR=/install_root install"'.format(self.cpus), environment = self.get_build_environment())
 
 
     def build_makefile(self):
 
-        return self.run_chroot(self.working_path, 'bash -c "cd /project && make clean && make && make PREFIX=/usr DESTDIR=/install_root install"')
+        return self.run_chroot(self.working_path, 'bash -c "cd /project && make clean && make -j{:d} && make PREFIX=/usr DESTDIR=/install_root install"'.format(self.cpus), environment = self.get_build_environment())
 
 
     def get_string(self,line):
@@ -480,24 +933,99 @@ class package_base(object):
 
         if show_msg:
             print(_("Launching {:s}").format(str(command)))
+        start = time.monotonic()
         proc = subprocess.Popen(command, shell=True)
-        return proc.wait()
+        retval = proc.wait()
+        self.trace_command(str(command),"command",start,retval)
+        return retval
+
+
+    def run_storage_program(self,args,quiet = False):
+
+        start = time.monotonic()
+        retval = multipackager_module.storage.call_program(args,quiet)
+        self.trace_command(" ".join(args),"storage",start,retval)
+        return retval
+
+
+    def run_phase(self,phase,function,*args):
+
+        """ Runs a step of the current phase, measuring its time if the phase is being measured """
+
+        if (self.profiler == None) or (self.current_phase == None):
+            return function(*args)
+        return self.profiler.run(self,phase,function,*args)
+
+
+    def trace_command(self,command,category,start,retval):
 
+        """ Adds a command to the trace file, if it was requested """
 
-    def run_chroot(self,base_path,command,username = None):
+        if self.configuration.tracer == None:
+            return
+        self.configuration.tracer.add_event(command,category,self.distro_full_name,self.current_phase,start,time.monotonic() - start,{"exit_code":retval})
+
+
+    def get_chroot_command(self,base_path,command,username = None,environment = None,pipe = False):
+
+        """ Returns the command line that runs 'command' inside the chroot environment at base_path """
 
         if self.architecture == "i386":
             personality = "x86"
         else:
             personality = "x86-64"
 
-        if username != None:
-            userparam = "--user={:s}".format(username)
-        else:
-            userparam = ""
+        runner = multipackager_module.runners.get_runner(self.configuration.runner)
+        return runner.get_command(base_path,personality,command,username,environment,pipe,self.get_binds())
+
+
+    @contextlib.contextmanager
+    def chroot_session(self,base_path):
 
-        command = "systemd-nspawn {:s} -D {:s} --personality {:s} {:s}".format(userparam,base_path,personality,command)
-        return self.run_external_program(command)
+        """ While inside this context, all the commands launched with run_chroot in base_path are
+            sent to a single container, instead of launching a new one for each command """
+
+        if (not self.configuration.sessions) or (base_path in self.sessions):
+            yield
+            return
+
+        session = multipackager_module.chroot_session.chroot_session(self,base_path)
+        start = time.monotonic()
+        retval = session.start()
+        self.trace_command(session.command,"container",start,1 if retval else 0)
+        if retval:
+            print(_("Can't start a container session at {:s}; launching a container for each command").format(base_path))
+            yield
+            return
+
+        self.sessions[base_path] = session
+        try:
+            yield
+        finally:
+            del self.sessions[base_path]
+            session.stop()
+
+
+    def run_chroot(self,base_path,command,username = None,environment = None):
+
+        if len(self.configuration.proxy_environment) != 0:
+            # the package managers inside the container must use the caching proxy
+            proxy_environment = dict(self.configuration.proxy_environment)
+            if environment != None:
+                proxy_environment.update(environment)
+            environment = proxy_environment
+
+        # commands starting with parameters for systemd-nspawn can't be sent to a session
+        if (base_path in self.sessions) and (command[0] != "-"):
+            session = self.sessions[base_path]
+            if session.alive():
+                print(_("Launching {:s}").format(str(command)))
+                start = time.monotonic()
+                retval = session.run(command,username,environment)
+                self.trace_command(str(command),"session",start,retval)
+                return retval
+
+        return self.run_external_program(self.get_chroot_command(base_path,command,username,environment))
 
 
     def set_perms(self,filename):
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import struct
+import sqlite3
+import tarfile
+import threading
+
+RPM_STRING_TYPES = [6, 8, 9] # string, string array and i18n string
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_PROVIDENAME = 1047
+
+class package_database(object):
+
+    """ Packages installed in a CHROOT environment, read directly from the database of its package
+        manager, without launching anything inside it """
+
+    def __init__(self):
+
+        self.packages = {} # version of each installed package
+        self.provides = {} # packages that provide each virtual name
+        self.files = {} # file of each package in the repositories, indexed by its sha256 (only for pacman_sync)
+
+
+    def add(self,name,version,provides):
+
+        self.packages[name] = version
+        for virtual in provides:
+            if virtual not in self.provides:
+                self.provides[virtual] = []
+            self.provides[virtual].append(name)
+
+
+    def contains(self,name):
+
+        return (name in self.packages) or (name in self.provides)
+
+
+    def get_version(self,name):
+
+        return self.packages.get(name,None)
+
+
+    def is_satisfied(self,dependency):
+
+        """ Returns True if the dependency, as passed to the package manager, is already installed. It can be
+            a group of alternatives separated by '|', and can contain several packages separated by spaces or
+            commas. Dependencies with version constraints are never considered satisfied """
+
+        for alternative in dependency.split("|"):
+            names = alternative.replace(","," ").split()
+            if len(names) == 0:
+                continue
+            satisfied = True
+            for name in names:
+                if (name.find("<") != -1) or (name.find(">") != -1) or (name.find("=") != -1):
+                    satisfied = False
+                    break
+                # Debian architecture qualifiers, like 'python3:any'
+                if (name.find(":") != -1) and (name.find("(") == -1):
+                    name = name[:name.find(":")]
+                if not self.contains(name):
+                    satisfied = False
+                    break
+            if satisfied:
+                return True
+        return False
+
+
+def read_dpkg(path):
+
+    status_path = os.path.join(path,"var","lib","dpkg","status")
+    if not os.path.exists(status_path):
+        return None
+
+    database = package_database()
+    f = open(status_path,"r",encoding = "utf-8",errors = "replace")
+    data = f.read()
+    f.close()
+    for paragraph in data.split("\n\n"):
+        fields = {}
+        for line in paragraph.split("\n"):
+            if (line == "") or (line[0] in " \t"):
+                continue # continuation of a multiline field
+            pos = line.find(":")
+            if pos == -1:
+                continue
+            fields[line[:pos]] = line[pos+1:].strip()
+        if ("Package" not in fields) or ("Status" not in fields):
+            continue
+        if fields["Status"].split()[-1] != "installed":
+            continue # removed, but with its configuration files still there
+        provides = []
+        for virtual in fields.get("Provides","").split(","):
+            pos = virtual.find("(") # remove version info
+            if pos != -1:
+                virtual = virtual[:pos]
+            if virtual.strip() != "":
+                provides.append(virtual.strip())
+        database.add(fields["Package"],fields.get("Version",""),provides)
+    return database
+
+
+def read_pacman_desc(lines,sections):
+
+    """ Adds to sections the contents of a 'desc' or 'depends' file of a pacman database """
+
+    section = None
+    for line in lines:
+        line = line.strip()
+        if line == "":
+            section = None
+        elif (line[0] == "%") and (line[-1] == "%"):
+            section = line
+            sections[section] = []
+        elif section != None:
+            sections[section].append(line)
+
+
+def add_pacman_package(database,sections):
+
+    if ("%NAME%" not in sections) or (len(sections["%NAME%"]) == 0):
+        return
+    version = sections["%VERSION%"][0] if len(sections.get("%VERSION%",[])) != 0 else ""
+    provides = []
+    for virtual in sections.get("%PROVIDES%",[]):
+        pos = virtual.find("=") # remove version info
+        if pos != -1:
+            virtual = virtual[:pos]
+        provides.append(virtual)
+    database.add(sections["%NAME%"][0],version,provides)
+    if (len(sections.get("%FILENAME%",[])) != 0) and (len(sections.get("%SHA256SUM%",[])) != 0):
+        database.files[sections["%SHA256SUM%"][0]] = sections["%FILENAME%"][0]
+
+
+def read_pacman(path):
+
+    local_path = os.path.join(path,"var","lib","pacman","local")
+    if not os.path.exists(local_path):
+        return None
+
+    database = package_database()
+    for entry in os.listdir(local_path):
+        desc_path = os.path.join(local_path,entry,"desc")
+        if not os.path.exists(desc_path):
+            continue
+        sections = {}
+        f = open(desc_path,"r",encoding = "utf-8",errors = "replace")
+        read_pacman_desc(f,sections)
+        f.close()
+        add_pacman_package(database,sections)
+    return database
+
+
+def read_pacman_sync(path):
+
+    """ Reads the packages available in the repositories, from the databases downloaded by 'pacman -Sy'.
+        Returns None if any of them can't be read (like when they use a compression not supported here) """
+
+    sync_path = os.path.join(path,"var","lib","pacman","sync")
+    if not os.path.exists(sync_path):
+        return None
+
+    database = package_database()
+    for filename in sorted(os.listdir(sync_path)):
+        if not filename.endswith(".db"):
+            continue
+        try:
+            repository = tarfile.open(os.path.join(sync_path,filename),"r:*")
+            # each package has a folder, with a 'desc' file (and a 'depends' file in older databases)
+            packages = {}
+            for member in repository:
+                if not member.isfile():
+                    continue
+                folder,name = os.path.split(member.name)
+                if name not in ["desc", "depends"]:
+                    continue
+                if folder not in packages:
+                    packages[folder] = {}
+                data = repository.extractfile(member).read().decode("utf-8","replace")
+                read_pacman_desc(data.split("\n"),packages[folder])
+            repository.close()
+        except (tarfile.TarError, EOFError):
+            return None
+        for sections in packages.values():
+            add_pacman_package(database,sections)
+    return database
+
+
+def read_rpm_header(blob):
+
+    """ Returns the tags with strings in an RPM header, as stored in the database """
+
+    entries,data_size = struct.unpack(">II",blob[0:8])
+    data = blob[8+16*entries:]
+    tags = {}
+    for entry in range(entries):
+        tag,tag_type,offset,count = struct.unpack(">IIII",blob[8+16*entry:24+16*entry])
+        if tag_type in RPM_STRING_TYPES:
+            values = []
+            for n in range(count if tag_type == 8 else 1):
+                end = data.index(b"\0",offset)
+                values.append(data[offset:end].decode("utf-8","replace"))
+                offset = end + 1
+            tags[tag] = values
+        elif (tag_type == 4) and (count == 1):
+            tags[tag] = [str(struct.unpack(">I",data[offset:offset+4])[0])]
+    return tags
+
+
+def read_rpm(path):
+
+    # newer Fedora versions keep it in /usr, with a link in /var
+    for rpmdb_path in [os.path.join(path,"usr","lib","sysimage","rpm","rpmdb.sqlite"), os.path.join(path,"var","lib","rpm","rpmdb.sqlite")]:
+        if os.path.exists(rpmdb_path):
+            break
+    else:
+        return None # older versions use BerkeleyDB, which can't be read from here
+
+    database = package_database()
+    try:
+        connection = sqlite3.connect("file:{:s}?mode=ro".format(rpmdb_path), uri = True)
+        rows = connection.execute("SELECT blob FROM Packages").fetchall()
+        connection.close()
+    except sqlite3.Error:
+        return None
+    for row in rows:
+        try:
+            tags = read_rpm_header(bytes(row[0]))
+        except (struct.error, ValueError):
+            continue
+        if RPMTAG_NAME not in tags:
+            continue
+        version = tags.get(RPMTAG_VERSION,[""])[0]+"-"+tags.get(RPMTAG_RELEASE,[""])[0]
+        if RPMTAG_EPOCH in tags:
+            version = tags[RPMTAG_EPOCH][0]+":"+version
+        database.add(tags[RPMTAG_NAME][0],version,tags.get(RPMTAG_PROVIDENAME,[]))
+    return database
+
+
+readers = {
+    "dpkg": read_dpkg,
+    "pacman": read_pacman,
+    "pacman_sync": read_pacman_sync,
+    "rpm": read_rpm
+}
+
+# databases already read, with the cache generation at that moment
+databases = {}
+databases_lock = threading.Lock()
+
+
+def get_database(path,kind,generation,reader = None):
+
+    """ Returns the package_database of the CHROOT environment at path, or None if it can't be read.
+        It is read only once for each path and generation, which can be any value that changes when the
+        database does. reader replaces the default one for kind, and is called with path """
+
+    key = (path,kind)
+    with databases_lock:
+        if (key in databases) and (databases[key][0] == generation):
+            return databases[key][1]
+    if reader == None:
+        reader = readers[kind]
+    try:
+        database = reader(path)
+    except (OSError, UnicodeError):
+        database = None
+    with databases_lock:
+        databases[key] = (generation,database)
+    return database
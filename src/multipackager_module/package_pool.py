@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import hashlib
+import threading
+
+PACKAGE_EXTENSIONS = (".deb", ".rpm", ".pkg.tar", ".pkg.tar.gz", ".pkg.tar.xz", ".pkg.tar.zst")
+
+# the pool is shared by all the targets built at the same time
+pool_lock = threading.Lock()
+
+
+class package_pool(object):
+
+    """ Keeps the packages downloaded by the package managers of all the CHROOT environments. Each
+        environment has its own folder (a view) bind-mounted over its package cache folder, and each
+        package in a view is a hardlink to a file in the objects folder, named after the sha256 of its
+        contents; this way, a package downloaded for several environments is stored only once. When the
+        repository metadata gives the sha256 of the packages, the ones already in the pool are linked into
+        the view before the package manager runs, so they aren't downloaded again """
+
+    def __init__(self, pool_path, max_size):
+
+        self.pool_path = pool_path
+        self.objects_path = os.path.join(pool_path,"objects")
+        self.views_path = os.path.join(pool_path,"views")
+        self.max_size = max_size # in bytes
+
+
+    def enabled(self):
+
+        return self.max_size > 0
+
+
+    def get_view_path(self,name):
+
+        view_path = os.path.join(self.views_path,name)
+        if not os.path.exists(view_path):
+            os.makedirs(view_path)
+        return view_path
+
+
+    def hash_file(self,path):
+
+        hasher = hashlib.sha256()
+        f = open(path,"rb")
+        while True:
+            data = f.read(1048576)
+            if len(data) == 0:
+                break
+            hasher.update(data)
+        f.close()
+        return hasher.hexdigest()
+
+
+    def ingest(self,view_path):
+
+        """ Adds to the pool the packages downloaded into a view since the last call. Returns the
+            number of new packages and of packages that were already in the pool """
+
+        new_packages = 0
+        duplicated = 0
+        with pool_lock:
+            for dirname, dirnames, filenames in os.walk(view_path):
+                # incomplete downloads
+                if "partial" in dirnames:
+                    dirnames.remove("partial")
+                for filename in filenames:
+                    if not filename.endswith(PACKAGE_EXTENSIONS):
+                        continue
+                    package_path = os.path.join(dirname,filename)
+                    status = os.lstat(package_path)
+                    if status.st_nlink != 1:
+                        continue # it is already a link to an object
+                    key = self.hash_file(package_path)
+                    object_path = os.path.join(self.objects_path,key[:2],key)
+                    if not os.path.exists(os.path.dirname(object_path)):
+                        os.makedirs(os.path.dirname(object_path))
+                    try:
+                        os.link(package_path,object_path)
+                        new_packages += 1
+                    except FileExistsError:
+                        # downloaded again for another environment; keep only one copy
+                        tmp_path = package_path+".pool"
+                        os.link(object_path,tmp_path)
+                        os.rename(tmp_path,package_path)
+                        os.utime(object_path)
+                        duplicated += 1
+            self.evict()
+        return new_packages,duplicated
+
+
+    def link_objects(self,view_path,archives):
+
+        """ Links into a view the packages of the pool that its package manager knows, before it downloads them.
+            archives contains the name that the package manager expects for each package, indexed by its sha256.
+            Returns the number of packages linked """
+
+        linked = 0
+        with pool_lock:
+            if not os.path.exists(self.objects_path):
+                return 0
+            for prefix in os.listdir(self.objects_path):
+                prefix_path = os.path.join(self.objects_path,prefix)
+                for key in os.listdir(prefix_path):
+                    if key not in archives:
+                        continue
+                    package_path = os.path.join(view_path,archives[key])
+                    if os.path.exists(package_path):
+                        continue
+                    os.link(os.path.join(prefix_path,key),package_path)
+                    os.utime(os.path.join(prefix_path,key))
+                    linked += 1
+        return linked
+
+
+    def evict(self):
+
+        """ Removes the oldest packages, from the objects folder and from all the views, until
+            the pool fits in its maximum size. Must be called with the lock held """
+
+        objects = []
+        total_size = 0
+        if not os.path.exists(self.objects_path):
+            return
+        for prefix in os.listdir(self.objects_path):
+            prefix_path = os.path.join(self.objects_path,prefix)
+            for key in os.listdir(prefix_path):
+                object_path = os.path.join(prefix_path,key)
+                status = os.lstat(object_path)
+                objects.append((status.st_mtime,status.st_size,status.st_ino,object_path))
+                total_size += status.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        # the links in the views are found by their inode
+        links = {}
+        for dirname, dirnames, filenames in os.walk(self.views_path):
+            for filename in filenames:
+                path = os.path.join(dirname,filename)
+                inode = os.lstat(path).st_ino
+                if inode not in links:
+                    links[inode] = []
+                links[inode].append(path)
+
+        objects.sort()
+        for mtime,size,inode,object_path in objects:
+            if total_size <= self.max_size:
+                break
+            print(_("Removing {:s} from the package pool").format(object_path))
+            for path in links.get(inode,[]):
+                os.remove(path)
+            os.remove(object_path)
+            total_size -= size
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import time
+import threading
+import importlib
+import importlib.util
+import traceback
+
+class profiler(object):
+
+    """ Measures the time spent by each target in each phase, and calls the hooks defined in the
+        user modules listed in the configuration file. A hook module can define these functions:
+
+            pre_phase(distro, phase)
+            post_phase(distro, phase, elapsed, failed)
+
+        where distro is the object of the target (with distro_type, distro_name, architecture,
+        distro_full_name, working_path, project_name...), phase is the name of the phase,
+        elapsed is the time spent in seconds, and failed is True if the phase failed.
+
+        A phase can be split in steps, measured with distro.run_phase(); they are shown
+        below the phase, but not added to the total time """
+
+    def __init__(self):
+
+        self.modules = []
+        self.timings = {}
+        self.lock = threading.Lock()
+
+
+    def load_hooks(self,hooks):
+
+        """ Loads the hook modules. Each one can be a path to a python file or a module name, and is loaded
+            only once even if it is repeated. Returns True if there was an error """
+
+        loaded = []
+        for hook in hooks:
+            if hook in loaded:
+                continue
+            loaded.append(hook)
+            try:
+                if hook.endswith(".py") or (hook.find(os.path.sep) != -1):
+                    name = "multipackager_hook_{:d}".format(len(self.modules))
+                    spec = importlib.util.spec_from_file_location(name,hook)
+                    module = importlib.util.module_from_spec(spec)
+                    spec.loader.exec_module(module)
+                else:
+                    module = importlib.import_module(hook)
+            except Exception as e:
+                print(_("Can't load the hook module {:s}: {:s}").format(hook,str(e)))
+                return True
+            self.modules.append(module)
+        return False
+
+
+    def call_hooks(self,function_name,*args):
+
+        for module in self.modules:
+            function = getattr(module,function_name,None)
+            if function == None:
+                continue
+            try:
+                function(*args)
+            except Exception:
+                # a failure in a hook must not stop the build
+                print(_("Exception in the hook {:s} of {:s}").format(function_name,module.__name__))
+                traceback.print_exc()
+
+
+    def run(self,distro,phase,function,*args):
+
+        """ Runs a phase of a target, measuring the time spent in it, and returns its result """
+
+        distro.profiler = self
+        if distro.current_phase != None:
+            phase = distro.current_phase+"/"+phase
+        self.call_hooks("pre_phase",distro,phase)
+        previous_phase = distro.current_phase
+        distro.current_phase = phase
+        start = time.monotonic()
+        failed = True
+        try:
+            retval = function(*args)
+            # True, or the exit code of a program; other values (package names, lists...) are results
+            failed = (retval is True) or ((type(retval) == int) and (retval != 0))
+        finally:
+            elapsed = time.monotonic() - start
+            distro.current_phase = previous_phase
+            if distro.configuration.tracer != None:
+                distro.configuration.tracer.add_event(phase,"phase",distro.distro_full_name,phase,start,elapsed,{"failed":failed})
+            with self.lock:
+                if distro.distro_full_name not in self.timings:
+                    self.timings[distro.distro_full_name] = []
+                self.timings[distro.distro_full_name].append((phase,elapsed,previous_phase != None))
+            self.call_hooks("post_phase",distro,phase,elapsed,failed)
+        return retval
+
+
+    def print_summary(self):
+
+        if len(self.timings) == 0:
+            return
+        print(_("Time spent in each phase:"))
+        for target in sorted(self.timings):
+            total = 0.0
+            for phase,elapsed,step in self.timings[target]:
+                if not step:
+                    total += elapsed
+            print("  {:s}: {:.1f} s".format(target,total))
+            steps = []
+            for phase,elapsed,step in self.timings[target]:
+                if step:
+                    steps.append((phase,elapsed)) # they end before their phase, but are shown after it
+                    continue
+                print("    {:<32s} {:>9.1f} s {:>5.1f}%".format(phase,elapsed,(100.0 * elapsed / total) if total > 0 else 0.0))
+                for step_phase,step_elapsed in steps:
+                    print("      {:<30s} {:>9.1f} s {:>5.1f}%".format(step_phase[len(phase)+1:],step_elapsed,(100.0 * step_elapsed / total) if total > 0 else 0.0))
+                steps = []
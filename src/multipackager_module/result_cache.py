@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import shutil
+import hashlib
+import threading
+import stat
+
+class result_cache(object):
+
+    """ Stores the packages already built, indexed by a hash of everything used to build them
+        (project files, packaging metadata, dependencies, cache generation and revision) """
+
+    def __init__(self, cache_path, max_size):
+
+        self.cache_path = cache_path
+        self.max_size = max_size # in bytes
+        self.lock = threading.Lock()
+
+
+    def enabled(self):
+
+        return self.max_size > 0
+
+
+    def hash_file(self,path,hasher):
+
+        f = open(path,"rb")
+        while True:
+            data = f.read(1048576)
+            if len(data) == 0:
+                break
+            hasher.update(data)
+        f.close()
+
+
+    def hash_tree(self,project_path,hasher):
+
+        """ Adds to the hash the files that will be copied into the chroot. The folders and files at the
+            top level starting with a dot are skipped, because 'cp -a project/*' doesn't copy them """
+
+        for dirname, dirnames, filenames in os.walk(project_path):
+            if dirname == project_path:
+                dirnames[:] = [d for d in dirnames if d[0] != "."]
+                filenames = [f for f in filenames if f[0] != "."]
+            dirnames.sort()
+            for filename in sorted(filenames + [d for d in dirnames if os.path.islink(os.path.join(dirname,d))]):
+                fullpath = os.path.join(dirname,filename)
+                status = os.lstat(fullpath)
+                hasher.update("{:s}\0{:o}\0".format(os.path.relpath(fullpath,project_path),status.st_mode).encode("utf-8","surrogateescape"))
+                if stat.S_ISLNK(status.st_mode):
+                    hasher.update(os.readlink(fullpath).encode("utf-8","surrogateescape"))
+                elif stat.S_ISREG(status.st_mode):
+                    self.hash_file(fullpath,hasher)
+                hasher.update(b"\0")
+
+
+    def get_key(self,distro,project_path,package_name,dependencies,preinstall):
+
+        hasher = hashlib.sha256()
+        hasher.update("multipackager-result-2\0{:s}\0{:s}\0{:d}\0{:d}\0".format(distro.distro_full_name,package_name,distro.configuration.revision,distro.get_cache_generation()).encode("utf-8"))
+        # the packaging metadata (debian/control, the .spec file, the PKGBUILD...) is inside the project tree
+        self.hash_tree(project_path,hasher)
+        for dependency in sorted(dependencies):
+            hasher.update("{:s}\0".format(dependency).encode("utf-8"))
+        # the versions that will be installed, which can change without a new generation of the cache
+        for version in distro.get_dependency_versions(dependencies):
+            hasher.update("{:s}\0".format(version).encode("utf-8"))
+        for package in preinstall:
+            self.hash_file(package,hasher)
+        return hasher.hexdigest()
+
+
+    def get_entry_path(self,key):
+
+        return os.path.join(self.cache_path,key[:2],key)
+
+
+    def restore(self,key,package_name,destination_path):
+
+        """ Copies the cached package to destination_path. Returns True if it was found """
+
+        package_path = os.path.join(self.get_entry_path(key),package_name)
+        if not os.path.exists(package_path):
+            return False
+
+        tmp_path = destination_path+".tmp"
+        shutil.copy2(package_path,tmp_path)
+        os.rename(tmp_path,destination_path)
+        os.utime(self.get_entry_path(key)) # mark as recently used
+        return True
+
+
+    def store(self,key,package_name,package_path):
+
+        if not os.path.exists(package_path):
+            return
+
+        entry_path = self.get_entry_path(key)
+        tmp_path = entry_path+".tmp"
+        shutil.rmtree(tmp_path, ignore_errors = True)
+        shutil.rmtree(entry_path, ignore_errors = True)
+        os.makedirs(tmp_path)
+        shutil.copy2(package_path,os.path.join(tmp_path,package_name))
+        os.rename(tmp_path,entry_path)
+        self.evict()
+
+
+    def evict(self):
+
+        """ Removes the least recently used entries until the cache fits in its maximum size """
+
+        with self.lock:
+            entries = []
+            total_size = 0
+            for prefix in os.listdir(self.cache_path):
+                prefix_path = os.path.join(self.cache_path,prefix)
+                if not os.path.isdir(prefix_path):
+                    continue
+                for key in os.listdir(prefix_path):
+                    entry_path = os.path.join(prefix_path,key)
+                    if key.endswith(".tmp"):
+                        continue
+                    size = 0
+                    for f in os.listdir(entry_path):
+                        size += os.lstat(os.path.join(entry_path,f)).st_size
+                    entries.append((os.stat(entry_path).st_mtime,size,entry_path))
+                    total_size += size
+
+            entries.sort()
+            for mtime,size,entry_path in entries:
+                if total_size <= self.max_size:
+                    break
+                print(_("Removing {:s} from the package cache").format(entry_path))
+                shutil.rmtree(entry_path, ignore_errors = True)
+                total_size -= size
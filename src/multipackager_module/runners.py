@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import sys
+import shlex
+
+class nspawn_runner(object):
+
+    """ Launches the commands with systemd-nspawn """
+
+    def get_command(self,base_path,personality,command,username = None,environment = None,pipe = False,binds = None):
+
+        if username != None:
+            userparam = "--user={:s}".format(username)
+        else:
+            userparam = ""
+
+        if binds != None:
+            for bind in binds:
+                userparam += " --bind={:s}".format(bind)
+
+        if environment != None:
+            for variable in environment:
+                userparam += " --setenv={:s}={:s}".format(variable,environment[variable])
+
+        if pipe:
+            userparam += " --console=pipe"
+
+        return "systemd-nspawn {:s} -D {:s} --personality {:s} {:s}".format(userparam,base_path,personality,command)
+
+
+class namespace_runner(object):
+
+    """ Launches the commands with namespace_helper.py, which creates the mount, PID, UTS and IPC
+        namespaces and does the chroot itself, without the machine registration and journal
+        management done by systemd-nspawn """
+
+    def get_command(self,base_path,personality,command,username = None,environment = None,pipe = False,binds = None):
+
+        helper = os.path.join(os.path.dirname(os.path.abspath(__file__)),"namespace_helper.py")
+        params = "--root={:s} --personality={:s}".format(shlex.quote(base_path),personality)
+        if username != None:
+            params += " --user={:s}".format(username)
+        if environment != None:
+            for variable in environment:
+                params += " --setenv={:s}={:s}".format(variable,environment[variable])
+
+        if binds != None:
+            # the helper accepts the same --bind parameters than systemd-nspawn before the command
+            for bind in binds:
+                command = "--bind={:s} {:s}".format(bind,command)
+
+        return "{:s} {:s} {:s} -- {:s}".format(shlex.quote(sys.executable),shlex.quote(helper),params,command)
+
+
+runners = {
+    "nspawn" : nspawn_runner,
+    "namespace" : namespace_runner
+}
+
+
+def get_runner(name):
+
+    if name not in runners:
+        return None
+    return runners[name]()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import threading
+import traceback
+
+class scheduler(object):
+
+    """ Runs a list of tasks using up to 'jobs' threads. Each task has a list of keys (usually
+        cache paths); two tasks sharing a key never run at the same time. Tasks are started
+        in the order they were added, skipping those that are blocked by a running one. """
+
+    def __init__(self, jobs = 1):
+
+        self.jobs = max(1,jobs)
+        self.tasks = []
+        self.condition = threading.Condition()
+
+
+    def add_task(self, function, args = (), keys = []):
+
+        self.tasks.append({"function":function, "args":args, "keys":set(keys), "result":None, "started":False, "done":False})
+        return len(self.tasks) - 1
+
+
+    def get_concurrency(self):
+
+        """ Returns how many tasks can run at the same time """
+
+        return max(1,min(self.jobs,len(self.tasks)))
+
+
+    def run_task(self,task):
+
+        try:
+            task["result"] = task["function"](*task["args"])
+        except:
+            traceback.print_exc()
+            task["result"] = None
+
+
+    def get_next_task(self,busy_keys):
+
+        for task in self.tasks:
+            if task["started"]:
+                continue
+            if len(task["keys"] & busy_keys) != 0:
+                continue
+            return task
+        return None
+
+
+    def worker(self,busy_keys):
+
+        while True:
+            with self.condition:
+                while True:
+                    task = self.get_next_task(busy_keys)
+                    if task != None:
+                        break
+                    if all(t["started"] for t in self.tasks):
+                        return
+                    self.condition.wait()
+                task["started"] = True
+                busy_keys |= task["keys"]
+
+            self.run_task(task)
+
+            with self.condition:
+                task["done"] = True
+                busy_keys -= task["keys"]
+                self.condition.notify_all()
+
+
+    def run(self):
+
+        """ Runs all the tasks and returns a list with their results, in the same order they were added """
+
+        if self.get_concurrency() == 1:
+            for task in self.tasks:
+                task["started"] = True
+                self.run_task(task)
+                task["done"] = True
+        else:
+            busy_keys = set()
+            threads = []
+            for n in range(self.get_concurrency()):
+                thread = threading.Thread(target = self.worker, args = (busy_keys,))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+
+        return [task["result"] for task in self.tasks]
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import re
+import shutil
+import subprocess
+import threading
+import fcntl
+import tempfile
+
+# ioctl to share the blocks of a file with another one (reflink)
+FICLONE = 0x40049409
+
+
+def call_program(args,quiet = False):
+
+    if quiet:
+        return subprocess.call(args,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+    return subprocess.call(args)
+
+
+class copy_storage(object):
+
+    """ Creates, copies and deletes the CHROOT environments. This one works in any filesystem,
+        copying and deleting every file """
+
+    name = "copy"
+
+    def __init__(self, run_program = None):
+
+        # function used to launch the external programs; receives the arguments and if the output must be hidden
+        self.run_program = run_program if run_program != None else call_program
+
+
+    def create_parent(self,path):
+
+        parent = os.path.dirname(path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+
+
+    def create_folder(self,path):
+
+        """ Creates an empty folder to generate a CHROOT environment inside """
+
+        os.makedirs(path)
+        return False
+
+
+    def clone(self,origin_path,destination_path):
+
+        """ Creates destination_path as a copy of origin_path. Returns True if there was an error """
+
+        self.create_parent(destination_path)
+        return 0 != self.run_program(["cp","-a",origin_path,destination_path])
+
+
+    def delete(self,path):
+
+        shutil.rmtree(path, ignore_errors=True)
+        return False
+
+
+class reflink_storage(copy_storage):
+
+    """ The copies share the data blocks with the original files (XFS, btrfs...), so only the
+        metadata is written """
+
+    name = "reflink"
+
+    def clone(self,origin_path,destination_path):
+
+        # falls back to a normal copy if the destination is in another filesystem
+        self.create_parent(destination_path)
+        return 0 != self.run_program(["cp","-a","--reflink=auto",origin_path,destination_path])
+
+
+class btrfs_storage(reflink_storage):
+
+    """ Each CHROOT environment is a btrfs subvolume, so copying it is just taking a snapshot,
+        and deleting it doesn't need to walk its files """
+
+    name = "btrfs"
+
+    def is_subvolume(self,path):
+
+        try:
+            status = os.lstat(path)
+        except OSError:
+            return False
+        # the root folder of a btrfs subvolume always has this inode number
+        return os.path.isdir(path) and (not os.path.islink(path)) and (status.st_ino == 256)
+
+
+    def create_folder(self,path):
+
+        self.create_parent(path)
+        if 0 == self.run_program(["btrfs","subvolume","create",path],True):
+            return False
+        return super().create_folder(path)
+
+
+    def clone(self,origin_path,destination_path):
+
+        if self.is_subvolume(origin_path):
+            self.create_parent(destination_path)
+            if 0 == self.run_program(["btrfs","subvolume","snapshot",origin_path,destination_path],True):
+                return False
+            # the destination is in another filesystem
+        return super().clone(origin_path,destination_path)
+
+
+    def delete(self,path):
+
+        if self.is_subvolume(path):
+            if 0 == self.run_program(["btrfs","subvolume","delete",path],True):
+                return False
+        return super().delete(path)
+
+
+storages = {
+    "copy" : copy_storage,
+    "reflink" : reflink_storage,
+    "btrfs" : btrfs_storage
+}
+
+detected_storages = {}
+detection_lock = threading.Lock()
+
+
+def get_filesystem_type(path):
+
+    """ Returns the type of the filesystem where path is stored, reading the mount table """
+
+    path = os.path.realpath(path)
+    fs_type = None
+    mount_length = -1
+    try:
+        f = open("/proc/self/mountinfo","r")
+    except:
+        return None
+    for line in f:
+        fields = line.split(" ")
+        if (len(fields) < 5) or ("-" not in fields):
+            continue
+        # spaces and other special characters are stored in octal
+        mount_point = re.sub("\\\\([0-7]{3})", lambda m: chr(int(m.group(1),8)), fields[4])
+        if (mount_point == path) or (mount_point == "/") or (path.startswith(mount_point+os.path.sep)):
+            # the last mount point wins, because it can be mounted over another one
+            if len(mount_point) >= mount_length:
+                mount_length = len(mount_point)
+                fs_type = fields[fields.index("-")+1]
+    f.close()
+    return fs_type
+
+
+def supports_reflink(path):
+
+    """ Checks if the filesystem allows to share the data blocks between two files """
+
+    try:
+        origin = tempfile.TemporaryFile(dir = path)
+        destination = tempfile.TemporaryFile(dir = path)
+    except OSError:
+        return False
+    try:
+        origin.write(b"multipackager")
+        origin.flush()
+        fcntl.ioctl(destination.fileno(),FICLONE,origin.fileno())
+        retval = True
+    except OSError:
+        retval = False
+    origin.close()
+    destination.close()
+    return retval
+
+
+def detect_storage(path):
+
+    # the cache path can not exist yet
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
+    if (get_filesystem_type(path) == "btrfs") and (shutil.which("btrfs") != None):
+        return "btrfs"
+    if supports_reflink(path):
+        return "reflink"
+    return "copy"
+
+
+def get_storage(path,name = "auto",run_program = None):
+
+    """ Returns the storage backend to use for the CHROOT environments stored in path. With 'auto', the
+        best one supported by its filesystem is used """
+
+    if name == "auto":
+        with detection_lock:
+            if path not in detected_storages:
+                detected_storages[path] = detect_storage(path)
+                print(_("Using {:s} storage for {:s}").format(detected_storages[path],path))
+            name = detected_storages[path]
+    if name not in storages:
+        return None
+    return storages[name](run_program)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 (C) Raster Software Vigo (Sergio Costas)
+#
+# This file is part of Multipackager
+#
+# Multipackager is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Multipackager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+
+import os
+import time
+import json
+import threading
+
+class tracer(object):
+
+    """ Stores the commands launched and the phases of each target as events in the Chrome trace
+        format, which can be opened with chrome://tracing or Perfetto. Each target is shown as
+        a different thread """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.start_time = time.monotonic()
+        self.events = []
+        self.targets = {}
+        self.lock = threading.Lock()
+
+
+    def get_tid(self,target):
+
+        if target == None:
+            target = _("multipackager")
+        if target not in self.targets:
+            self.targets[target] = len(self.targets) + 1
+            self.events.append({"name":"thread_name", "ph":"M", "pid":os.getpid(), "tid":self.targets[target], "args":{"name":target}})
+        return self.targets[target]
+
+
+    def add_event(self,name,category,target,phase,start,duration,args = None):
+
+        """ Adds an event that started at 'start' (a time.monotonic() value) and lasted 'duration' seconds """
+
+        event_args = {"target":target, "phase":phase}
+        if args != None:
+            event_args.update(args)
+        with self.lock:
+            self.events.append({"name":name,
+                                "cat":category,
+                                "ph":"X",
+                                "ts":int((start - self.start_time) * 1000000),
+                                "dur":int(duration * 1000000),
+                                "pid":os.getpid(),
+                                "tid":self.get_tid(target),
+                                "args":event_args})
+
+
+    def write(self):
+
+        """ Writes the trace file. Returns True if there was an error """
+
+        with self.lock:
+            data = {"traceEvents":self.events, "displayTimeUnit":"ms"}
+        try:
+            f = open(self.filename,"w")
+            json.dump(data,f)
+            f.close()
+        except Exception as e:
+            print(_("Can't write the trace file {:s}: {:s}").format(self.filename,str(e)))
+            return True
+        print(_("Trace written to {:s}").format(self.filename))
+        return False